@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""Compare suitcase.framing against byte-by-byte escaping loops
+
+Each framing is used to encode and then deframe the same frames.  The
+naive implementations process one byte at a time in Python, as escaping
+is often written::
+
+    python benchmarks/framing.py --total 1048576 --chunk 4096
+
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+import six
+
+from suitcase.framing import SLIPFraming, HDLCFraming, COBSFraming, Deframer
+
+
+def naive_escape(data, reserved, escape, mask=0x20):
+    out = bytearray()
+    for byte in six.iterbytes(data):
+        if byte in reserved:
+            out.append(escape)
+            out.append(byte ^ mask)
+        else:
+            out.append(byte)
+    return bytes(out)
+
+
+class NaiveDeframer(object):
+    """Byte-at-a-time HDLC-like deframing"""
+
+    def __init__(self, flag, escape, callback, mask=0x20):
+        self.flag = flag
+        self.escape = escape
+        self.mask = mask
+        self.callback = callback
+        self.frame = bytearray()
+        self.escaped = False
+
+    def feed(self, data):
+        for byte in six.iterbytes(data):
+            if byte == self.flag:
+                if self.frame:
+                    self.callback(bytes(self.frame))
+                self.frame = bytearray()
+                self.escaped = False
+            elif self.escaped:
+                self.frame.append(byte ^ self.mask)
+                self.escaped = False
+            elif byte == self.escape:
+                self.escaped = True
+            else:
+                self.frame.append(byte)
+
+
+def build_frames(total_bytes, payload_size):
+    rng = random.Random(0)
+    frames = []
+    size = 0
+    while size < total_bytes:
+        frames.append(bytes(bytearray(rng.getrandbits(8)
+                                      for _ in range(payload_size))))
+        size += payload_size
+    return frames
+
+
+def measure(encode, make_deframer, frames, chunk_size):
+    received = []
+    start = time.time()
+    stream = b''.join(encode(frame) for frame in frames)
+    encoded = time.time()
+    deframer = make_deframer(received.append)
+    for offset in range(0, len(stream), chunk_size):
+        deframer.feed(stream[offset:offset + chunk_size])
+    done = time.time()
+    assert received == frames
+    return encoded - start, done - encoded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--total', type=int, default=256 * 1024,
+                        help='number of payload bytes')
+    parser.add_argument('--payload', type=int, default=256,
+                        help='payload size of each frame')
+    parser.add_argument('--chunk', type=int, default=4096,
+                        help='read size to feed the deframer with')
+    args = parser.parse_args()
+
+    frames = build_frames(args.total, args.payload)
+    total = len(frames) * args.payload
+
+    hdlc = HDLCFraming()
+    cases = [
+        ("naive hdlc",
+         lambda data: b'\x7e' + naive_escape(data, (0x7d, 0x7e), 0x7d) + b'\x7e',
+         lambda callback: NaiveDeframer(0x7e, 0x7d, callback)),
+        ("hdlc", hdlc.encode, lambda callback: Deframer(hdlc, callback)),
+        ("slip", SLIPFraming().encode,
+         lambda callback: Deframer(SLIPFraming(), callback)),
+        ("cobs", COBSFraming().encode,
+         lambda callback: Deframer(COBSFraming(), callback)),
+    ]
+    print("%d frames of %d bytes" % (len(frames), args.payload))
+    print("%12s %14s %14s" % ("framing", "encode MB/s", "deframe MB/s"))
+    for name, encode, make_deframer in cases:
+        encode_time, deframe_time = measure(encode, make_deframer, frames,
+                                            args.chunk)
+        print("%12s %14.2f %14.2f" % (name, total / encode_time / 1e6,
+                                      total / deframe_time / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""Measure decode_parallel() throughput as a function of worker count
+
+A capture file of checksummed frames is written to a temporary file and
+decoded with an increasing number of worker processes, reducing each
+message to its sequence number::
+
+    python benchmarks/parallel_decode.py --total 67108864 --workers 1 2 4 8
+
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import tempfile
+import time
+
+from suitcase.crc import crc16_ccitt
+from suitcase.fields import Magic, UBInt16, UBInt32, LengthField, Payload, CRCField
+from suitcase.io import MappedFrameReader, decode_parallel
+from suitcase.structure import Structure
+
+
+class CaptureFrame(Structure):
+    magic = Magic(b'\xAA\x55')
+    sequence = UBInt32()
+    length = LengthField(UBInt16())
+    payload = Payload(length)
+    crc = CRCField(UBInt16(), crc16_ccitt, 2, -2)
+
+
+def sequence_of(message):
+    return message.sequence
+
+
+def write_capture(f, total_bytes, payload_size):
+    frames = 0
+    size = 0
+    while size < total_bytes:
+        frame = CaptureFrame(sequence=frames, payload=b'\x5A' * payload_size).pack()
+        f.write(frame)
+        size += len(frame)
+        frames += 1
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--total', type=int, default=8 * 1024 * 1024,
+                        help='number of bytes in the capture')
+    parser.add_argument('--payload', type=int, default=64,
+                        help='payload size of each frame')
+    parser.add_argument('--chunk', type=int, default=1024 * 1024,
+                        help='chunk size')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, os.cpu_count() or 1],
+                        help='worker counts to measure')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.bin')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            nframes = write_capture(f, args.total, args.payload)
+        print("%d bytes, %d frames" % (os.path.getsize(path), nframes))
+
+        start = time.time()
+        with MappedFrameReader(path, CaptureFrame) as reader:
+            count = sum(1 for _message in reader)
+        sequential = time.time() - start
+        assert count == nframes
+        print("%10s %12s %12s %10s" % ("workers", "MB/s", "frames/s", "speedup"))
+        print("%10s %12.2f %12.0f %10.2f" % ("reader", args.total / sequential / 1e6,
+                                             nframes / sequential, 1.0))
+        for workers in args.workers:
+            start = time.time()
+            count = sum(1 for _result in decode_parallel(
+                path, CaptureFrame, sequence_of, workers=workers, chunk_size=args.chunk))
+            elapsed = time.time() - start
+            assert count == nframes
+            print("%10d %12.2f %12.0f %10.2f" % (workers, args.total / elapsed / 1e6,
+                                                 nframes / elapsed, sequential / elapsed))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
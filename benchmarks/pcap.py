@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""Measure PacketReader throughput on pcap and pcapng captures
+
+Captures of UDP datagrams are written to temporary files and read back,
+both memory mapped and through a file object, with and without
+unpacking each packet::
+
+    python benchmarks/pcap.py --total 1073741824 --payload 512
+
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import tempfile
+import time
+
+from suitcase.pcap import PacketReader, PcapWriter, PcapngWriter, LINKTYPE_RAW
+from suitcase.test.examples.test_network_stack import UDPFrame
+
+
+def write_capture(path, writer_class, total_bytes, payload_size):
+    frame = UDPFrame(source_port=9101, destination_port=9100, checksum=0,
+                     data=b'\x5A' * payload_size).pack()
+    packets = 0
+    with writer_class(path, LINKTYPE_RAW) as writer:
+        for packets in range(1, total_bytes // len(frame) + 1):
+            writer.write(frame, timestamp=packets)
+    return packets
+
+
+def read_packets(path):
+    with PacketReader(path) as reader:
+        return sum(1 for _packet in reader)
+
+
+def read_stream(path):
+    with open(path, 'rb') as f:
+        return sum(1 for _packet in PacketReader(f))
+
+
+def read_messages(path):
+    with PacketReader(path) as reader:
+        return sum(1 for _message in reader.messages(UDPFrame))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--total', type=int, default=64 * 1024 * 1024,
+                        help='number of bytes of packets in each capture')
+    parser.add_argument('--payload', type=int, default=512,
+                        help='payload size of each datagram')
+    args = parser.parse_args()
+
+    print("%10s %10s %12s %12s" % ("format", "reader", "MB/s", "packets/s"))
+    for name, writer_class in (('pcap', PcapWriter), ('pcapng', PcapngWriter)):
+        fd, path = tempfile.mkstemp(suffix='.' + name)
+        os.close(fd)
+        try:
+            npackets = write_capture(path, writer_class, args.total, args.payload)
+            size = os.path.getsize(path)
+            for label, read in (('mmap', read_packets), ('stream', read_stream),
+                                ('unpack', read_messages)):
+                start = time.time()
+                count = read(path)
+                elapsed = time.time() - start
+                assert count == npackets
+                print("%10s %10s %12.2f %12.0f" % (name, label, size / elapsed / 1e6,
+                                                   npackets / elapsed))
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""Measure StreamProtocolHandler throughput as a function of read size
+
+The same stream of frames is fed to the handler in chunks ranging from
+a single byte (slow serial reads) to 1 MB (one large socket read holding
+thousands of frames).  With linear buffering the throughput for a given
+chunk size should not depend on the total amount of data fed::
+
+    python benchmarks/stream_fragmentation.py --total 1048576
+
+With ``--readinto`` the stream is read directly into the handler's
+buffer using ``get_buffer()`` and ``buffer_updated()`` instead of
+``feed()``.
+
+With ``--field-by-field`` the frames are also parsed one field at a time,
+as is done for layouts whose size is not known from their header, for
+comparison with unpacking each frame once it has been buffered whole.
+
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import time
+
+from suitcase.fields import Magic, UBInt16, LengthField, Payload
+from suitcase.protocol import StreamProtocolHandler
+from suitcase.structure import Structure
+
+
+class FieldByFieldHandler(StreamProtocolHandler):
+    """Parse every frame field by field, ignoring its layout"""
+
+    def _read_frame(self, message_schema, layout):
+        return self._read_frame_incrementally(message_schema)
+
+
+class BenchmarkFrame(Structure):
+    magic = Magic(b'\xAA\x55')
+    sequence = UBInt16()
+    length = LengthField(UBInt16())
+    payload = Payload(length)
+
+
+def build_stream(total_bytes, payload_size):
+    frames = []
+    size = 0
+    sequence = 0
+    while size < total_bytes:
+        frame = BenchmarkFrame(sequence=sequence & 0xFFFF,
+                               payload=b'\x5A' * payload_size).pack()
+        frames.append(frame)
+        size += len(frame)
+        sequence += 1
+    return b''.join(frames), len(frames)
+
+
+def run(stream, expected_frames, chunk_size, readinto=False,
+        handler_class=StreamProtocolHandler):
+    received = [0]
+
+    def callback(packet):
+        received[0] += 1
+
+    handler = handler_class(BenchmarkFrame, callback)
+    start = time.time()
+    if readinto:
+        source = io.BytesIO(stream)
+        while True:
+            nbytes = source.readinto(handler.get_buffer(chunk_size)[:chunk_size])
+            if nbytes == 0:
+                break
+            handler.buffer_updated(nbytes)
+    else:
+        for offset in range(0, len(stream), chunk_size):
+            handler.feed(stream[offset:offset + chunk_size])
+    elapsed = time.time() - start
+    assert received[0] == expected_frames, (received[0], expected_frames)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--total', type=int, default=256 * 1024,
+                        help='number of bytes in the stream')
+    parser.add_argument('--payload', type=int, default=64,
+                        help='payload size of each frame')
+    parser.add_argument('--chunks', type=int, nargs='+',
+                        default=[1, 16, 256, 4096, 65536, 1024 * 1024],
+                        help='read sizes to feed the handler with')
+    parser.add_argument('--readinto', action='store_true',
+                        help='read into the buffer of the handler')
+    parser.add_argument('--field-by-field', action='store_true',
+                        help='also parse each frame one field at a time')
+    args = parser.parse_args()
+
+    stream, nframes = build_stream(args.total, args.payload)
+    print("%d bytes, %d frames" % (len(stream), nframes))
+    handlers = [('whole-frame', StreamProtocolHandler)]
+    if args.field_by_field:
+        handlers.append(('field-by-field', FieldByFieldHandler))
+    print("%10s %16s %12s %12s" % ("chunk", "parser", "MB/s", "frames/s"))
+    for chunk_size in args.chunks:
+        for label, handler_class in handlers:
+            elapsed = run(stream, nframes, chunk_size, args.readinto, handler_class)
+            print("%10d %16s %12.2f %12.0f" % (chunk_size, label,
+                                               len(stream) / elapsed / 1e6,
+                                               nframes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
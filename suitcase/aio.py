@@ -0,0 +1,304 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""asyncio front-ends for the stream protocol handler
+
+This module requires Python 3.7 or newer.  It offers two ways of receiving
+messages from an asyncio stream.
+
+A protocol for use with ``loop.create_connection()`` or
+``loop.create_server()``.  :class:`BufferedFrameProtocol` receives data
+directly into a buffer it provides to the transport while
+:class:`FrameProtocol` is a plain :class:`asyncio.Protocol`.  Received
+messages are iterated over with ``async for``::
+
+    transport, protocol = await loop.create_connection(
+        lambda: BufferedFrameProtocol(MySchema), host, port)
+    async for message in protocol:
+        handle(message)
+
+An async iterator over an existing :class:`asyncio.StreamReader`::
+
+    reader, writer = await asyncio.open_connection(host, port)
+    async for message in frames(reader, MySchema):
+        handle(message)
+
+Both apply backpressure.  The protocols pause reading from the transport
+while ``max_queue`` or more parsed messages are waiting to be consumed.
+:func:`frames` only reads from the stream once all messages parsed from
+the previous read have been consumed, leaving it to the StreamReader to
+pause the transport.
+
+For datagram endpoints (``loop.create_datagram_endpoint()``), a
+:class:`DatagramFrameProtocol` iterates over ``(message, address)`` pairs,
+unpacking each datagram as one message.
+
+For sending, a :class:`TransportFrameWriter` coalesces the frames written
+during one iteration of the event loop into a single write to the
+transport::
+
+    writer = TransportFrameWriter(transport)
+    for reading in readings:
+        writer.write(reading)
+
+"""
+import asyncio
+import collections
+
+from suitcase.protocol import DatagramProtocolHandler, FrameWriter, \
+    StreamProtocolHandler
+
+
+class FrameProtocol(asyncio.Protocol):
+    """An :class:`asyncio.Protocol` parsing messages of ``message_schema``
+
+    The protocol is an async iterator over the parsed messages.  Iteration
+    ends when the connection is closed, raising the exception the
+    connection was lost with, if any.
+
+    :param message_schema: The schema of the messages on the stream.
+    :param max_queue: The number of parsed messages which may be waiting
+        to be consumed before reading from the transport is paused.
+
+    """
+
+    def __init__(self, message_schema, max_queue=64):
+        self.message_schema = message_schema
+        self.max_queue = max_queue
+        self.transport = None
+        self._handler = StreamProtocolHandler(message_schema, self._frame_received)
+        self._frames = collections.deque()
+        self._waiter = None
+        self._paused = False
+        self._closed = False
+        self._exception = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._handler.feed(data)
+
+    def eof_received(self):
+        return False  # close the transport
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._exception = exc
+        self._wakeup()
+
+    def _frame_received(self, message):
+        self._frames.append(message)
+        if len(self._frames) >= self.max_queue and not self._paused:
+            self._paused = True
+            self.transport.pause_reading()
+        self._wakeup()
+
+    def _wakeup(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._frames:
+            if self._closed:
+                if self._exception is not None:
+                    raise self._exception
+                raise StopAsyncIteration
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        message = self._frames.popleft()
+        if self._paused and len(self._frames) < self.max_queue and not self._closed:
+            self._paused = False
+            self.transport.resume_reading()
+        return message
+
+
+class BufferedFrameProtocol(FrameProtocol, asyncio.BufferedProtocol):
+    """A :class:`FrameProtocol` the transport receives data into directly
+
+    The transport reads straight into the buffer of the stream protocol
+    handler (see :meth:`StreamProtocolHandler.get_buffer`), avoiding an
+    allocation and a copy for each read.
+
+    :param read_size: The minimum size of the buffer provided to the
+        transport for each read.
+
+    """
+
+    def __init__(self, message_schema, max_queue=64, read_size=65536):
+        FrameProtocol.__init__(self, message_schema, max_queue)
+        self.read_size = read_size
+
+    def get_buffer(self, sizehint):
+        return self._handler.get_buffer(max(sizehint, self.read_size))
+
+    def buffer_updated(self, nbytes):
+        self._handler.buffer_updated(nbytes)
+
+
+class FrameIterator(object):
+    """Async iterator over the messages read from a StreamReader
+
+    See :func:`frames`.
+
+    """
+
+    def __init__(self, reader, message_schema, read_size=65536):
+        self.reader = reader
+        self.read_size = read_size
+        self._frames = collections.deque()
+        self._handler = StreamProtocolHandler(message_schema, self._frames.append)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._frames:
+            data = await self.reader.read(self.read_size)
+            if not data:
+                raise StopAsyncIteration
+            self._handler.feed(data)
+        return self._frames.popleft()
+
+
+def frames(reader, message_schema, read_size=65536):
+    """Iterate asynchronously over the messages read from ``reader``
+
+    :param reader: An :class:`asyncio.StreamReader`.
+    :param message_schema: The schema of the messages on the stream.
+    :param read_size: The maximum number of bytes to read at a time.
+
+    """
+    return FrameIterator(reader, message_schema, read_size)
+
+
+class DatagramFrameProtocol(asyncio.DatagramProtocol):
+    """An :class:`asyncio.DatagramProtocol` unpacking one message per datagram
+
+    The protocol is an async iterator over ``(message, address)`` pairs.
+    Datagrams which cannot be unpacked are counted in the ``errors`` of
+    its :class:`~suitcase.protocol.DatagramProtocolHandler` (``handler``).
+    As datagram transports cannot be paused, messages received while
+    ``max_queue`` messages are waiting to be consumed are dropped and
+    counted in ``frames_dropped``.
+
+    :param message_schema: The schema of the messages in the datagrams.
+    :param max_queue: The number of messages which may be waiting to be
+        consumed.
+
+    """
+
+    def __init__(self, message_schema, max_queue=1024):
+        self.message_schema = message_schema
+        self.max_queue = max_queue
+        self.transport = None
+        self.handler = DatagramProtocolHandler(message_schema, self._frame_received,
+                                               batch_size=0)
+        self.frames_dropped = 0
+        self._frames = collections.deque()
+        self._waiter = None
+        self._closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.handler.feed(data, addr)
+
+    def error_received(self, exc):
+        pass  # e.g. ICMP port unreachable; datagrams are unreliable anyway
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._wakeup()
+
+    def _frame_received(self, message, address):
+        if len(self._frames) >= self.max_queue:
+            self.frames_dropped += 1
+            return
+        self._frames.append((message, address))
+        self._wakeup()
+
+    def _wakeup(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._frames:
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self._frames.popleft()
+
+
+class TransportFrameWriter(FrameWriter):
+    """A :class:`~suitcase.protocol.FrameWriter` for an asyncio transport
+
+    Buffered frames are written to the transport once ``flush_size``
+    bytes are buffered or when :meth:`flush` is called.  Otherwise they
+    are written once the oldest has waited ``flush_interval`` seconds or,
+    by default, at the end of the current iteration of the event loop,
+    which coalesces the frames written by callbacks and tasks running in
+    the same iteration.
+
+    :param transport: The :class:`asyncio.Transport` to write to.
+
+    The remaining parameters are those of FrameWriter.
+
+    """
+
+    def __init__(self, transport, flush_size=65536, flush_interval=None):
+        FrameWriter.__init__(self, self._write_to_transport, flush_size, flush_interval)
+        self.transport = transport
+        self._handle = None
+
+    def _write_to_transport(self, data):
+        # the transport may keep hold of the data, but the buffer is reused
+        self.transport.write(bytes(data))
+
+    def write(self, frame):
+        FrameWriter.write(self, frame)
+        self._schedule()
+
+    def close(self):
+        """Write out the buffered frames and stop any pending flush"""
+        self.flush()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        if self._handle is not None or not self.bytes_buffered:
+            return
+        loop = asyncio.get_event_loop()
+        if self.flush_interval is None:
+            self._handle = loop.call_soon(self._scheduled_flush)
+        else:
+            self._handle = loop.call_later(self.poll() or 0, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._handle = None
+        if self.flush_interval is None:
+            self.flush()
+        else:
+            self.poll()
+        self._schedule()
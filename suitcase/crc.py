@@ -88,10 +88,22 @@ CRC16_KERMIT_TAB = \
     ]
 
 
+if six.PY2:
+    def _iterbytes(data):
+        # iterating a str gives characters but a bytearray gives integers
+        # on Python 2; a bytearray is made of any other buffer (e.g. slices
+        # of a protocol handler's buffer)
+        if isinstance(data, bytearray):
+            return data
+        return bytearray(data)
+else:
+    _iterbytes = iter
+
+
 def crc16_kermit(data, crc=0):
     """Calculate/Update the Kermit CRC16 checksum for some data"""
     tab = CRC16_KERMIT_TAB  # minor optimization (now in locals)
-    for byte in six.iterbytes(data):
+    for byte in _iterbytes(data):
         tbl_idx = (crc ^ byte) & 0xff
         crc = (tab[tbl_idx] ^ (crc >> 8)) & 0xffff
     return crc & 0xffff
@@ -109,10 +121,15 @@ def crc16_ccitt(data, crc=0):
 
     """
     tab = CRC16_CCITT_TAB  # minor optimization (now in locals)
-    for byte in six.iterbytes(data):
+    for byte in _iterbytes(data):
         crc = (((crc << 8) & 0xff00) ^ tab[((crc >> 8) & 0xff) ^ byte])
     return crc & 0xffff
 
 
 def crc32(data, crc=0):
     return binascii.crc32(data, crc) & 0xffffffff  # positive sign
+
+
+#: Algorithms for which ``algo(b, algo(a)) == algo(a + b)``.  A checksum
+#: using one of these can be computed incrementally as data arrives.
+RESUMABLE_ALGORITHMS = (crc16_kermit, crc16_ccitt, crc32)
@@ -0,0 +1,59 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+import asyncio
+import sys
+
+from suitcase.aio import BufferedFrameProtocol, frames
+from suitcase.examples.client_server import EchoProtocolFrame, \
+    FRAME_TYPE_ECHO_REQUEST, FRAME_TYPE_ECHO_RESPONSE
+
+
+class EchoServerProtocol(BufferedFrameProtocol):
+    def connection_made(self, transport):
+        BufferedFrameProtocol.connection_made(self, transport)
+        asyncio.ensure_future(self.serve())
+
+    async def serve(self):
+        async for request_frame in self:
+            print("Received %r" % request_frame)
+            if request_frame.frame_type == FRAME_TYPE_ECHO_REQUEST:
+                response = EchoProtocolFrame()
+                response.frame_type = FRAME_TYPE_ECHO_RESPONSE
+                response.payload = b"You sent %r" % request_frame.payload
+                self.transport.write(response.pack())
+            else:
+                print("Unexpected frame: %r" % request_frame)
+
+
+async def server():
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        lambda: EchoServerProtocol(EchoProtocolFrame), '0.0.0.0', 7070)
+    async with server:
+        await server.serve_forever()
+
+
+async def client():
+    reader, writer = await asyncio.open_connection('127.0.0.1', 7070)
+    responses = frames(reader, EchoProtocolFrame)
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, input, "Data to send: ")
+        request = EchoProtocolFrame()
+        request.frame_type = FRAME_TYPE_ECHO_REQUEST
+        request.payload = data.encode()
+        writer.write(request.pack())
+        print(await responses.__anext__())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage Client: %s -c" % sys.argv[0])
+        print("Usage Server: %s -s" % sys.argv[0])
+    elif sys.argv[1] == '-c':
+        asyncio.run(client())
+    elif sys.argv[1] == '-s':
+        asyncio.run(server())
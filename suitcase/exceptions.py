@@ -34,6 +34,10 @@ class SuitcaseParseError(SuitcaseException):
     """Raised when there is a problem parsing bytes into a suitcase schema"""
 
 
+class SuitcaseBufferOverflowError(SuitcaseException):
+    """Raised when a stream exceeds the buffering limits of its handler"""
+
+
 class SuitcasePackException(SuitcaseException):
     """Raised when there is an error packing a message"""
 
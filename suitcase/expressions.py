@@ -0,0 +1,280 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""Declarative expressions over the fields of a message
+
+Some fields need to compute something from other fields in the same message:
+a :class:`~suitcase.fields.ConditionalField` needs a condition and a
+:class:`~suitcase.fields.LengthField` may need to derive a length.  These
+may be given as plain Python callables, but they may also be written as
+expressions built directly from the fields in the schema declaration::
+
+    class IPV4Header(Structure):
+        hdr = BitField(8, version=BitNum(4), ihl=BitNum(4))
+        flags = BitField(8, has_ext=BitBool(), reserved=BitNum(7))
+        ext = ConditionalField(UBInt16(), flags.has_ext == 1)
+        options_length = LengthField(hdr.ihl * 4 - 20)
+        options = Payload(options_length)
+
+Unlike a lambda, an expression can be inspected.  The fields it references
+are known (see :meth:`Expression.references`), a length expression that is
+linear in a single field can be inverted when packing (see
+:meth:`Expression.solve`), and the expression can be evaluated against
+values from any source via :meth:`Expression.evaluate_with`, for instance
+against whole columns of values at a time.
+
+Supported operators are the arithmetic operators (``+``, ``-``, ``*``,
+``//``, ``/``, ``%``, unary ``-``), the bitwise operators (``&``, ``|``,
+``^``, ``<<``, ``>>``) and the comparison operators.  ``/`` is true
+division, even on Python 2 without ``from __future__ import division``;
+use ``//`` for integer results.  As comparisons evaluate to booleans, ``&``
+and ``|`` can be used to combine them::
+
+    (flags.has_ext == 1) & (hdr.version == 4)
+
+"""
+import operator
+
+from suitcase.exceptions import SuitcaseProgrammingError
+
+
+def as_expression(value):
+    """Convert a field placeholder or constant to an :class:`Expression`"""
+    # look on the type; placeholders turn any attribute access into an accessor
+    convert = getattr(type(value), '_as_expression', None)
+    if convert is not None:
+        return convert(value)
+    return Constant(value)
+
+
+def _lookup_field(message, placeholder):
+    """Find the field within ``message`` created for ``placeholder``"""
+    if hasattr(placeholder.cls, 'access'):  # FieldAccessor (e.g. bits.flag)
+        return placeholder.cls.access(message, placeholder)
+    return message.lookup_field_by_placeholder(placeholder)
+
+
+def _binary(op, symbol):
+    def _operator(self, other):
+        return BinaryOperation(op, symbol, self, other)
+
+    def _reflected(self, other):
+        return BinaryOperation(op, symbol, other, self)
+
+    return _operator, _reflected
+
+
+def _comparison(op, symbol):
+    def _operator(self, other):
+        return Comparison(op, symbol, self, other)
+
+    return _operator
+
+
+class ExpressionOperators(object):
+    """Mixin providing the operators used to build expressions
+
+    This is shared by :class:`Expression` and field placeholders so that
+    expressions can be written directly in terms of the fields declared
+    on a structure.  Only special methods are defined here as placeholders
+    use attribute access for other purposes.
+
+    """
+
+    # comparison operators are overloaded, but objects still hash by identity
+    __hash__ = object.__hash__
+
+    __add__, __radd__ = _binary(operator.add, '+')
+    __sub__, __rsub__ = _binary(operator.sub, '-')
+    __mul__, __rmul__ = _binary(operator.mul, '*')
+    __floordiv__, __rfloordiv__ = _binary(operator.floordiv, '//')
+    __truediv__, __rtruediv__ = _binary(operator.truediv, '/')
+    # Python 2 without ``from __future__ import division``
+    __div__, __rdiv__ = __truediv__, __rtruediv__
+    __mod__, __rmod__ = _binary(operator.mod, '%')
+    __and__, __rand__ = _binary(operator.and_, '&')
+    __or__, __ror__ = _binary(operator.or_, '|')
+    __xor__, __rxor__ = _binary(operator.xor, '^')
+    __lshift__, __rlshift__ = _binary(operator.lshift, '<<')
+    __rshift__, __rrshift__ = _binary(operator.rshift, '>>')
+
+    __eq__ = _comparison(operator.eq, '==')
+    __ne__ = _comparison(operator.ne, '!=')
+    __lt__ = _comparison(operator.lt, '<')
+    __le__ = _comparison(operator.le, '<=')
+    __gt__ = _comparison(operator.gt, '>')
+    __ge__ = _comparison(operator.ge, '>=')
+
+    def __neg__(self):
+        return BinaryOperation(operator.sub, '-', 0, self)
+
+
+class Expression(ExpressionOperators):
+    """Base class for all expressions
+
+    An expression is callable with a message, which makes it usable
+    anywhere a function taking the message is expected (for instance
+    as the ``condition`` of a ConditionalField).
+
+    """
+
+    def evaluate_with(self, resolve):
+        """Evaluate the expression, looking up field values with ``resolve``
+
+        :param resolve: A function taking a field placeholder and returning
+            the value to be used for that field.
+
+        """
+        raise NotImplementedError
+
+    def evaluate(self, message):
+        """Evaluate the expression against the fields of ``message``"""
+        return self.evaluate_with(
+            lambda placeholder: _lookup_field(message, placeholder).getval())
+
+    __call__ = evaluate
+
+    def _as_expression(self):
+        return self
+
+    def references(self):
+        """Return a list of the field placeholders used by this expression"""
+        return []
+
+    def solve(self, value):
+        """Find the field value for which this expression equals ``value``
+
+        This is only possible for expressions referencing a single field
+        through invertible operations (e.g. ``hdr.ihl * 4 - 20``).
+
+        :returns: A tuple of the referenced placeholder and its value.
+        :raises SuitcaseProgrammingError: If the expression cannot be
+            inverted or there is no integral solution.
+
+        """
+        raise SuitcaseProgrammingError("Expression %r cannot be inverted" % (self,))
+
+    def assign(self, message, value):
+        """Set the referenced field of ``message`` so the expression equals ``value``"""
+        placeholder, field_value = self.solve(value)
+        _lookup_field(message, placeholder).setval(field_value)
+
+
+class Constant(Expression):
+    """An expression with a fixed value"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def evaluate_with(self, resolve):
+        return self.value
+
+
+class FieldReference(Expression):
+    """An expression evaluating to the value of a field"""
+
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+
+    def __repr__(self):
+        if hasattr(self.placeholder.cls, 'access'):
+            field_placeholder, name = self.placeholder.args
+            return "%r.%s" % (FieldReference(field_placeholder), name)
+        return "<%s #%d>" % (self.placeholder.cls.__name__,
+                             self.placeholder._field_seqno)
+
+    def evaluate_with(self, resolve):
+        return resolve(self.placeholder)
+
+    def references(self):
+        return [self.placeholder]
+
+    def solve(self, value):
+        return self.placeholder, value
+
+
+class BinaryOperation(Expression):
+    """An expression applying an operator to two other expressions"""
+
+    def __init__(self, op, symbol, left, right):
+        self.op = op
+        self.symbol = symbol
+        self.left = as_expression(left)
+        self.right = as_expression(right)
+
+    def __repr__(self):
+        return "(%r %s %r)" % (self.left, self.symbol, self.right)
+
+    def evaluate_with(self, resolve):
+        return self.op(self.left.evaluate_with(resolve),
+                       self.right.evaluate_with(resolve))
+
+    def references(self):
+        refs = self.left.references()
+        refs.extend(r for r in self.right.references()
+                    if not any(r is seen for seen in refs))
+        return refs
+
+    def solve(self, value):
+        left_refs = self.left.references()
+        right_refs = self.right.references()
+        if left_refs and right_refs or not (left_refs or right_refs):
+            return Expression.solve(self, value)
+
+        # isolate the side referencing a field, the other side is constant
+        if left_refs:
+            inner, constant, inner_first = self.left, self.right, True
+        else:
+            inner, constant, inner_first = self.right, self.left, False
+        c = constant.evaluate_with(None)
+
+        if self.op is operator.add:
+            return inner.solve(value - c)
+        elif self.op is operator.sub:
+            return inner.solve(value + c if inner_first else c - value)
+        elif self.op is operator.mul and c != 0:
+            if value % c != 0:
+                raise SuitcaseProgrammingError(
+                    "No integral solution for %r == %r" % (self, value))
+            return inner.solve(value // c)
+        elif self.op is operator.lshift and inner_first:
+            if value & ((1 << c) - 1):
+                raise SuitcaseProgrammingError(
+                    "No integral solution for %r == %r" % (self, value))
+            return inner.solve(value >> c)
+        return Expression.solve(self, value)
+
+
+class Comparison(BinaryOperation):
+    """An expression comparing two other expressions
+
+    Because ``==`` and ``!=`` on field placeholders build expressions,
+    the truth value of these two comparisons falls back to comparing the
+    operands by identity.  That keeps placeholders usable in containers
+    and ``in`` tests.  Other comparisons cannot be used as a truth value.
+
+    """
+
+    def __init__(self, op, symbol, left, right):
+        BinaryOperation.__init__(self, op, symbol, left, right)
+        self._operands = (left, right)
+
+    def __bool__(self):
+        left, right = self._operands
+        if self.op is operator.eq:
+            return left is right
+        elif self.op is operator.ne:
+            return left is not right
+        raise TypeError("The truth value of expression %r is not known until "
+                        "it is evaluated against a message" % (self,))
+
+    __nonzero__ = __bool__
+
+    def solve(self, value):
+        return Expression.solve(self, value)
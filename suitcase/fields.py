@@ -6,12 +6,14 @@
 import struct
 
 import six
+from suitcase.crc import RESUMABLE_ALGORITHMS
 from suitcase.exceptions import SuitcaseChecksumException, SuitcaseProgrammingError, \
     SuitcaseParseError, SuitcaseException, SuitcasePackStructException
+from suitcase.expressions import Expression, ExpressionOperators, FieldReference
 from six import BytesIO, StringIO
 
 
-class FieldPlaceholder(object):
+class FieldPlaceholder(ExpressionOperators):
     """Internally used object that holds information about a field schema
 
     A FieldPlaceholder is what is actually instantiated and stored with
@@ -19,6 +21,9 @@ class FieldPlaceholder(object):
     placeholder stores all instantiation information needed to create
     the fields when the message object is instantiated
 
+    Operators on a placeholder build :mod:`suitcase.expressions`
+    referencing the field (e.g. ``flags.has_ext == 1``).
+
     """
 
     # record the number of instantiations of fields.  This is how
@@ -41,6 +46,9 @@ class FieldPlaceholder(object):
         instance._field_seqno = self._field_seqno
         return instance
 
+    def _as_expression(self):
+        return FieldReference(self)
+
     def __getattr__(self, name):
         # In case the same field is being referenced more than once.
         if name in self.__accessors:
@@ -176,8 +184,6 @@ class CRCField(BaseField):
 
     def validate(self, data, offset):
         """Raises :class:`SuitcaseChecksumException` if not valid"""
-        recorded_checksum = self.field.getval()
-
         # convert negative offset to positive
         if offset < 0:
             offset += len(data)
@@ -186,7 +192,17 @@ class CRCField(BaseField):
         data = b''.join((data[:offset],
                          b"\x00" * self.bytes_required,
                          data[offset + self.bytes_required:]))
-        actual_checksum = self.algo(data[self.start:self.end])
+        self.check(self.algo(data[self.start:self.end]), data)
+
+    def check(self, actual_checksum, data=None):
+        """Raises :class:`SuitcaseChecksumException` if ``actual_checksum``
+        does not match the recorded checksum
+
+        This is for use when the checksum of the data has been calculated
+        separately (for instance incrementally, as the data arrived).
+
+        """
+        recorded_checksum = self.field.getval()
         if recorded_checksum != actual_checksum:
             raise SuitcaseChecksumException(
                 "recorded checksum %r did not match actual %r.  full data: %r",
@@ -194,11 +210,38 @@ class CRCField(BaseField):
 
     def packed_checksum(self, data):
         """Given the data of the entire packet return the checksum bytes"""
-        self.field.setval(self.algo(data[self.start:self.end]))
+        return self.pack_checksum(self.algo(data[self.start:self.end]))
+
+    def pack_checksum(self, checksum):
+        """Record ``checksum`` as the value of the field and return its bytes"""
+        self.field.setval(checksum)
         sio = BytesIO()
         self.field.pack(sio)
         return sio.getvalue()
 
+    def checksum_parts(self, parts):
+        """Given the entire packet as a list of buffers return the checksum
+
+        The buffers are not joined if the algorithm is one of the
+        :data:`~suitcase.crc.RESUMABLE_ALGORITHMS`.
+
+        """
+        start, end, _step = slice(self.start, self.end).indices(
+            sum(len(part) for part in parts))
+        pieces = []
+        offset = 0
+        for part in parts:
+            size = len(part)
+            if offset < end and start < offset + size:
+                pieces.append(memoryview(part)[max(start - offset, 0):end - offset])
+            offset += size
+        if self.algo not in RESUMABLE_ALGORITHMS:
+            return self.algo(b''.join(piece.tobytes() for piece in pieces))
+        crc = 0
+        for piece in pieces:
+            crc = self.algo(piece, crc)
+        return crc
+
     def getval(self):
         return self.field.getval()
 
@@ -444,7 +487,7 @@ class DispatchTarget(BaseField):
         # OK, things check out.  Set both the value here and the
         # type byte value
         self._value = value
-        value._parent = self._parent
+        value.bind_parent(self._parent)
         self.dispatch_field.setval(key)
 
     def pack(self, stream):
@@ -462,6 +505,37 @@ class DispatchTarget(BaseField):
         return self._value.unpack(data, trailing=not self.is_greedy).read()
 
 
+class _ExpressionValue(object):
+    """Stands in for the field wrapped by a LengthField given an expression"""
+
+    bytes_required = 0
+
+    def __init__(self, expression, parent):
+        self.expression = expression
+        self.parent = parent
+
+    def __repr__(self):
+        try:
+            return repr(self.getval())
+        except TypeError:  # referenced fields not yet populated
+            return repr(None)
+
+    def is_substructure(self):
+        return False
+
+    def getval(self):
+        return self.expression.evaluate(self.parent)
+
+    def setval(self, value):
+        self.expression.assign(self.parent, value)
+
+    def pack(self, stream):
+        pass
+
+    def unpack(self, data, **kwargs):
+        return data
+
+
 class LengthField(BaseField):
     """Wraps an existing field marking it as a LengthField
 
@@ -471,7 +545,18 @@ class LengthField(BaseField):
 
     :param length_field: The field providing the actual length value to
         be used.  This field should return an integer value representing
-        the length (or a multiple of the length) as a return value
+        the length (or a multiple of the length) as a return value.  This
+        may instead be an expression over fields declared earlier in the
+        message (see :mod:`suitcase.expressions`), in which case the
+        LengthField takes up no bytes itself.  When packing, the field
+        referenced by the expression is updated so that the expression
+        evaluates to the length of the payload::
+
+            class IPV4Options(Structure):
+                hdr = BitField(8, version=BitNum(4), ihl=BitNum(4))
+                options_length = LengthField(hdr.ihl * 4 - 20)
+                options = Payload(options_length)
+
     :param get_length: If specified, this is a function which takes a reference
         to the encapsulated field and is responsible for reading the length
         out from that field.  By default, this just reads the value of the
@@ -490,9 +575,14 @@ class LengthField(BaseField):
     def __init__(self, length_field, get_length=None, set_length=None, multiplier=1, **kwargs):
         BaseField.__init__(self, **kwargs)
         self.multiplier = multiplier
+        if isinstance(length_field, Expression):
+            self.length_field = _ExpressionValue(length_field, self._parent)
+            default_set_length = self._derived_set_length
+        else:
+            self.length_field = length_field.create_instance(self._parent)
+            default_set_length = self._default_set_length
         self.get_length = self._default_get_length if get_length is None else get_length
-        self.set_length = self._default_set_length if set_length is None else set_length
-        self.length_field = length_field.create_instance(self._parent)
+        self.set_length = default_set_length if set_length is None else set_length
         self.length_value_provider = None
 
     def __repr__(self):
@@ -504,6 +594,14 @@ class LengthField(BaseField):
     def _default_set_length(self, field, length):
         field._value = length  # TODO: use setval() [problem with DependentField tests]?
 
+    def _derived_set_length(self, field, length):
+        field.setval(length)
+
+    @property
+    def is_derived(self):
+        """True if the length is derived from other fields by an expression"""
+        return isinstance(self.length_field, _ExpressionValue)
+
     def is_substructure(self):
         return self.length_field.is_substructure()
 
@@ -529,10 +627,17 @@ class LengthField(BaseField):
 
         self.length_value_provider = _length_value_provider
 
-    def pack(self, stream):
+    def update_length(self):
+        """Store the current length of the associated payload"""
         if self.length_value_provider is None:
             raise SuitcaseException("No length_provider added to this LengthField")
         self.set_length(self.length_field, self.length_value_provider())
+
+    def pack(self, stream):
+        # derived lengths are updated by the packer before any field
+        # is packed as the fields they update appear earlier
+        if not self.is_derived:
+            self.update_length()
         self.length_field.pack(stream)
 
     def unpack(self, data, **kwargs):
@@ -644,6 +749,13 @@ class ConditionalField(BaseField):
     allows us to define a function to examine that state and only have the
     field capture the bytes if the conditions are right.
 
+    During a pack or unpack of the parent message, the result of the
+    condition is remembered once it has been evaluated (until a field it
+    depends on is assigned to), so the condition is typically evaluated
+    only once per pass.  Outside of a pass it is evaluated on each access,
+    so changes made in place (for instance to a nested message or a list)
+    are always seen.
+
     :param field: The field which should handle the parsing if the condition
         evaluates to true.
 
@@ -651,41 +763,99 @@ class ConditionalField(BaseField):
         message that is expected to return a boolean value.  If the value
         is true, then ``field`` will handle the bytes.  If not, then the
         field will be skipped and left with its default value (None).
+        The condition may also be an expression over other fields of the
+        message (see :mod:`suitcase.expressions`)::
+
+            class Optional(Structure):
+                flags = BitField(8, has_ext=BitBool(), reserved=BitNum(7))
+                ext = ConditionalField(UBInt16(), flags.has_ext == 1)
+
+    :param depends_on: If specified, this is a list of the fields (from the
+        same message) that the condition examines.  The result remembered
+        during a pass is then only thrown away when one of these fields
+        is set rather than when any field in the message is set.  For a
+        condition given as an expression, this defaults to the fields it
+        references.
 
     """
 
-    def __init__(self, field, condition, **kwargs):
+    def __init__(self, field, condition, depends_on=None, **kwargs):
         BaseField.__init__(self, **kwargs)
         self.field = field.create_instance(self._parent)
         self.condition = condition
+        if depends_on is None and isinstance(condition, Expression):
+            depends_on = condition.references()
+        if depends_on is None:
+            self.depends_on = None
+        else:
+            self.depends_on = []
+            for placeholder in depends_on:
+                dependency = self._ph2f(placeholder)
+                if isinstance(dependency, FieldAccessor):
+                    # attribute assignments are seen on the wrapped field
+                    dependency = dependency._field
+                self.depends_on.append(dependency)
+        self._included = None
+        self._passes = 0
 
     def __repr__(self):
-        if self.condition(self._parent):
+        if self.is_included():
             return repr(self.field)
         else:
             return "<ConditionalField: not included>"
 
+    def is_included(self):
+        """Return True if the condition currently holds for the parent"""
+        if not self._passes:
+            return bool(self.condition(self._parent))
+        included = self._included
+        if included is None:
+            included = self._included = bool(self.condition(self._parent))
+        return included
+
+    def begin_pass(self):
+        """Remember the result of the condition until :meth:`end_pass`"""
+        self._passes += 1
+        self._included = None
+
+    def end_pass(self):
+        """Stop remembering the result of the condition"""
+        self._passes -= 1
+        self._included = None
+
+    def invalidate(self, changed_field=None):
+        """Forget the remembered result of the condition
+
+        :param changed_field: The field that has changed.  If the field is
+            not one this condition depends on, the result is kept.  If None,
+            the result is always discarded.
+
+        """
+        if (changed_field is None or self.depends_on is None or
+                any(changed_field is f for f in self.depends_on)):
+            self._included = None
+
     def is_substructure(self):
         return self.field.is_substructure()
 
     @property
     def bytes_required(self):
-        if self.condition(self._parent):
+        if self.is_included():
             return self.field.bytes_required
         else:
             return 0
 
     def pack(self, stream):
-        if self.condition(self._parent):
+        if self.is_included():
             self.field.pack(stream)
 
     def unpack(self, data, **kwargs):
-        if self.condition(self._parent):
+        if self.is_included():
             return self.field.unpack(data, **kwargs)
         return data
 
     def getval(self):
-        if not self.condition(self._parent):
+        if not self.is_included():
             return None
 
         return self.field.getval()
@@ -732,7 +902,11 @@ class Payload(BaseField):
             return self.length_provider.get_adjusted_length()
 
     def pack(self, stream):
-        stream.write(self._value)
+        if six.PY2 and isinstance(self._value, memoryview):
+            # str() of a memoryview is its repr on Python 2
+            stream.write(self._value.tobytes())
+        else:
+            stream.write(self._value)
 
     def unpack(self, data, **kwargs):
         self._value = data
@@ -744,6 +918,33 @@ class Payload(BaseField):
 VariableRawPayload = Payload
 
 
+class StreamedPayload(Payload):
+    """Payload which may be received in pieces rather than held in memory
+
+    This behaves as a :class:`Payload` with a length provider, except when
+    a :class:`~suitcase.protocol.StreamProtocolHandler` is given a
+    ``payload_sink``.  The handler then passes the contents of the field
+    to the sink as they arrive instead of buffering the whole frame, and
+    the field of the message delivered has no value.  This keeps the
+    memory used to receive large payloads (e.g. firmware images) constant::
+
+        class FirmwareChunk(Structure):
+            magic = Magic(b'\xF0\x0D')
+            length = LengthField(UBInt32())
+            image = StreamedPayload(length)
+            crc = CRCField(UBInt32(), crc32, 2, -4)
+
+    :param length_provider: The LengthField with which this payload is
+        associated.  Unlike for Payload this is required.
+
+    """
+
+    def __init__(self, length_provider, **kwargs):
+        if not isinstance(length_provider, FieldPlaceholder):
+            raise SuitcaseProgrammingError("A StreamedPayload requires a length provider")
+        Payload.__init__(self, length_provider, **kwargs)
+
+
 class BaseVariableByteSequence(BaseField):
     def __init__(self, make_format, length_provider, **kwargs):
         BaseField.__init__(self, **kwargs)
@@ -797,6 +998,10 @@ class DependentField(BaseField):
                 0x00: MyDependentMessage,
             })
 
+    The field in the parent message is looked up when the message is
+    attached to its parent (e.g. by a DispatchTarget) or, failing that,
+    the first time the DependentField is used.
+
     :param name: The name of the field from the parent message that we
         would like brought into our message namespace.
 
@@ -807,6 +1012,17 @@ class DependentField(BaseField):
         self.bytes_required = 0
         self.parent_field_name = name
         self.parent_field = None
+        if self._parent is not None:
+            self._parent._dependent_fields.append(self)
+
+    def bind(self, message_parent):
+        """Resolve the parent field against ``message_parent`` (if present)"""
+        try:
+            self.parent_field = message_parent.lookup_field_by_name(
+                self.parent_field_name)
+        except (AttributeError, KeyError):
+            # not (yet) resolvable; fall back to resolving on first use
+            self.parent_field = None
 
     def _get_parent_field(self):
         if self.parent_field is None:
@@ -817,7 +1033,17 @@ class DependentField(BaseField):
         return self.parent_field
 
     def __getattr__(self, attr):
-        return getattr(self._get_parent_field(), attr)
+        # Only reached for attributes the DependentField does not define;
+        # the methods used to pack and unpack are all defined here.  Special
+        # names (e.g. those looked up by copy and pickle) are not forwarded.
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        parent_field = self.__dict__.get('parent_field')
+        if parent_field is None:
+            if '_parent' not in self.__dict__:
+                raise AttributeError(attr)  # not initialized (yet)
+            parent_field = self._get_parent_field()
+        return getattr(parent_field, attr)
 
     def pack(self, stream):
         pass
@@ -872,7 +1098,7 @@ class SubstructureField(BaseField):
         BaseField.__init__(self, **kwargs)
         self.substructure = substructure
         self._value = substructure()
-        self._value._parent = self._parent
+        self._value.bind_parent(self._parent)
 
     def is_substructure(self):
         return True
@@ -887,7 +1113,7 @@ class SubstructureField(BaseField):
 
     def unpack(self, data, **kwargs):
         self._value = self.substructure()
-        self._value._parent = self._parent
+        self._value.bind_parent(self._parent)
         return self._value.unpack(data, **kwargs).read()
 
 
@@ -967,7 +1193,7 @@ class FieldArray(BaseField):
         kwargs['trailing'] = True
         while True:
             structure = self.substructure()
-            structure._parent = self._parent
+            structure.bind_parent(self._parent)
             data = structure.unpack(data, **kwargs).read()
             self._value.append(structure)
             if data == b"":
@@ -1463,6 +1689,8 @@ class BitField(BaseField):
     def __setattr__(self, key, value):
         if key in self.__dict__.get('_bitfield_map', {}):
             self._bitfield_map[key].viewset(value)
+            if self._parent is not None:
+                self._parent.invalidate_conditions(self)
         else:
             self.__dict__[key] = value
 
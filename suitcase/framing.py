@@ -0,0 +1,377 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""Byte stuffing and delimited framing for serial protocols
+
+Many serial protocols delimit or escape the messages they carry before
+they are sent.  This module provides that framing layer so that it can be
+combined with Suitcase schemas.  Escaping and unescaping is done with
+``bytes.replace``, ``bytes.split`` and friends rather than byte-by-byte
+loops in Python.
+
+For protocols where each message is delimited (SLIP, HDLC-like framing
+and COBS), a :class:`Deframer` splits the stream into frames::
+
+    framing = SLIPFraming()
+    sock.sendall(framing.pack(message))
+
+    deframer = Deframer(framing, message_received, message_schema=MySchema)
+    while True:
+        deframer.feed(sock.recv(1024))
+
+For protocols which escape the bytes of a stream without delimiting the
+messages, such as XBee API mode 2, an :class:`UnescapingStream` removes
+the escaping before the bytes reach a
+:class:`~suitcase.protocol.StreamProtocolHandler`::
+
+    handler = StreamProtocolHandler(XBeeFrame, frame_received)
+    stream = UnescapingStream(XBEE_ESCAPING, handler.feed)
+    while True:
+        stream.feed(serial_port.read(1024))
+
+"""
+import six
+
+from suitcase.exceptions import SuitcaseParseError
+
+
+class ByteStuffing(object):
+    """Escaping of reserved bytes by an escape byte
+
+    Each reserved byte is replaced by the escape byte followed by a
+    substitute byte.  The escape byte is always one of the reserved bytes.
+
+    :param escape: The escape byte (e.g. ``b'\\x7d'``).
+    :param substitutes: A dictionary mapping each reserved byte to the
+        byte which follows the escape byte in its place.
+
+    """
+
+    def __init__(self, escape, substitutes):
+        if escape not in substitutes:
+            raise ValueError("The escape byte must be one of the reserved bytes")
+        self.escape_byte = escape
+        self.substitutes = substitutes
+        self._pairs = [(byte, escape + substitute)
+                       for byte, substitute in substitutes.items()]
+        # the escape byte must be escaped first and unescaped last
+        self._pairs.sort(key=lambda pair: pair[0] != escape)
+
+    @classmethod
+    def with_mask(cls, escape, reserved, mask=0x20):
+        """Escaping where the substitute of a reserved byte is ``byte ^ mask``"""
+        return cls(escape, dict(
+            (six.int2byte(byte), six.int2byte(byte ^ mask))
+            for byte in six.iterbytes(escape + reserved)))
+
+    def escape(self, data):
+        """Escape the reserved bytes in ``data``"""
+        for byte, escaped in self._pairs:
+            data = data.replace(byte, escaped)
+        return data
+
+    def unescape(self, data):
+        """Remove the escaping from ``data``
+
+        :raises SuitcaseParseError: If the escape byte is followed by a byte
+            which is not the substitute of a reserved byte.
+
+        """
+        data = bytes(data)
+        escape_count = data.count(self.escape_byte)
+        if not escape_count:
+            return data
+        pair_count = 0
+        for byte, escaped in reversed(self._pairs):
+            count = data.count(escaped)
+            if count:
+                pair_count += count
+                data = data.replace(escaped, byte)
+        if pair_count != escape_count:
+            raise SuitcaseParseError("Invalid escape sequence in %r" % (data,))
+        return data
+
+
+#: Escaping used by HDLC-like framing (e.g. PPP)
+HDLC_ESCAPING = ByteStuffing.with_mask(b'\x7d', b'\x7e')
+
+#: Escaping used by XBee modules in API mode 2
+XBEE_ESCAPING = ByteStuffing.with_mask(b'\x7d', b'\x7e\x11\x13')
+
+
+def cobs_encode(data):
+    """Encode ``data`` using Consistent Overhead Byte Stuffing
+
+    The result contains no zero bytes.  The trailing zero delimiter is
+    not included.
+
+    """
+    out = []
+    blocks = data.split(b'\x00')
+    last = len(blocks) - 1
+    for i, block in enumerate(blocks):
+        whole = len(block) - len(block) % 254
+        for start in range(0, whole, 254):
+            out.append(b'\xff')
+            out.append(block[start:start + 254])
+        rest = block[whole:]
+        # a final block of 254 bytes needs no (empty) block after it
+        if rest or not block or i != last:
+            out.append(six.int2byte(len(rest) + 1))
+            out.append(rest)
+    return b''.join(out)
+
+
+def cobs_decode(data):
+    """Decode data encoded with :func:`cobs_encode`
+
+    :raises SuitcaseParseError: If ``data`` is not validly encoded.
+
+    """
+    data = bytes(data)
+    out = []
+    position = 0
+    length = len(data)
+    while position < length:
+        code = six.indexbytes(data, position)
+        end = position + code
+        if code == 0 or end > length:
+            raise SuitcaseParseError("Invalid COBS code %d at offset %d"
+                                     % (code, position))
+        block = data[position + 1:end]
+        if b'\x00' in block:
+            raise SuitcaseParseError("Zero byte in COBS data at offset %d"
+                                     % (position + 1 + block.index(b'\x00')))
+        out.append(block)
+        position = end
+        if code != 0xFF and position < length:
+            out.append(b'\x00')
+    return b''.join(out)
+
+
+class DelimitedFraming(object):
+    """Base for framings where each frame ends with a delimiter
+
+    Subclasses define the ``delimiter`` and how the contents of a frame
+    are encoded and decoded.
+
+    """
+
+    delimiter = None
+
+    def encode(self, data):
+        """Return the framed ``data``, including delimiters"""
+        raise NotImplementedError
+
+    def decode(self, frame):
+        """Return the contents of a frame (without its delimiters)"""
+        raise NotImplementedError
+
+    def pack(self, message):
+        """Pack a :class:`~suitcase.structure.Structure` and frame it"""
+        return self.encode(message.pack())
+
+
+class SLIPFraming(DelimitedFraming):
+    """Serial Line Internet Protocol framing (RFC 1055)
+
+    :param leading_end: If True, frames are also preceded by an END byte
+        to flush any line noise received before the frame.
+
+    """
+
+    END = b'\xc0'
+    ESC = b'\xdb'
+    ESC_END = b'\xdc'
+    ESC_ESC = b'\xdd'
+
+    delimiter = END
+
+    def __init__(self, leading_end=False):
+        self.leading_end = leading_end
+        self._stuffing = ByteStuffing(self.ESC, {self.END: self.ESC_END,
+                                                 self.ESC: self.ESC_ESC})
+
+    def encode(self, data):
+        escaped = self._stuffing.escape(data)
+        if self.leading_end:
+            return b''.join((self.END, escaped, self.END))
+        return escaped + self.END
+
+    def decode(self, frame):
+        return self._stuffing.unescape(frame)
+
+
+class HDLCFraming(DelimitedFraming):
+    """HDLC-like framing with flag bytes and byte stuffing (RFC 1662)
+
+    No address, control or frame check sequence fields are added; these
+    can be declared as part of the schema of the frame contents.
+
+    :param escaping: The :class:`ByteStuffing` to use.  This defaults to
+        :data:`HDLC_ESCAPING`.
+
+    """
+
+    FLAG = b'\x7e'
+
+    delimiter = FLAG
+
+    def __init__(self, escaping=HDLC_ESCAPING):
+        self.escaping = escaping
+
+    def encode(self, data):
+        return b''.join((self.FLAG, self.escaping.escape(data), self.FLAG))
+
+    def decode(self, frame):
+        return self.escaping.unescape(frame)
+
+
+class COBSFraming(DelimitedFraming):
+    """Consistent Overhead Byte Stuffing with a zero byte delimiter"""
+
+    delimiter = b'\x00'
+
+    def encode(self, data):
+        return cobs_encode(data) + self.delimiter
+
+    def decode(self, frame):
+        return cobs_decode(frame)
+
+
+class Deframer(object):
+    """Split a stream of bytes into frames of a :class:`DelimitedFraming`
+
+    Empty frames (for instance between consecutive delimiters) are
+    ignored.  Frames which cannot be decoded are dropped and counted in
+    ``errors``.
+
+    :param framing: The :class:`DelimitedFraming` of the stream.
+    :param frame_callback: A callback to be executed with the form
+        ``callback(frame)`` for each frame.
+    :param message_schema: If specified, each frame is unpacked as a
+        message of this schema before being passed to the callback.
+        Frames which do not match the schema are counted as errors.
+    :param max_frame_size: If specified, the maximum number of bytes of
+        a frame (before decoding).  Longer frames are dropped.
+
+    """
+
+    def __init__(self, framing, frame_callback, message_schema=None,
+                 max_frame_size=None):
+        self.framing = framing
+        self.frame_callback = frame_callback
+        self.message_schema = message_schema
+        self.max_frame_size = max_frame_size
+        self.frames_received = 0
+        self.errors = 0
+        # the pieces of the frame being received, only joined once the
+        # frame is complete so that small reads do not copy it again
+        self._pending = []
+        self._pending_size = 0
+        self._oversized = False
+
+    def feed(self, new_bytes):
+        """Feed bytes from the stream, executing callbacks for new frames"""
+        data = bytes(new_bytes)
+        delimiter = self.framing.delimiter
+        # only the new bytes are searched, along with any bytes already
+        # received which could be the start of a delimiter
+        tail = self._pending_tail(len(delimiter) - 1)
+        frames = (tail + data).split(delimiter)
+        if len(frames) == 1:
+            frames = []
+            self._add_pending(data)
+        else:
+            pending = b''.join(self._pending)
+            frames[0] = pending[:len(pending) - len(tail)] + frames[0]
+            self._pending = []
+            self._pending_size = 0
+            self._add_pending(frames.pop())
+
+        decoded = []
+        for frame in frames:
+            if self._oversized:
+                # the end of a frame which was too long
+                self._oversized = False
+                continue
+            if not frame:
+                continue
+            if self.max_frame_size is not None and len(frame) > self.max_frame_size:
+                self.errors += 1
+                continue
+            try:
+                data = self.framing.decode(frame)
+                if self.message_schema is not None:
+                    data = self.message_schema.from_data(data)
+            except Exception:
+                self.errors += 1
+                continue
+            decoded.append(data)
+
+        if self.max_frame_size is not None and self._pending_size > self.max_frame_size:
+            # drop the start of the frame and the rest of it when it arrives
+            tail = self._pending_tail(len(delimiter) - 1)
+            self._pending = [tail] if tail else []
+            self._pending_size = len(tail)
+            if not self._oversized:
+                self._oversized = True
+                self.errors += 1
+
+        # as for StreamProtocolHandler, callbacks are executed after parsing
+        self.frames_received += len(decoded)
+        for data in decoded:
+            self.frame_callback(data)
+
+    def reset(self):
+        """Discard any partially received frame"""
+        self._pending = []
+        self._pending_size = 0
+        self._oversized = False
+
+    def _add_pending(self, data):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+
+    def _pending_tail(self, size):
+        """The last ``size`` bytes received of the pending frame (or fewer)"""
+        if size <= 0:
+            return b''
+        pieces = []
+        for piece in reversed(self._pending):
+            pieces.append(piece[-size:])
+            size -= len(pieces[-1])
+            if size == 0:
+                break
+        return b''.join(reversed(pieces))
+
+
+class UnescapingStream(object):
+    """Remove byte stuffing from a stream before passing it on
+
+    :param escaping: The :class:`ByteStuffing` used by the stream.
+    :param feed: A function taking the unescaped bytes (for instance the
+        ``feed`` method of a StreamProtocolHandler).
+
+    """
+
+    def __init__(self, escaping, feed):
+        self.escaping = escaping
+        self.downstream_feed = feed
+        self._pending = b''
+
+    def feed(self, new_bytes):
+        """Unescape ``new_bytes`` and pass them on"""
+        data = self._pending + bytes(new_bytes)
+        # an escape byte is always the start of an escape sequence, so a
+        # trailing escape byte must wait for the byte which follows it
+        if data.endswith(self.escaping.escape_byte):
+            data, self._pending = data[:-1], data[-1:]
+        else:
+            self._pending = b''
+        if data:
+            self.downstream_feed(self.escaping.unescape(data))
@@ -0,0 +1,478 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""Read messages from capture files
+
+A capture file holds frames back to back, as received from a stream.
+:class:`MappedFrameReader` memory maps the file so that captures of any
+size can be parsed without reading them into memory::
+
+    with MappedFrameReader('capture.bin', MySchema) as reader:
+        for message in reader:
+            analyze(message)
+
+A :class:`FrameIndex` records where each frame is, along with a few key
+fields, in a sidecar file so frames can be found without a rescan::
+
+    index = FrameIndex.build('capture.bin', MySchema, keys=['timestamp'])
+    with MappedFrameReader('capture.bin', MySchema) as reader:
+        message = reader.read(index.offsets[3000000])
+        window = [reader.read(index.offsets[i])
+                  for i in index.key_range('timestamp', start, end)]
+
+:func:`decode_parallel` decodes a capture using several processes::
+
+    for sequence in decode_parallel('capture.bin', MySchema, get_sequence):
+        ...
+
+"""
+from __future__ import absolute_import
+
+import array
+import bisect
+import collections
+import itertools
+import mmap
+import os
+import sys
+
+from suitcase.exceptions import SuitcaseParseError, SuitcaseProgrammingError
+from suitcase.fields import Magic, UBInt8, LengthField, Payload
+from suitcase.structure import Structure
+from suitcase.protocol import StreamParser, _FrameLayout, _TerminatedLayout, \
+    _frame_layout, _leading_magic
+
+
+class MappedFrameReader(object):
+    """Iterate over the messages in a memory mapped capture file
+
+    Frames are unpacked straight from the mapping with
+    :meth:`~suitcase.structure.Structure.unpack_from`; only the pages of
+    the file being parsed need to be in memory.
+
+    If the schema starts with a :class:`~suitcase.fields.Magic` field,
+    reading synchronizes on it, so ``offset`` need not be the start of a
+    frame.  Frames which cannot be unpacked (for instance because of a
+    bad checksum) are then skipped by searching for the next Magic from
+    the byte after their start, and counted in ``errors``.
+
+    A frame extending past the end of the file ends the iteration (when
+    ``resync`` is False or ``growing`` is True) or is counted as an error
+    and skipped.
+
+    :param path: The path of the capture file.
+    :param message_schema: The schema of the frames in the file.
+    :param offset: The offset in the file to start reading from.
+    :param resync: If False, an exception is raised for a frame which
+        cannot be unpacked instead of resynchronizing.
+    :param growing: If True, the capture is taken to still be written to,
+        so a frame extending past the end of the file always ends the
+        iteration.  A new reader starting from ``offset`` can read it once
+        it is complete.
+
+    The reader counts the frames read (``frames_read``), the frames
+    skipped (``errors``) and the bytes skipped while synchronizing
+    (``bytes_skipped``).  ``offset`` is the offset of the next frame.
+
+    """
+
+    def __init__(self, path, message_schema, offset=0, resync=True, growing=False):
+        self.path = path
+        self.message_schema = message_schema
+        self.offset = offset
+        self.resync = resync
+        self.growing = growing
+
+        # counters
+        self.frames_read = 0
+        self.errors = 0
+        self.bytes_skipped = 0
+
+        self._layout = _frame_layout(message_schema)
+        self._magic = _leading_magic(message_schema)
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b''  # empty files cannot be mapped
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Unmap and close the file"""
+        if hasattr(self._map, 'close'):
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # unmapped once the views still referenced are freed
+        self._file.close()
+
+    def __len__(self):
+        """The size of the file"""
+        return len(self._map)
+
+    def __iter__(self):
+        for _offset, message in self.iter_with_offsets():
+            yield message
+
+    def iter_with_offsets(self):
+        """Iterate over ``(offset, message)`` pairs from the current offset"""
+        end = len(self._map)
+        while self.offset < end:
+            if self._magic is not None:
+                found = self._map.find(self._magic, self.offset)
+                if found == -1:
+                    found = end
+                self.bytes_skipped += found - self.offset
+                self.offset = found
+                if found == end:
+                    return
+
+            try:
+                message, size = self._read_frame(self.offset, end)
+            except Exception:
+                if not self.resync or self._magic is None:
+                    raise
+                self.errors += 1
+                self.bytes_skipped += 1
+                self.offset += 1
+                continue
+            if message is None:
+                if self.resync and self._magic is not None and not self.growing:
+                    self.errors += 1
+                    self.bytes_skipped += 1
+                    self.offset += 1
+                    continue
+                return  # truncated at the end of the capture
+
+            offset = self.offset
+            self.offset += size
+            self.frames_read += 1
+            yield offset, message
+
+    def read(self, offset):
+        """Unpack the frame starting at ``offset`` (for instance from a FrameIndex)"""
+        message, _size = self._read_frame(offset, len(self._map))
+        if message is None:
+            raise SuitcaseParseError("The frame at offset %d extends past the end "
+                                     "of the file" % offset)
+        return message
+
+    def _read_frame(self, offset, end):
+        """Unpack the frame at ``offset``
+
+        :returns: The message and the size of the frame, or ``(None, 0)``
+            if the frame extends past ``end``.
+
+        """
+        layout = self._layout
+        message = self.message_schema()
+        if isinstance(layout, _FrameLayout):
+            if offset + layout.header_size > end:
+                return None, 0
+            position = offset
+            fields = message._sorted_fields[:layout.header_count]
+            for (_name, field), size in zip(fields, layout.sizes):
+                field.unpack(self._map[position:position + size])
+                position += size
+            size = layout.frame_size(message)
+        elif isinstance(layout, _TerminatedLayout):
+            found = self._map.find(layout.terminator, offset + layout.header_size)
+            if found == -1:
+                return None, 0
+            size = found - offset + len(layout.terminator) + layout.trailer_size
+        else:
+            parser = StreamParser(self.message_schema)
+            message = parser.advance(self._map, offset, end)
+            return message, parser.bytes_consumed
+
+        if offset + size > end:
+            return None, 0
+        if size <= 0:
+            raise SuitcaseParseError("Invalid frame size %d at offset %d" % (size, offset))
+        message.unpack_from(self._map, offset, size)
+        return message, size
+
+
+class _IndexHeader(Structure):
+    magic = Magic(b'SCIX')
+    version = UBInt8()
+    keys_length = LengthField(UBInt8())
+    keys = Payload(keys_length)
+
+
+def _int64_typecode():
+    """The array typecode of 64-bit signed integers, or None if there is none
+
+    'q' is new in Python 3.3; on Python 2 'l' is 64 bits wide on most
+    platforms other than Windows.
+
+    """
+    for typecode in ('q', 'l'):
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:  # unknown typecode
+            pass
+    return None
+
+
+class FrameIndex(object):
+    """Offsets, sizes and key fields of the frames in a capture file
+
+    The index is kept as arrays: ``offsets`` and ``sizes`` hold the offset
+    and size of each frame in the capture, and ``key_values[name]`` the
+    value of each key field.  Key fields are top-level integer fields of
+    the schema (e.g. a DispatchField, a sequence number or a timestamp).
+
+    An index file holds a small header followed by one record of 64-bit
+    integers per frame, so frames can be appended to it as the capture
+    grows (see :meth:`update`).
+
+    The arrays need a 64-bit integer type, which Python 2 only has on
+    platforms where a C long is 64 bits wide (i.e. not on Windows).
+
+    :param keys: The names of the key fields.
+
+    """
+
+    VERSION = 1
+    _TYPECODE = _int64_typecode()
+
+    def __init__(self, keys=()):
+        if self._TYPECODE is None:
+            raise SuitcaseProgrammingError("FrameIndex requires an array type of 64-bit "
+                                           "integers, which this Python does not have")
+        self.keys = list(keys)
+        self.offsets = array.array(self._TYPECODE)
+        self.sizes = array.array(self._TYPECODE)
+        self.key_values = dict((name, array.array(self._TYPECODE)) for name in self.keys)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        """The ``(offset, size)`` of a frame followed by its key values"""
+        return ((self.offsets[index], self.sizes[index]) +
+                tuple(self.key_values[name][index] for name in self.keys))
+
+    @property
+    def end(self):
+        """The offset just past the last frame indexed"""
+        if not self.offsets:
+            return 0
+        return self.offsets[-1] + self.sizes[-1]
+
+    @staticmethod
+    def default_path(capture_path):
+        """The path of the index of ``capture_path`` (``capture_path + '.idx'``)"""
+        return capture_path + '.idx'
+
+    @classmethod
+    def build(cls, capture_path, message_schema, keys=(), index_path=None):
+        """Index a capture file, writing the index file
+
+        This is :meth:`update` for a new index.
+
+        """
+        index = cls(keys)
+        index_path = index_path or cls.default_path(capture_path)
+        with open(index_path, 'wb') as f:
+            f.write(_IndexHeader(version=cls.VERSION,
+                                 keys=','.join(index.keys).encode('ascii')).pack())
+        index.update(capture_path, message_schema, index_path)
+        return index
+
+    @classmethod
+    def load(cls, index_path):
+        """Read an index file"""
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        header = _IndexHeader()
+        body = header.unpack(data, trailing=True).read()
+        if header.version != cls.VERSION:
+            raise SuitcaseParseError("Unsupported index version %d" % header.version)
+        keys = header.keys.decode('ascii')
+        index = cls(keys.split(',') if keys else ())
+
+        stride = 2 + len(index.keys)
+        records = array.array(cls._TYPECODE)
+        record_size = stride * records.itemsize
+        # ignore a record being written
+        frombytes = getattr(records, 'frombytes', None) or records.fromstring
+        frombytes(body[:len(body) - len(body) % record_size])
+        if sys.byteorder == 'big':
+            records.byteswap()
+        index._extend(records)
+        return index
+
+    def update(self, capture_path, message_schema, index_path=None):
+        """Index the frames added to a capture file since the last update
+
+        Reading resumes after the last frame indexed.  A frame which is
+        still being written at the end of the capture is left for the next
+        update.  The new records are appended to the index file.
+
+        :returns: The number of frames added to the index.
+
+        """
+        index_path = index_path or self.default_path(capture_path)
+        records = array.array(self._TYPECODE)
+        with MappedFrameReader(capture_path, message_schema, offset=self.end,
+                               growing=True) as reader:
+            for offset, message in reader.iter_with_offsets():
+                records.append(offset)
+                records.append(reader.offset - offset)
+                for name in self.keys:
+                    records.append(int(getattr(message, name)))
+        if not records:
+            return 0
+
+        self._extend(records)
+        if sys.byteorder == 'big':
+            records.byteswap()
+        with open(index_path, 'ab') as f:
+            records.tofile(f)
+        return len(records) // (2 + len(self.keys))
+
+    def _extend(self, records):
+        stride = 2 + len(self.keys)
+        self.offsets.extend(records[0::stride])
+        self.sizes.extend(records[1::stride])
+        for i, name in enumerate(self.keys):
+            self.key_values[name].extend(records[2 + i::stride])
+
+    def key_range(self, name, start, stop):
+        """Return the range of frames with ``start <= key < stop``
+
+        The values of the key field must be in ascending order (as for a
+        timestamp or an ever increasing sequence number).
+
+        """
+        if name not in self.key_values:
+            raise SuitcaseProgrammingError("%r is not a key of this index" % (name,))
+        values = self.key_values[name]
+        return range(bisect.bisect_left(values, start), bisect.bisect_left(values, stop))
+
+    def find(self, name, value):
+        """Return the positions of the frames whose key field equals ``value``"""
+        if name not in self.key_values:
+            raise SuitcaseProgrammingError("%r is not a key of this index" % (name,))
+        return [i for i, key in enumerate(self.key_values[name]) if key == value]
+
+
+def _decode_chunk(path, message_schema, function, start, stop):
+    """Decode the frames starting in ``[start, stop)`` (run by a worker)
+
+    :returns: The offsets of the frames, the results for each frame (the
+        packed message if ``function`` is None) and the offset just past
+        the last frame (None if there are none).
+
+    """
+    offsets = []
+    results = []
+    end = None
+    with MappedFrameReader(path, message_schema, offset=start) as reader:
+        for offset, message in reader.iter_with_offsets():
+            if offset >= stop:
+                break
+            offsets.append(offset)
+            results.append(message.pack() if function is None else function(message))
+            end = reader.offset
+    return offsets, results, end
+
+
+def decode_parallel(path, message_schema, function=None, workers=None,
+                    chunk_size=16 << 20, index=None):
+    """Decode a capture file in chunks using a pool of processes
+
+    The file is split into chunks of about ``chunk_size`` bytes, which
+    are decoded by a :class:`concurrent.futures.ProcessPoolExecutor`.
+    Results are generated in the order of the frames in the file.  At
+    most two chunks per worker are being decoded or waiting to be
+    consumed at any time, so a slow consumer does not make decoded
+    results pile up.
+
+    Each worker synchronizes on the schema's leading Magic from the
+    start of its chunk and decodes the frames starting within it, as a
+    :class:`MappedFrameReader` would.  If a chunk does not start with the
+    frame following the last frame of the previous chunk (for instance
+    because the Magic sequence also occurs within a frame), the chunk is
+    decoded again from that frame.  With an ``index``, chunks start at
+    the frames it records and no synchronization is needed.
+
+    This requires :mod:`concurrent.futures`, i.e. Python 3.
+
+    :param path: The path of the capture file.
+    :param message_schema: The schema of the frames.  It must be picklable
+        (i.e. defined at the top level of a module).
+    :param function: A picklable function called with each message in
+        the worker process, whose result is returned instead of the
+        message.  Without it, messages are sent back packed and unpacked
+        again by the calling process, which limits the speedup.
+    :param workers: The number of worker processes (by default, the
+        number of CPUs).
+    :param chunk_size: The approximate number of bytes in each chunk.
+    :param index: A :class:`FrameIndex` of the capture.
+    :raises SuitcaseProgrammingError: If the schema does not start with a
+        Magic field and no index is given.
+
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if index is None and _leading_magic(message_schema) is None:
+        raise SuitcaseProgrammingError(
+            "Frame boundaries cannot be found in the middle of a capture of %s "
+            "frames without an index" % message_schema.__name__)
+    size = os.path.getsize(path)
+    if index is not None:
+        # the first frame starting in each chunk, if any
+        offsets = index.offsets
+        firsts = (bisect.bisect_left(offsets, position)
+                  for position in range(0, index.end, chunk_size))
+        starts = sorted(set(offsets[first] for first in firsts if first < len(offsets)))
+    else:
+        starts = list(range(0, size, chunk_size))
+    chunks = list(zip(starts, starts[1:] + [size]))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as executor:
+        remaining = iter(chunks)
+        in_flight = collections.deque()
+
+        def submit(count):
+            for start, stop in itertools.islice(remaining, count):
+                in_flight.append(((start, stop), executor.submit(
+                    _decode_chunk, path, message_schema, function, start, stop)))
+
+        submit(2 * workers)
+        expected = None  # where the frame after the previous chunk starts
+        while in_flight:
+            (start, stop), future = in_flight.popleft()
+            offsets, results, end = future.result()
+            submit(1)
+            if expected is not None:
+                first = bisect.bisect_left(offsets, expected)
+                if first < len(offsets) and offsets[first] == expected:
+                    results = results[first:]
+                elif expected < stop:
+                    # misaligned, continue from the end of the previous chunk
+                    offsets, results, end = _decode_chunk(
+                        path, message_schema, function, expected, stop)
+                else:
+                    # the previous chunk's last frame extends past this one
+                    results, end = [], None
+            for result in results:
+                if function is None:
+                    result = message_schema.from_data(result)
+                yield result
+            if end is not None:
+                expected = end
@@ -0,0 +1,516 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+
+"""Read and write pcap and pcapng packet captures
+
+A :class:`PacketReader` iterates over the packets of a pcap or pcapng
+file (the format is detected from the file).  Each :class:`Packet` holds
+the data of the packet as a memoryview over the memory mapped file, so
+it can be unpacked with :meth:`~suitcase.structure.Structure.unpack_from`
+without being copied::
+
+    with PacketReader('capture.pcap') as reader:
+        for packet in reader:
+            frame = IPV4Frame()
+            frame.unpack_from(packet.data)
+
+:meth:`PacketReader.messages` does the same, counting the packets which
+do not match the schema in ``errors``.
+
+A :class:`PcapWriter` or :class:`PcapngWriter` writes packets, given as
+bytes or as messages, to a capture which can be opened with the usual
+tools::
+
+    with PcapWriter('capture.pcap', link_type=LINKTYPE_RAW) as writer:
+        writer.write(frame)
+
+On Python 2, where a memoryview of a memory mapped file cannot be made,
+the file is read as it would be from a file object instead.
+
+Only the blocks of pcapng files holding packets (Enhanced and Simple
+Packet Blocks) and the blocks describing them (Section Header and
+Interface Description Blocks) are interpreted; any others are skipped.
+
+"""
+from __future__ import absolute_import
+
+import collections
+import io
+import mmap
+import os
+import struct
+import time
+
+import six
+
+from suitcase.exceptions import SuitcaseException, SuitcaseParseError
+
+#: Link type of Ethernet frames
+LINKTYPE_ETHERNET = 1
+
+#: Link type of raw IPv4 or IPv6 packets
+LINKTYPE_RAW = 101
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_NANOSECOND_MAGIC = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+_PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+_PCAPNG_SIMPLE_PACKET = 0x00000003
+_PCAPNG_ENHANCED_PACKET = 0x00000006
+_PCAPNG_OPTION_END = 0
+_PCAPNG_OPTION_TSRESOL = 9
+
+# the largest packet libpcap captures, used to reject corrupt lengths
+_MAXIMUM_SNAPLEN = 262144
+_MAXIMUM_BLOCK_SIZE = 16 << 20
+
+
+class Packet(collections.namedtuple(
+        'Packet', 'timestamp data original_length link_type interface')):
+    """A packet read from a capture
+
+    ``timestamp`` is the time the packet was captured in nanoseconds
+    since the epoch (None for pcapng Simple Packet Blocks).  ``data`` is a
+    memoryview of the captured bytes, which are fewer than
+    ``original_length`` if the packet was truncated when it was captured.
+    ``link_type`` is the ``LINKTYPE_*`` value of the interface
+    (``interface``) the packet was captured on.
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def time(self):
+        """The timestamp in seconds since the epoch, as a float"""
+        if self.timestamp is None:
+            return None
+        return self.timestamp / 1e9
+
+
+class _Interface(object):
+    def __init__(self, link_type, snaplen, resolution=1000000):
+        self.link_type = link_type
+        self.snaplen = snaplen
+        self.resolution = resolution  # timestamp units per second
+
+    def nanoseconds(self, ticks):
+        if self.resolution == 1000000:
+            return ticks * 1000
+        return ticks * 1000000000 // self.resolution
+
+
+class PacketReader(object):
+    """Iterate over the packets of a pcap or pcapng capture
+
+    Given a path, the file is memory mapped and the data of each packet
+    is a memoryview of the mapping; it remains valid for as long as it is
+    referenced, even after the reader is closed.
+
+    Given a file object (for instance a pipe from ``tcpdump -w -``), the
+    file is read with ``readinto`` into a buffer of ``buffer_size`` bytes
+    which is reused; the data of a packet is then only valid until the
+    next packet is read.  This is also how a path is read on Python 2.
+
+    A packet extending past the end of the file, as left by a capture
+    which is still being written or was interrupted, ends the iteration.
+    ``offset`` is then the offset of that packet in the file.
+
+    :param source: The path of the capture or a binary file object.
+    :param buffer_size: The size of the read buffer used for file objects.
+    :raises SuitcaseParseError: If the file is not a pcap or pcapng file.
+
+    """
+
+    def __init__(self, source, buffer_size=1 << 20):
+        self.packets_read = 0
+        self.errors = 0
+
+        self._base = 0  # offset in the file of the start of the buffer
+        self._pos = 0
+        self._end = 0
+        self._map = None
+        self._readinto = None
+        self._owns_file = False
+        if isinstance(source, (six.string_types, bytes)) and six.PY2:
+            # Python 2 cannot make a memoryview of a mmap
+            source = io.open(source, 'rb')
+            self._owns_file = True
+        if isinstance(source, (six.string_types, bytes)):
+            self._file = open(source, 'rb')
+            self._owns_file = True
+            if os.fstat(self._file.fileno()).st_size:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._buffer = self._map
+                self._end = len(self._map)
+            else:
+                self._buffer = b''  # empty files cannot be mapped
+        else:
+            self._file = source
+            self._readinto = source.readinto
+            self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+
+        try:
+            if not self._fill(4):
+                raise SuitcaseParseError("The capture has no file header")
+            magic = self._view[self._pos:self._pos + 4].tobytes()
+            if struct.unpack('>I', magic)[0] == PCAPNG_SECTION_HEADER:
+                self.format = 'pcapng'
+                self._interfaces = []
+                self._packets = self._read_pcapng
+            else:
+                self.format = 'pcap'
+                self._read_pcap_header(magic)
+                self._packets = self._read_pcap
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the file (if it was opened by the reader)"""
+        self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # unmapped once the packets still referenced are freed
+        if self._owns_file:
+            self._file.close()
+
+    @property
+    def offset(self):
+        """The offset in the file of the next packet (or block)"""
+        return self._base + self._pos
+
+    def __iter__(self):
+        return self._packets()
+
+    def messages(self, message_schema):
+        """Iterate over ``(packet, message)`` pairs
+
+        The data of each packet is unpacked as a message of
+        ``message_schema``.  Packets which cannot be unpacked are skipped
+        and counted in ``errors``.
+
+        """
+        for packet in self._packets():
+            message = message_schema()
+            try:
+                message.unpack_from(packet.data)
+            except SuitcaseException:
+                self.errors += 1
+                continue
+            yield packet, message
+
+    def _fill(self, size):
+        """Make ``size`` bytes from the current position available
+
+        :returns: False if the file ends first.
+
+        """
+        available = self._end - self._pos
+        if available >= size:
+            return True
+        if self._readinto is None:
+            return False
+
+        if size > len(self._buffer):
+            buffer = bytearray(max(size, 2 * len(self._buffer)))
+            buffer[:available] = self._buffer[self._pos:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        elif self._pos:
+            # the length is unchanged so that exported views do not prevent it
+            self._buffer[:available] = self._buffer[self._pos:self._end]
+        self._base += self._pos
+        self._pos = 0
+        self._end = available
+
+        while self._end < size:
+            count = self._readinto(self._view[self._end:])
+            if not count:
+                return False
+            self._end += count
+        return True
+
+    def _read_pcap_header(self, magic):
+        for byte_order in '<>':
+            value = struct.unpack(byte_order + 'I', magic)[0]
+            if value in (PCAP_MAGIC, PCAP_NANOSECOND_MAGIC):
+                break
+        else:
+            raise SuitcaseParseError("Not a pcap or pcapng file (magic %r)" % (magic,))
+        if not self._fill(24):
+            raise SuitcaseParseError("The pcap file header is truncated")
+        (_magic, self.version_major, self.version_minor, _thiszone, _sigfigs,
+         self.snaplen, network) = struct.unpack_from(byte_order + 'IHHiIII',
+                                                     self._buffer, self._pos)
+        self._pos += 24
+        self.nanosecond = value == PCAP_NANOSECOND_MAGIC
+        # the upper bits may hold the FCS length of the link
+        self.link_type = network & 0xffff
+        self._record_header = struct.Struct(byte_order + 'IIII')
+
+    def _read_pcap(self):
+        unpack_from = self._record_header.unpack_from
+        scale = 1 if self.nanosecond else 1000
+        link_type = self.link_type
+        maximum = max(self.snaplen, _MAXIMUM_SNAPLEN)
+        fill = self._fill
+        while fill(16):
+            seconds, fraction, captured, original = unpack_from(self._buffer, self._pos)
+            if captured > maximum:
+                raise SuitcaseParseError("Invalid packet length %d at offset %d"
+                                         % (captured, self.offset))
+            if not fill(16 + captured):
+                return  # truncated
+            start = self._pos + 16
+            self._pos = start + captured
+            self.packets_read += 1
+            yield Packet(seconds * 1000000000 + fraction * scale,
+                         self._view[start:start + captured], original, link_type, 0)
+
+    def _read_pcapng(self):
+        fill = self._fill
+        while fill(12):
+            pos = self._pos
+            if self._view[pos:pos + 4].tobytes() == b'\x0a\x0d\x0d\x0a':
+                self._read_section_header(pos)
+            block_type, length = self._block_header.unpack_from(self._buffer, pos)
+            if length < 12 or length % 4 or length > _MAXIMUM_BLOCK_SIZE:
+                raise SuitcaseParseError("Invalid pcapng block length %d at offset %d"
+                                         % (length, self.offset))
+            if not fill(length):
+                return  # truncated
+            pos = self._pos
+            self._pos = pos + length
+            if block_type == _PCAPNG_ENHANCED_PACKET:
+                (interface, high, low, captured,
+                 original) = self._enhanced_packet.unpack_from(self._buffer, pos + 8)
+                if 28 + captured + 4 > length:
+                    raise SuitcaseParseError("Invalid packet length %d at offset %d"
+                                             % (captured, self.offset - length))
+                details = self._interface(interface)
+                self.packets_read += 1
+                yield Packet(details.nanoseconds(high << 32 | low),
+                             self._view[pos + 28:pos + 28 + captured],
+                             original, details.link_type, interface)
+            elif block_type == _PCAPNG_SIMPLE_PACKET:
+                original, = self._uint32.unpack_from(self._buffer, pos + 8)
+                details = self._interface(0)
+                captured = min(original, length - 16)
+                if details.snaplen:
+                    captured = min(captured, details.snaplen)
+                self.packets_read += 1
+                yield Packet(None, self._view[pos + 12:pos + 12 + captured],
+                             original, details.link_type, 0)
+            elif block_type == _PCAPNG_INTERFACE_DESCRIPTION:
+                self._read_interface_description(pos, length)
+
+    def _read_section_header(self, pos):
+        for byte_order in '<>':
+            magic, = struct.unpack_from(byte_order + 'I', self._buffer, pos + 8)
+            if magic == PCAPNG_BYTE_ORDER_MAGIC:
+                break
+        else:
+            raise SuitcaseParseError("Invalid pcapng byte-order magic at offset %d"
+                                     % self.offset)
+        self._byte_order = byte_order
+        self._block_header = struct.Struct(byte_order + 'II')
+        self._enhanced_packet = struct.Struct(byte_order + 'IIIII')
+        self._uint32 = struct.Struct(byte_order + 'I')
+        self._option_header = struct.Struct(byte_order + 'HH')
+        self._interfaces = []  # interfaces are numbered per section
+
+    def _read_interface_description(self, pos, length):
+        link_type, _reserved, snaplen = struct.unpack_from(
+            self._byte_order + 'HHI', self._buffer, pos + 8)
+        interface = _Interface(link_type, snaplen)
+        position = pos + 16
+        end = pos + length - 4
+        while position + 4 <= end:
+            code, option_length = self._option_header.unpack_from(self._buffer, position)
+            if code == _PCAPNG_OPTION_END:
+                break
+            if code == _PCAPNG_OPTION_TSRESOL and option_length == 1:
+                value = six.indexbytes(self._view[position + 4:position + 5].tobytes(), 0)
+                if value & 0x80:
+                    interface.resolution = 2 ** (value & 0x7f)
+                else:
+                    interface.resolution = 10 ** value
+            position += 4 + (option_length + 3) // 4 * 4
+        self._interfaces.append(interface)
+
+    def _interface(self, interface):
+        try:
+            return self._interfaces[interface]
+        except IndexError:
+            raise SuitcaseParseError("Packet from undescribed interface %d at "
+                                     "offset %d" % (interface, self.offset))
+
+
+class _CaptureWriter(object):
+    def __init__(self, destination):
+        if isinstance(destination, (six.string_types, bytes)):
+            self._file = open(destination, 'wb')
+            self._owns_file = True
+        else:
+            self._file = destination
+            self._owns_file = False
+        self.packets_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Flush the file and close it (if it was opened by the writer)"""
+        if self._owns_file:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    @staticmethod
+    def _parts(data, snaplen):
+        """Return the parts of ``data`` to write, their length and the original length"""
+        if hasattr(data, 'pack_parts'):
+            parts = data.pack_parts()
+        else:
+            parts = [data]
+        length = sum(len(part) for part in parts)
+        if snaplen and length > snaplen:
+            return [b''.join(bytes(part) for part in parts)[:snaplen]], snaplen, length
+        return parts, length, length
+
+    @staticmethod
+    def _timestamp(timestamp):
+        if timestamp is None:
+            return int(time.time() * 1e6) * 1000
+        return timestamp
+
+
+class PcapWriter(_CaptureWriter):
+    """Write packets to a pcap file
+
+    The file is written in little-endian byte order.
+
+    :param destination: The path of the file or a binary file object.
+    :param link_type: The ``LINKTYPE_*`` value of the packets.
+    :param snaplen: Packets longer than this are truncated.
+    :param nanosecond: If True, timestamps are stored with nanosecond
+        rather than microsecond resolution.
+
+    """
+
+    def __init__(self, destination, link_type=LINKTYPE_ETHERNET,
+                 snaplen=_MAXIMUM_SNAPLEN, nanosecond=False):
+        _CaptureWriter.__init__(self, destination)
+        self.link_type = link_type
+        self.snaplen = snaplen
+        self.nanosecond = nanosecond
+        self._record_header = struct.Struct('<IIII')
+        self._file.write(struct.pack(
+            '<IHHiIII', PCAP_NANOSECOND_MAGIC if nanosecond else PCAP_MAGIC,
+            2, 4, 0, 0, snaplen, link_type))
+
+    def write(self, data, timestamp=None):
+        """Write a packet
+
+        :param data: The packet, as a bytes-like object or a message (which
+            is packed with :meth:`~suitcase.structure.Structure.pack_parts`).
+        :param timestamp: The time the packet was captured in nanoseconds
+            since the epoch.  This defaults to the current time.
+
+        """
+        parts, captured, original = self._parts(data, self.snaplen)
+        seconds, nanoseconds = divmod(self._timestamp(timestamp), 1000000000)
+        fraction = nanoseconds if self.nanosecond else nanoseconds // 1000
+        write = self._file.write
+        write(self._record_header.pack(seconds, fraction, captured, original))
+        for part in parts:
+            write(part)
+        self.packets_written += 1
+
+
+class PcapngWriter(_CaptureWriter):
+    """Write packets to a pcapng file as Enhanced Packet Blocks
+
+    The file holds a single section, written in little-endian byte order,
+    and an interface of ``link_type`` (interface 0).  More interfaces can
+    be described with :meth:`add_interface`.
+
+    :param destination: The path of the file or a binary file object.
+    :param link_type: The ``LINKTYPE_*`` value of the packets of interface 0.
+    :param snaplen: Packets longer than this are truncated (0 for no limit).
+    :param nanosecond: If True, timestamps are stored with nanosecond
+        rather than microsecond resolution.
+
+    """
+
+    def __init__(self, destination, link_type=LINKTYPE_ETHERNET, snaplen=0,
+                 nanosecond=False):
+        _CaptureWriter.__init__(self, destination)
+        self.nanosecond = nanosecond
+        self._snaplens = []
+        self._packet_header = struct.Struct('<IIIIIII')
+        # the section length is unknown (-1) as the file is streamed
+        self._file.write(struct.pack('<IIIHHqI', PCAPNG_SECTION_HEADER, 28,
+                                     PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1, 28))
+        self.add_interface(link_type, snaplen)
+
+    def add_interface(self, link_type, snaplen=0):
+        """Describe another interface
+
+        :returns: The number of the interface, to be passed to :meth:`write`.
+
+        """
+        if self.nanosecond:
+            options = struct.pack('<HHB3xHH', _PCAPNG_OPTION_TSRESOL, 1, 9,
+                                  _PCAPNG_OPTION_END, 0)
+        else:
+            options = b''
+        length = 20 + len(options)
+        self._file.write(struct.pack('<IIHHI', _PCAPNG_INTERFACE_DESCRIPTION,
+                                     length, link_type, 0, snaplen))
+        self._file.write(options + struct.pack('<I', length))
+        self._snaplens.append(snaplen)
+        return len(self._snaplens) - 1
+
+    def write(self, data, timestamp=None, interface=0):
+        """Write a packet
+
+        :param data: The packet, as a bytes-like object or a message (which
+            is packed with :meth:`~suitcase.structure.Structure.pack_parts`).
+        :param timestamp: The time the packet was captured in nanoseconds
+            since the epoch.  This defaults to the current time.
+        :param interface: The interface the packet was captured on.
+
+        """
+        parts, captured, original = self._parts(data, self._snaplens[interface])
+        ticks = self._timestamp(timestamp)
+        if not self.nanosecond:
+            ticks //= 1000
+        padding = -captured % 4
+        length = 32 + captured + padding
+        write = self._file.write
+        write(self._packet_header.pack(_PCAPNG_ENHANCED_PACKET, length, interface,
+                                       ticks >> 32, ticks & 0xffffffff,
+                                       captured, original))
+        for part in parts:
+            write(part)
+        write(b'\x00' * padding + struct.pack('<I', length))
+        self.packets_written += 1
@@ -13,10 +13,470 @@ handlers will also provide notifications of error conditions
 (for instance, unexpected bytes or a bad checksum).
 
 """
-from functools import partial
+import collections
+import errno
+import operator
+import re
+import socket
+import sys
+import time
 
 import six
-from suitcase.fields import Magic
+from suitcase.crc import RESUMABLE_ALGORITHMS
+from suitcase.exceptions import SuitcaseException, SuitcaseParseError, \
+    SuitcaseBufferOverflowError, SuitcaseProgrammingError
+from suitcase.fields import Magic, BaseStructField, BitField, BaseFixedByteSequence, \
+    DispatchField, TypeField, CRCField, FieldProperty, FieldAccessor, LengthField, \
+    Payload, FieldArray, DispatchTarget, BaseVariableByteSequence, ConditionalField, \
+    SubstructureField, StreamedPayload
+
+# clock used to time batches
+_clock = getattr(time, 'monotonic', time.time)
+
+# flag making a single receive non-blocking (0 where not supported)
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# fields whose size never depends on the data being parsed
+_STATIC_FIELD_TYPES = (BaseStructField, Magic, BitField, BaseFixedByteSequence,
+                       DispatchField, TypeField, CRCField, FieldProperty,
+                       FieldAccessor, LengthField)
+
+# fields whose size is given by some other (length providing) field
+_LENGTH_PROVIDED_FIELD_TYPES = (Payload, FieldArray, DispatchTarget,
+                                BaseVariableByteSequence)
+
+#: Raise a :class:`~suitcase.exceptions.SuitcaseBufferOverflowError` from
+#: ``feed()`` after discarding the buffered bytes
+OVERFLOW_RAISE = 'raise'
+#: Discard the oldest data: the frame which is too large, or the oldest
+#: bytes buffered beyond ``max_buffer_size``
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+#: Discard the first byte of the frame which is too large (or the oldest
+#: bytes waiting to be parsed) and resynchronize on the bytes that follow
+OVERFLOW_RESYNC = 'resync'
+
+
+def _max_length(provider):
+    """Largest length a length provider can give (None if not known)"""
+    if isinstance(provider, TypeField):
+        return max(provider.length_mapping.values())
+    if not isinstance(provider, LengthField) or provider.is_derived:
+        return None
+    if provider.get_length != provider._default_get_length:
+        return None
+    length_field = provider.length_field
+    if not isinstance(length_field, BaseStructField):
+        return None
+    fmt = length_field.PACK_FORMAT[-1:]
+    if isinstance(fmt, bytes):
+        fmt = fmt.decode('ascii')
+    signed = 1 if fmt in 'bhilq' else 0
+    return ((1 << (8 * length_field.bytes_required - signed)) - 1) * provider.multiplier
+
+
+class _FrameLayout(object):
+    """Describes how to find the size of a frame from its header
+
+    Many framing schemes consist of fixed size fields, possibly followed
+    by fields whose size is given by a length field in the header (e.g.
+    Magic + header + LengthField + payload + CRC).  For these, the size
+    of the whole frame is known as soon as the header has been received.
+
+    :param header_count: The number of leading fields making up the header.
+    :param header_size: The number of bytes in the header.
+    :param sizes: The size of each field, with None for fields whose size
+        is given by a length provider in the header.
+    :param max_frame_size: The largest frame the header can describe, or
+        None if this is not known.
+    :param streamed_index: The index of the frame's StreamedPayload field,
+        if it has one.
+    :param crc_indexes: The indexes of the frame's CRCFields.
+    :param resumable: True if all of the CRCFields use one of the
+        :data:`~suitcase.crc.RESUMABLE_ALGORITHMS`.
+
+    """
+
+    def __init__(self, header_count, header_size, sizes, max_frame_size=None,
+                 streamed_index=None, crc_indexes=(), resumable=True):
+        self.header_count = header_count
+        self.header_size = header_size
+        self.sizes = sizes
+        self.max_frame_size = max_frame_size
+        self.streamed_index = streamed_index
+        self.crc_indexes = crc_indexes
+        self.resumable = resumable
+        self.header = list(zip(range(header_count), sizes))
+        self.body = list(enumerate(sizes))[header_count:]
+        # offsets of the checksums from the start (or end) of the frame
+        # where they do not depend on the lengths in the header
+        self._crc_positions = []
+        for index in crc_indexes:
+            head, tail = sizes[:index], sizes[index:]
+            self._crc_positions.append(
+                (index, None if None in head else sum(head),
+                 None if None in tail else sum(tail)))
+
+    @classmethod
+    def from_schema(cls, message_schema):
+        """Return the layout for a schema or None if it is not suitable"""
+        message = message_schema()
+        fields = [field for _name, field in message]
+        indexes = dict((id(field), i) for i, field in enumerate(fields))
+        sizes = []
+        header_count = 0
+        max_frame_size = 0
+        for field in fields:
+            if isinstance(field, _STATIC_FIELD_TYPES):
+                size = field.bytes_required
+                if not isinstance(size, six.integer_types):
+                    return None
+                sizes.append(size)
+                max_size = size
+            elif isinstance(field, _LENGTH_PROVIDED_FIELD_TYPES):
+                provider = getattr(field, 'length_provider', None)
+                provider_index = indexes.get(id(provider))
+                if provider_index is None:
+                    return None
+                sizes.append(None)
+                header_count = max(header_count, provider_index + 1)
+                max_size = _max_length(provider)
+            else:
+                return None
+            if max_frame_size is not None:
+                max_frame_size = None if max_size is None else max_frame_size + max_size
+
+        if None in sizes[:header_count]:
+            return None
+        streamed = [i for i, field in enumerate(fields)
+                    if isinstance(field, StreamedPayload)]
+        crc_indexes = [i for i, field in enumerate(fields) if isinstance(field, CRCField)]
+        resumable = all(fields[i].algo in RESUMABLE_ALGORITHMS for i in crc_indexes)
+        return cls(header_count, sum(sizes[:header_count]), sizes, max_frame_size,
+                   streamed[0] if len(streamed) == 1 else None, crc_indexes, resumable)
+
+    def unpack_header(self, message, buffer, start):
+        """Unpack the header fields of the frame at ``buffer[start:]``"""
+        fields = message._sorted_fields
+        offset = start
+        for index, size in self.header:
+            fields[index][1].unpack(bytes(buffer[offset:offset + size]))
+            offset += size
+
+    def unpack_body(self, message, buffer, start):
+        """Unpack the fields after the header of the frame at ``buffer[start:]``"""
+        fields = message._sorted_fields
+        offset = start + self.header_size
+        for index, size in self.body:
+            field = fields[index][1]
+            if size is None:
+                size = field.bytes_required
+            field.unpack(bytes(buffer[offset:offset + size]))
+            offset += size
+
+    def running_checksums(self, message, frame_size):
+        """Return the checksums of a frame which can be computed as it arrives
+
+        Returns None unless every CRCField of the message uses one of the
+        :data:`~suitcase.crc.RESUMABLE_ALGORITHMS` over a region not
+        including the checksum itself.
+
+        """
+        if not self.crc_indexes or not self.resumable:
+            return None
+        checksums = []
+        for field, offset, start, end in self.checksum_regions(message, frame_size):
+            if start < offset + field.bytes_required and offset < end:
+                return None
+            checksums.append(_RunningChecksum(field, offset, start, end))
+        return checksums
+
+    def checksum_regions(self, message, frame_size):
+        """Return ``(crc_field, offset, start, end)`` for each CRCField"""
+        fields = message._sorted_fields
+        offsets = None
+        regions = []
+        for index, head, tail in self._crc_positions:
+            if head is not None:
+                offset = head
+            elif tail is not None:
+                offset = frame_size - tail
+            else:
+                if offsets is None:
+                    offsets = self.offsets(message)
+                offset = offsets[index]
+            field = fields[index][1]
+            start, end, _step = slice(field.start, field.end).indices(frame_size)
+            regions.append((field, offset, start, end))
+        return regions
+
+    def validate_checksums(self, message, buffer, start, frame_size):
+        """Validate the checksums of the frame at ``buffer[start:]``"""
+        for field, offset, crc_start, crc_end in self.checksum_regions(message, frame_size):
+            if crc_end <= offset or offset + field.bytes_required <= crc_start:
+                # the checksum does not cover itself
+                field.check(field.algo(buffer[start + crc_start:start + crc_end]))
+            else:
+                field.validate(bytes(buffer[start:start + frame_size]), offset)
+
+    def offsets(self, message):
+        """Offsets of the fields, given a message with its header unpacked"""
+        offsets = []
+        offset = 0
+        for (_name, field), size in zip(message, self.sizes):
+            offsets.append(offset)
+            offset += field.bytes_required if size is None else size
+        return offsets
+
+    def frame_size(self, message):
+        """Size of the frame, given a message with its header unpacked"""
+        total = 0
+        for (_name, field), size in zip(message, self.sizes):
+            if size is None:
+                size = field.bytes_required
+                if size < 0:
+                    raise SuitcaseParseError("Negative length %d for field %r"
+                                             % (size, _name))
+            total += size
+        return total
+
+
+def _is_unbounded(field):
+    """True for a greedy field taking all bytes up to the fields after it"""
+    if getattr(field, 'length_provider', None) is not None or not field.is_greedy:
+        return False
+    if isinstance(field, FieldArray):
+        return field.num_elements_provider is None
+    return isinstance(field, (Payload, DispatchTarget))
+
+
+class _TerminatedLayout(object):
+    """Describes a frame whose end is marked by a terminating Magic field
+
+    The frame consists of fixed size fields, a single greedy field (e.g. a
+    Payload without a length provider), a Magic terminator and possibly
+    more fixed size fields (e.g. a CRCField).  The end of the greedy
+    field is found by searching for the terminator, which must not occur
+    within the contents of the greedy field.
+
+    :param header_size: The number of bytes before the greedy field.
+    :param terminator: The byte sequence of the terminating Magic.
+    :param trailer_size: The number of bytes after the terminator.
+
+    """
+
+    # frames are only bounded by the max_frame_size of the handler
+    max_frame_size = None
+
+    def __init__(self, header_size, terminator, trailer_size):
+        self.header_size = header_size
+        self.terminator = terminator
+        self.trailer_size = trailer_size
+
+    @classmethod
+    def from_schema(cls, message_schema):
+        """Return the layout for a schema or None if it is not suitable"""
+        fields = [field for _name, field in message_schema()]
+        greedy_index = None
+        sizes = []
+        for index, field in enumerate(fields):
+            if isinstance(field, _STATIC_FIELD_TYPES):
+                size = field.bytes_required
+                if not isinstance(size, six.integer_types):
+                    return None
+                sizes.append(size)
+            elif greedy_index is None and _is_unbounded(field):
+                greedy_index = index
+                sizes.append(0)
+            else:
+                return None
+
+        if greedy_index is None or greedy_index + 1 == len(fields):
+            return None
+        terminator = fields[greedy_index + 1]
+        if not isinstance(terminator, Magic):
+            return None
+        return cls(sum(sizes[:greedy_index]), terminator.getval(),
+                   sum(sizes[greedy_index + 2:]))
+
+
+class _RunningChecksum(object):
+    """Checksum over a region of a frame, updated as the frame arrives"""
+
+    def __init__(self, crc_field, crc_offset, start, end):
+        self.crc_field = crc_field
+        self.crc_offset = crc_offset
+        self.position = start
+        self.end = end
+        self.crc = 0
+
+    def update(self, buffer, frame_start, available):
+        """Add the bytes of the region among the first ``available`` bytes"""
+        upto = min(available, self.end)
+        if upto > self.position:
+            self.crc = self.crc_field.algo(
+                buffer[frame_start + self.position:frame_start + upto], self.crc)
+            self.position = upto
+
+
+def _frame_layout(message_schema):
+    """Return the layout of a schema's frames or None if it has no known layout"""
+    return (_FrameLayout.from_schema(message_schema) or
+            _TerminatedLayout.from_schema(message_schema))
+
+
+def _leading_magic(message_schema):
+    """Return the sequence of a schema's leading Magic field (or None)"""
+    for _name, field in message_schema():
+        if isinstance(field, Magic):
+            return field.getval()
+        return None
+
+
+class _ParseState(object):
+    """Progress through the fields of one (possibly nested) message"""
+
+    def __init__(self, message, base, on_complete):
+        self.message = message
+        self.fields = message._sorted_fields
+        self.index = 0
+        self.base = base  # offset of the message within the frame
+        self.crc_fields = []
+        self.on_complete = on_complete
+
+
+class StreamParser(object):
+    """Resumable parser for a single message received in pieces
+
+    The parser does no I/O itself.  Each call to :meth:`advance` is given
+    all of the bytes received so far for the message, starting at the
+    first byte of the message, and parses as many fields as it can.  When
+    it runs out of bytes it remembers where it was and reports through
+    :attr:`bytes_required` how many bytes it needs to make progress, so
+    the caller can wait for that many bytes before calling it again::
+
+        parser = StreamParser(MySchema)
+        data = bytearray()
+        while True:
+            message = parser.advance(data)
+            if message is not None:
+                break
+            while len(data) < parser.bytes_required:
+                data += sock.recv(4096)
+
+    Fields with a known size are unpacked as soon as their bytes are
+    available.  SubstructureFields, DispatchTargets without a length
+    provider and FieldArrays with a number of elements are parsed by
+    descending into the nested messages.  Greedy fields are supported
+    where their extent is bounded by a length provider; a greedy field
+    which could extend to the end of the stream raises a
+    :class:`~suitcase.exceptions.SuitcaseParseError`.
+
+    :param message_schema: The schema of the message to be parsed.
+
+    """
+
+    def __init__(self, message_schema):
+        self.message = message_schema()
+        #: Number of bytes of the message parsed so far
+        self.bytes_consumed = 0
+        #: Number of bytes (from the start of the message) needed to continue
+        self.bytes_required = 0
+        self._stack = [_ParseState(self.message, 0, None)]
+
+    def advance(self, buffer, start=0, end=None):
+        """Continue parsing with the bytes in ``buffer[start:end]``
+
+        :param buffer: A bytes-like object holding the message received
+            so far.  The first byte of the message is at ``start``.
+        :returns: The fully parsed message or None if more bytes are needed.
+
+        """
+        if end is None:
+            end = len(buffer)
+        available = end - start
+        stack = self._stack
+        while stack:
+            state = stack[-1]
+            if state.index == len(state.fields):
+                stack.pop()
+                self._complete(state, buffer, start)
+                continue
+
+            name, field = state.fields[state.index]
+            try:
+                size = field.bytes_required
+                if size is None:
+                    state.index += 1
+                    self._descend(name, field)
+                    continue
+
+                if self.bytes_consumed + size > available:
+                    self.bytes_required = self.bytes_consumed + size
+                    return None
+
+                if isinstance(field, CRCField):
+                    state.crc_fields.append((field, self.bytes_consumed - state.base))
+                offset = start + self.bytes_consumed
+                unused_data = field.unpack(bytes(buffer[offset:offset + size]))
+                self.bytes_consumed += size - len(unused_data or b"")
+                state.index += 1
+            except SuitcaseException:
+                raise  # just re-raise these
+            except Exception:
+                exc_type = SuitcaseParseError
+                _, exc_value, exc_traceback = sys.exc_info()
+                exc_value = exc_type("Unexpected exception while unpacking field %r: %s" % (name, str(exc_value)))
+                six.reraise(exc_type, exc_value, exc_traceback)
+
+        self.bytes_required = self.bytes_consumed
+        return self.message
+
+    def _push(self, message, on_complete=None):
+        self._stack.append(_ParseState(message, self.bytes_consumed, on_complete))
+
+    def _descend(self, name, field):
+        """Start parsing the nested message(s) of a field of unknown size"""
+        if isinstance(field, ConditionalField):
+            field = field.field  # only reached if the condition holds
+
+        if isinstance(field, SubstructureField):
+            child = field.substructure()
+            child.bind_parent(field._parent)
+            field._value = child
+            self._push(child)
+        elif isinstance(field, DispatchTarget):
+            target_msg_type = field._lookup_msg_type()
+            if target_msg_type is None:
+                raise SuitcaseParseError("Input data contains type byte not"
+                                         " contained in mapping")
+            child = target_msg_type()
+            field.setval(child)
+            self._push(child)
+        elif isinstance(field, FieldArray) and field.num_elements is not None:
+            self._push_array_element(field, field.num_elements)
+        else:
+            raise SuitcaseParseError("The extent of greedy field %r cannot be "
+                                     "determined from a stream of bytes" % (name,))
+
+    def _push_array_element(self, array, remaining):
+        if remaining <= 0:
+            return
+
+        def on_complete(element):
+            array._value.append(element)
+            self._push_array_element(array, remaining - 1)
+
+        element = array.substructure()
+        element.bind_parent(array._parent)
+        self._push(element, on_complete)
+
+    def _complete(self, state, buffer, start):
+        if state.crc_fields:
+            data = bytes(buffer[start + state.base:start + self.bytes_consumed])
+            for crc_field, offset in state.crc_fields:
+                crc_field.validate(data, offset)
+        if state.on_complete is not None:
+            state.on_complete(state.message)
 
 
 class StreamProtocolHandler(object):
@@ -60,55 +520,461 @@ class StreamProtocolHandler(object):
         packets for the protocol to be used.
     :param packet_callback: A callback to be executed with the form
         ``callback(packet)`` when a fully-formed packet is detected.
+    :param max_buffer_size: The maximum number of bytes to keep buffered
+        between calls to :meth:`feed`.  This also limits the frame size.
+        Complete frames left in the buffer because of
+        ``max_frames_per_feed`` do not count towards the limit.
+    :param max_frame_size: The maximum size of a frame.  By default this
+        is the largest frame the schema can describe, when the size of the
+        frame can be determined from its header.
+    :param max_frames_per_feed: The maximum number of packets parsed by a
+        single call to :meth:`feed`.  The bytes of further packets are
+        left in the buffer and parsed by the next call (see :meth:`process`).
+    :param immediate_delivery: If True, ``packet_callback`` is executed
+        as soon as each packet is parsed rather than once all of the
+        bytes fed have been parsed.
+    :param batch_callback: A callback to be executed with the form
+        ``callback(packets)`` with a list of packets, instead of executing
+        ``packet_callback`` for each packet.  By default it is executed
+        once for all of the packets parsed by a call to :meth:`feed`.
+    :param batch_size: If specified, batches of ``batch_size`` packets are
+        delivered, holding back packets until a batch is full.
+    :param batch_interval: If specified, packets are held back until the
+        first packet of a batch has been waiting for ``batch_interval``
+        seconds (or the batch is full).  Use :meth:`flush` to deliver
+        packets which are being held back.
+    :param resync_on_error: If True, a frame which cannot be parsed (for
+        instance because of a bad checksum, an impossible length or a
+        mismatched Magic) is skipped by searching for the next frame from
+        the byte after its start, keeping the rest of the buffer.  By
+        default the whole buffer is discarded (see :meth:`reset`).
+    :param payload_sink: A function called with a message whose header has
+        been parsed when a frame with a
+        :class:`~suitcase.fields.StreamedPayload` starts.  It returns a
+        function which is called with each piece of the payload as it
+        arrives (for instance the ``write`` method of a file or the
+        ``update`` method of a hash).  The frame's trailer, including any
+        checksum, is validated once the whole payload has been passed on;
+        only then is the message delivered.  Only the bytes outside the
+        payload count towards ``max_frame_size``.  Exceptions raised by
+        ``payload_sink`` or the function it returns are not parse errors:
+        the rest of the frame is discarded and the exception is raised
+        by :meth:`feed` (or :meth:`process`) once the packets it parsed
+        have been delivered.
+    :param payload_error_callback: A callback to be executed with the form
+        ``callback(message, error)`` when a frame whose payload has been
+        passed to ``payload_sink`` is not delivered because its trailer
+        could not be parsed (for instance because of a bad checksum), so
+        that what the sink received can be discarded.
+    :param overflow_policy: What to do when a frame is too large or when
+        more than ``max_buffer_size`` bytes would remain buffered; one of
+        :data:`OVERFLOW_RAISE`, :data:`OVERFLOW_DROP_OLDEST` or
+        :data:`OVERFLOW_RESYNC`.
+
+    The handler counts the packets it has parsed (``frames_received``),
+    the number of times a limit was exceeded (``overflows``) and the
+    frames and bytes discarded as a result (``frames_dropped`` and
+    ``bytes_dropped``).  It also counts the number of times it has
+    resynchronized after an error (``resyncs``) and the bytes skipped
+    while searching for the start of a frame (``bytes_skipped``).
+
+    When the size of a whole frame can be determined from a fixed size
+    header (for instance Magic, a few fixed fields, a LengthField, the
+    payload and a CRCField), the handler waits until the whole frame has
+    been received and unpacks it in one go, validating any checksum.
+    Checksums using one of the :data:`~suitcase.crc.RESUMABLE_ALGORITHMS`
+    are computed as the bytes of the frame arrive.
+    Frames ending with a greedy field followed by a terminating Magic (and
+    possibly fixed size fields such as a checksum) are found by searching
+    for the terminator, without searching any byte more than once.
+    Other schemas are parsed incrementally by a :class:`StreamParser` as
+    bytes arrive.
 
     """
 
-    def __init__(self, message_schema, packet_callback):
+    # initial size of the receive buffer; it grows as needed
+    _INITIAL_BUFFER_SIZE = 4096
+    # smallest buffer handed out by get_buffer()
+    _MIN_READ_SIZE = 1024
+    # compute checksums of whole frames as their bytes arrive
+    _running_checksums = True
+
+    def __init__(self, message_schema, packet_callback=None, max_buffer_size=None,
+                 max_frame_size=None, max_frames_per_feed=None,
+                 overflow_policy=OVERFLOW_RAISE, immediate_delivery=False,
+                 batch_callback=None, batch_size=None, batch_interval=None,
+                 resync_on_error=False, payload_sink=None, payload_error_callback=None):
         # configuration parameters
         self.message_schema = message_schema
         self.packet_callback = packet_callback
+        self.payload_sink = payload_sink
+        self.payload_error_callback = payload_error_callback
+        self.immediate_delivery = immediate_delivery
+        self.batch_callback = batch_callback
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.resync_on_error = resync_on_error
+        self.max_buffer_size = max_buffer_size
+        self.max_frames_per_feed = max_frames_per_feed
+        if overflow_policy not in (OVERFLOW_RAISE, OVERFLOW_DROP_OLDEST, OVERFLOW_RESYNC):
+            raise ValueError("Unknown overflow policy %r" % (overflow_policy,))
+        self.overflow_policy = overflow_policy
+
+        # counters
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.bytes_dropped = 0
+        self.overflows = 0
+        self.resyncs = 0
+        self.bytes_skipped = 0
 
-        # internal state
-        self._available_bytes = b""
+        # internal state.  Bytes which have been received but not yet
+        # consumed are held in _buffer[_start:_end].  The buffer is only
+        # compacted or grown when there is no room left after _end.  It is
+        # never resized in place as get_buffer() exports views of it.
+        self._buffer = bytearray()
+        self._start = 0
+        self._end = 0
+        self._undelivered = collections.deque()
+        self._batch_started = None
+        # frames whose payload went to the sink but which failed, and the
+        # exception raised by a sink, reported once parsing stops
+        self._failed_payloads = collections.deque()
+        self._sink_error = None
+        self._frame_layout = _frame_layout(message_schema)
+        self._leading_magic = _leading_magic(message_schema)
+        if payload_sink is not None:
+            for schema in self._message_schemas():
+                for _name, field in schema():
+                    if isinstance(field, CRCField) and field.algo not in RESUMABLE_ALGORITHMS:
+                        raise SuitcaseProgrammingError(
+                            "The checksum %r of a streamed frame must use one of the "
+                            "resumable CRC algorithms" % (_name,))
+        if max_frame_size is None:
+            max_frame_size = self._derived_max_frame_size()
+        if max_buffer_size is not None:
+            max_frame_size = min(max_buffer_size, max_frame_size or max_buffer_size)
+        self.max_frame_size = max_frame_size
         self._packet_generator = self._create_packet_generator()
 
+    def _message_schemas(self):
+        """The schemas of the frames the handler may parse"""
+        return [self.message_schema]
+
+    def _derived_max_frame_size(self):
+        """The largest frame the schema can describe (None if unknown)"""
+        if self._frame_layout is None:
+            return None
+        return self._frame_layout.max_frame_size
+
+    def _bytes_available(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """Make sure there is room for ``size`` more bytes after _end"""
+        if self._end + size <= len(self._buffer):
+            return
+        pending = self._end - self._start
+        if pending + size <= len(self._buffer) // 2:
+            # plenty of room once consumed bytes are dropped; move the
+            # pending bytes to the front of the buffer
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        else:
+            new_size = max(self._INITIAL_BUFFER_SIZE, 2 * (pending + size))
+            new_buffer = bytearray(new_size)
+            new_buffer[:pending] = self._buffer[self._start:self._end]
+            self._buffer = new_buffer
+        self._start = 0
+        self._end = pending
+
+    def _append(self, new_bytes):
+        size = len(new_bytes)
+        self._reserve(size)
+        self._buffer[self._end:self._end + size] = new_bytes
+        self._end += size
+
+    def _skip(self, size):
+        """Drop the next ``size`` bytes from the buffer"""
+        self._start += size
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _skip_to(self, position):
+        """Discard the bytes before ``position`` while searching for a frame"""
+        self.bytes_skipped += position - self._start
+        self._skip(position - self._start)
+
+    def _synchronize(self, magic_seq):
+        """Discard bytes until the buffer starts with ``magic_seq``"""
+        bytes_required = len(magic_seq)
+        while True:
+            if self._bytes_available() < bytes_required:
+                yield None
+                continue
+
+            idx = self._buffer.find(magic_seq, self._start, self._end)
+            if idx == -1:  # no match in buffer
+                # Since we know the entire magic_seq is not here, there can be at most
+                # bytes_required - 1 bytes of the magic_seq available.  Thus we keep
+                # that many bytes around in case it is the start of the magic field.
+                self._skip_to(self._end - (bytes_required - 1))
+                yield None
+            else:
+                self._skip_to(idx)
+                break  # continue processing
+
     def _create_packet_generator(self):
         while True:
-            curmsg = self.message_schema()
-            for i, (_name, field) in enumerate(curmsg):
-                bytes_required = field.bytes_required
-
-                if i == 0 and isinstance(field, Magic):
-                    magic_seq = field.getval()
-                    while True:
-                        if len(self._available_bytes) < bytes_required:
-                            yield None
-                            continue
-
-                        idx = self._available_bytes.find(magic_seq)
-                        if idx == -1:  # no match in buffer
-                            # Since we know the entire magic_seq is not here, there can be at most
-                            # bytes_required - 1 bytes of the magic_seq available.  Thus we keep
-                            # that many bytes around in case it is the start of the magic field.
-                            self._available_bytes = self._available_bytes[-(bytes_required - 1):]
-                            yield None
-                        else:
-                            self._available_bytes = self._available_bytes[idx:]
-                            break  # continue processing
-
-                # For a specific field, read until we have enough bytes
-                # and then give the field a try.
-                while True:
-                    bytes_available = len(self._available_bytes)
-                    if bytes_required <= bytes_available:
-                        field_bytes = self._available_bytes[:bytes_required]
-                        new_bytes = self._available_bytes[bytes_required:]
-                        self._available_bytes = new_bytes
-                        field.unpack(field_bytes)
-                        break
-                    else:
+            if self._leading_magic is not None:
+                for _ in self._synchronize(self._leading_magic):
+                    yield None
+
+            for curmsg in self._read_frame(self.message_schema, self._frame_layout):
+                yield curmsg
+
+    def _read_frame(self, message_schema, layout):
+        """Parse a frame of ``message_schema`` from the start of the buffer
+
+        This yields None while waiting for more bytes, followed by the
+        message (unless the frame is dropped).
+
+        """
+        if isinstance(layout, _TerminatedLayout):
+            return self._read_terminated_frame(message_schema, layout)
+        if layout is not None:
+            return self._read_whole_frame(message_schema, layout)
+        return self._read_frame_incrementally(message_schema)
+
+    def _read_whole_frame(self, message_schema, layout):
+        """Parse a frame whose total size is known once the header is in
+
+        Only the header fields are parsed while waiting for the frame.
+        Once all of its bytes have been received, the remaining fields are
+        unpacked straight from the buffer and the checksums validated.
+
+        """
+        curmsg = self._header_message(message_schema)
+
+        while self._bytes_available() < layout.header_size:
+            yield None
+        layout.unpack_header(curmsg, self._buffer, self._start)
+
+        frame_size = layout.frame_size(curmsg)
+        if layout.streamed_index is not None and self.payload_sink is not None:
+            for packet in self._read_streamed_frame(curmsg, layout, frame_size):
+                yield packet
+            return
+        if self.max_frame_size is not None and frame_size > self.max_frame_size:
+            for _ in self._drop_frame(frame_size):
+                yield None
+            return
+        # checksums are computed as the bytes arrive where possible
+        checksums = None
+        if self._running_checksums and self._bytes_available() < frame_size:
+            checksums = layout.running_checksums(curmsg, frame_size)
+        while self._bytes_available() < frame_size:
+            if checksums is not None:
+                for checksum in checksums:
+                    checksum.update(self._buffer, self._start, self._bytes_available())
+            yield None
+
+        # the frame stays buffered until it has been unpacked successfully
+        if checksums is not None:
+            for checksum in checksums:
+                checksum.update(self._buffer, self._start, frame_size)
+        packet = self._complete_frame(curmsg, layout, frame_size, checksums)
+        self._skip(frame_size)
+        yield packet
+
+    def _header_message(self, message_schema):
+        """Return the message the header of the next frame is unpacked into"""
+        return message_schema()
+
+    def _read_streamed_frame(self, message, layout, frame_size):
+        """Pass the StreamedPayload of a frame to the payload sink
+
+        The bytes before and after the payload are buffered and unpacked
+        field by field.  Each piece of the payload is added to the running
+        checksums and passed to the sink before being dropped from the
+        buffer.
+
+        """
+        fields = message._sorted_fields
+        offsets = layout.offsets(message)
+        payload_start = offsets[layout.streamed_index]
+        payload_size = fields[layout.streamed_index][1].bytes_required
+        payload_end = payload_start + payload_size
+        if self.max_frame_size is not None and frame_size - payload_size > self.max_frame_size:
+            for _ in self._drop_frame(frame_size):
+                yield None
+            return
+
+        checksums = layout.running_checksums(message, frame_size) or []
+        if len(checksums) != len([f for _name, f in fields if isinstance(f, CRCField)]):
+            raise SuitcaseParseError("The checksums of %s cannot be computed while "
+                                     "its payload is streamed" % type(message).__name__)
+
+        while self._bytes_available() < payload_start:
+            yield None
+        head = bytes(self._buffer[self._start:self._start + payload_start])
+        for checksum in checksums:
+            checksum.update(self._buffer, self._start, payload_start)
+        self._skip(payload_start)
+
+        position = payload_start  # offset within the frame of the buffer start
+        try:
+            sink = self.payload_sink(message)
+        except Exception as exc:
+            for _ in self._discard_streamed_frame(exc, frame_size - position):
+                yield None
+            return
+        while position < payload_end:
+            count = min(self._bytes_available(), payload_end - position)
+            if count:
+                frame_start = self._start - position
+                for checksum in checksums:
+                    checksum.update(self._buffer, frame_start, position + count)
+                piece = bytes(self._buffer[self._start:self._start + count])
+                self._skip(count)
+                position += count
+                try:
+                    sink(piece)
+                except Exception as exc:
+                    for _ in self._discard_streamed_frame(exc, frame_size - position):
                         yield None
-            yield curmsg
+                    return
+            if position < payload_end:
+                yield None
+
+        trailer_size = frame_size - payload_end
+        while self._bytes_available() < trailer_size:
+            yield None
+        trailer = bytes(self._buffer[self._start:self._start + trailer_size])
+        for checksum in checksums:
+            checksum.update(self._buffer, self._start - payload_end, frame_size)
+
+        try:
+            for index, (_name, field) in enumerate(fields):
+                if index < layout.header_count or index == layout.streamed_index:
+                    continue
+                offset = offsets[index]
+                if offset < payload_start:
+                    field.unpack(head[offset:offset + field.bytes_required])
+                else:
+                    offset -= payload_end
+                    field.unpack(trailer[offset:offset + field.bytes_required])
+            for checksum in checksums:
+                checksum.crc_field.check(checksum.crc)
+        except Exception as exc:
+            self._failed_payloads.append((message, exc))
+            raise
+        self._skip(trailer_size)
+        yield message
+
+    def _discard_streamed_frame(self, error, remaining):
+        """Drop the rest of a streamed frame after its sink raised ``error``"""
+        self._sink_error = error
+        self.frames_dropped += 1
+        for _ in self._discard(remaining):
+            yield None
+
+    def _complete_frame(self, message, layout, frame_size, checksums):
+        """Unpack the rest of the buffered frame, returning the packet"""
+        layout.unpack_body(message, self._buffer, self._start)
+        if checksums is not None:
+            for checksum in checksums:
+                checksum.crc_field.check(checksum.crc)
+        elif layout.crc_indexes:
+            layout.validate_checksums(message, self._buffer, self._start, frame_size)
+        return message
+
+    def _read_terminated_frame(self, message_schema, layout):
+        """Parse a frame whose end is marked by a terminating Magic
+
+        The buffer is searched for the terminator with ``find``, resuming
+        from where the previous search stopped, so each byte received is
+        only searched once however the frame is fragmented.
+
+        """
+        terminator = layout.terminator
+        # offsets from the start of the frame, which stay valid when the
+        # buffer is compacted or grown
+        search_from = layout.header_size
+        while True:
+            idx = self._buffer.find(terminator, self._start + search_from, self._end)
+            if idx != -1:
+                break
+            available = self._bytes_available()
+            if self.max_frame_size is not None and available > self.max_frame_size:
+                # the terminator has not been found within the largest frame
+                for _ in self._drop_frame(available):
+                    yield None
+                return
+            # the end of the buffer might hold the start of the terminator
+            search_from = max(search_from, available - len(terminator) + 1)
+            yield None
+
+        frame_size = idx - self._start + len(terminator) + layout.trailer_size
+        if self.max_frame_size is not None and frame_size > self.max_frame_size:
+            for _ in self._drop_frame(frame_size):
+                yield None
+            return
+        while self._bytes_available() < frame_size:
+            yield None
+
+        curmsg = message_schema()
+        curmsg.unpack(bytes(self._buffer[self._start:self._start + frame_size]))
+        self._skip(frame_size)
+        yield curmsg
+
+    def _read_frame_incrementally(self, message_schema):
+        """Parse a frame of any schema, resuming where parsing left off
+
+        The bytes of a frame are kept in the buffer until the whole frame
+        has been parsed, so checksums can be validated at the end.
+
+        """
+        parser = StreamParser(message_schema)
+        max_frame_size = self.max_frame_size
+        while True:
+            curmsg = parser.advance(self._buffer, self._start, self._end)
+            if max_frame_size is not None and parser.bytes_required > max_frame_size:
+                # only the part of the frame parsed so far is known
+                for _ in self._drop_frame(parser.bytes_required):
+                    yield None
+                return
+            if curmsg is not None:
+                break
+            while self._bytes_available() < parser.bytes_required:
+                yield None
+        self._skip(parser.bytes_consumed)
+        yield curmsg
+
+    def _discard(self, size):
+        """Drop the next ``size`` bytes, including bytes yet to be received"""
+        while True:
+            count = min(size, self._bytes_available())
+            self._skip(count)
+            self.bytes_dropped += count
+            size -= count
+            if size == 0:
+                return
+            yield None
+
+    def _drop_frame(self, frame_size):
+        """Apply the overflow policy to a frame larger than max_frame_size"""
+        self.overflows += 1
+        if self.overflow_policy == OVERFLOW_RAISE:
+            raise SuitcaseBufferOverflowError(
+                "Frame of %d bytes exceeds the maximum frame size of %d bytes"
+                % (frame_size, self.max_frame_size))
+        self.frames_dropped += 1
+        if self.overflow_policy == OVERFLOW_RESYNC:
+            self._skip(1)
+            self.bytes_dropped += 1
+        else:
+            for _ in self._discard(frame_size):
+                yield None
 
     def feed(self, new_bytes):
         """Feed a new set of bytes into the protocol handler
@@ -121,31 +987,173 @@ class StreamProtocolHandler(object):
             handler.
 
         """
-        self._available_bytes += new_bytes
-        callbacks = []
-        try:
+        self._append(new_bytes)
+        self.process()
+
+    def get_buffer(self, min_size=-1):
+        """Return a writable buffer for the next bytes of the stream
+
+        Together with :meth:`buffer_updated` this allows data to be read
+        directly into the handler's buffer, without allocating an
+        intermediate bytes object for each read::
+
             while True:
-                packet = six.next(self._packet_generator)
-                if packet is None:
+                nbytes = sock.recv_into(protocol_handler.get_buffer())
+                if nbytes == 0:
                     break
-                else:
-                    callbacks.append(partial(self.packet_callback, packet))
-        except Exception:
-            # When we receive an exception, we assume that the _available_bytes
-            # has already been updated and we just choked on a field.  That
-            # is, unless the number of _available_bytes has not changed.  In
-            # that case, we reset the buffered entirely
-
-            # TODO: black hole may not be the best.  What should the logging
-            # behavior be?
+                protocol_handler.buffer_updated(nbytes)
+
+        This follows the same protocol as :class:`asyncio.BufferedProtocol`.
+        No other bytes may be fed to the handler until
+        :meth:`buffer_updated` has been called.
+
+        :param min_size: The minimum size of the returned buffer.  If
+            negative, a buffer of a reasonable size is returned.
+        :returns: A writable memoryview with at least ``min_size`` bytes.
+
+        """
+        self._reserve(max(min_size, self._MIN_READ_SIZE))
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """Process ``nbytes`` bytes written to the last :meth:`get_buffer`
+
+        Packets are parsed and ``packet_callback`` executed as for
+        :meth:`feed`.
+
+        """
+        if not 0 <= nbytes <= len(self._buffer) - self._end:
+            raise ValueError("buffer_updated(%d) exceeds the buffer returned by "
+                             "get_buffer()" % (nbytes,))
+        self._end += nbytes
+        self.process()
+
+    def process(self, max_frames=None):
+        """Parse bytes already in the buffer, executing callbacks for new packets
+
+        This is what :meth:`feed` does after buffering its bytes.  Calling
+        it directly is useful when a previous call stopped early because
+        of its frame budget, for instance to parse the remaining frames on
+        the next turn of an event loop.
+
+        Exceptions raised by ``packet_callback`` (or ``batch_callback``) are
+        propagated to the caller and do not affect the state of the parser;
+        packets which were parsed but not yet delivered are delivered by
+        the next call.
+        Parse errors on the other hand are never propagated (with the
+        exception of :class:`~suitcase.exceptions.SuitcaseBufferOverflowError`).
+
+        :param max_frames: The maximum number of packets to parse.
+            Defaults to ``max_frames_per_feed``.
+        :returns: The number of packets parsed.
+
+        """
+        if max_frames is None:
+            max_frames = self.max_frames_per_feed
+        count = 0
+        error = None
+        budget_spent = False
+        while True:
+            if max_frames is not None and count >= max_frames:
+                # the rest of the buffer is left for the next call
+                budget_spent = True
+                break
+            try:
+                packet = six.next(self._packet_generator)
+            except SuitcaseBufferOverflowError as exc:
+                self.reset()
+                error = exc
+                break
+            except Exception:
+                if self.resync_on_error and self._bytes_available():
+                    # the failed frame is still buffered, look for another
+                    # frame starting after its first byte
+                    self.resyncs += 1
+                    self._skip_to(self._start + 1)
+                    self._packet_generator = self._create_packet_generator()
+                    continue
+
+                # When we receive an exception, we assume that the buffered bytes
+                # have already been updated and we just choked on a field.  That
+                # is, unless the number of buffered bytes has not changed.  In
+                # that case, we reset the buffered entirely
+
+                # TODO: black hole may not be the best.  What should the logging
+                # behavior be?
+                self.reset()
+                break
+            if packet is None:
+                break
+            count += 1
+            self.frames_received += 1
+            if not self._undelivered:
+                self._batch_started = _clock()
+            self._undelivered.append(packet)
+            if self.immediate_delivery:
+                self._deliver(final=False)
+
+        if (error is None and not budget_spent and self.max_buffer_size is not None and
+                self._bytes_available() > self.max_buffer_size):
+            error = self._buffer_overflow()
+
+        # Callbacks are executed outside of the parsing activity (and its
+        # error handling).  Callbacks should not in any way rely on the
+        # parsers position in the byte stream.
+        self._deliver()
+        while self._failed_payloads:
+            message, exc = self._failed_payloads.popleft()
+            if self.payload_error_callback is not None:
+                self.payload_error_callback(message, exc)
+
+        sink_error, self._sink_error = self._sink_error, None
+        if error is None:
+            error = sink_error
+        if error is not None:
+            raise error
+        return count
+
+    def flush(self):
+        """Deliver all parsed packets, including those held back for a batch"""
+        self._deliver(final=True, force=True)
+
+    def _batch_ready(self, final):
+        if self.batch_size is not None and len(self._undelivered) >= self.batch_size:
+            return True
+        if self.batch_interval is not None:
+            return _clock() - self._batch_started >= self.batch_interval
+        return final and self.batch_size is None
+
+    def _deliver(self, final=True, force=False):
+        undelivered = self._undelivered
+        if self.batch_callback is None:
+            while undelivered:
+                self.packet_callback(undelivered.popleft())
+            return
+
+        while undelivered and (force or self._batch_ready(final)):
+            count = len(undelivered)
+            if self.batch_size is not None:
+                count = min(self.batch_size, count)
+            batch = [undelivered.popleft() for _ in range(count)]
+            self._batch_started = _clock()
+            self.batch_callback(batch)
+
+    def _buffer_overflow(self):
+        """Apply the overflow policy to bytes exceeding max_buffer_size"""
+        self.overflows += 1
+        if self.overflow_policy == OVERFLOW_RAISE:
+            pending = self._bytes_available()
             self.reset()
+            return SuitcaseBufferOverflowError(
+                "%d bytes buffered exceeds the maximum of %d bytes"
+                % (pending, self.max_buffer_size))
 
-        # callbacks are partials that are bound to packet already.  We do
-        # this in order to separate out parsing activity (and error handling)
-        # from the execution of callbacks.  Callbacks should not in any way
-        # rely on the parsers position in the byte stream.
-        for callback in callbacks:
-            callback()
+        excess = self._bytes_available() - self.max_buffer_size
+        if excess > 0:
+            self._skip(excess)
+            self.bytes_dropped += excess
+            self._packet_generator = self._create_packet_generator()
+        return None
 
     def reset(self):
         """Reset the internal state machine to a fresh state
@@ -158,4 +1166,504 @@ class StreamProtocolHandler(object):
 
         """
         self._packet_generator = self._create_packet_generator()
-        self._available_bytes = b""
+        self._buffer = bytearray()
+        self._start = self._end = 0
+
+
+class RawFrame(tuple):
+    """The bytes of a frame and its dispatch key, as found by a :class:`StreamFramer`
+
+    This is a ``(data, dispatch_key)`` tuple.  For frames selected for
+    sampling, ``message`` holds the decoded message (otherwise None).
+
+    """
+
+    def __new__(cls, data, dispatch_key, message=None):
+        frame = tuple.__new__(cls, (data, dispatch_key))
+        frame.message = message
+        return frame
+
+    def __repr__(self):
+        return "RawFrame(%r, %r)" % self
+
+    data = property(operator.itemgetter(0))
+    dispatch_key = property(operator.itemgetter(1))
+
+
+class StreamFramer(StreamProtocolHandler):
+    """Split a stream into frames without decoding them
+
+    Frames are found using the framing fields of the schema (its leading
+    Magic, the header up to its LengthFields and its CRCFields) but only
+    the header is parsed.  ``frame_callback`` is executed with a
+    :class:`RawFrame` for each frame, a ``(data, dispatch_key)`` tuple
+    holding the bytes of the frame and the value of the schema's
+    DispatchField (or None if it has none)::
+
+        def frame_received(frame):
+            data, dispatch_key = frame
+            forward(dispatch_key, data)
+
+        framer = StreamFramer(MySchema, frame_received, sample_interval=100)
+
+    This is only possible for schemas where the size of a frame is known
+    once its header has been received.
+
+    :param message_schema: The schema of the frames.
+    :param frame_callback: A callback executed with each :class:`RawFrame`.
+    :param validate_crc: If False, checksums are not validated.
+    :param sample_interval: If specified, one in ``sample_interval`` frames
+        is fully decoded, available as the ``message`` of its RawFrame.
+
+    The remaining parameters are those of :class:`StreamProtocolHandler`.
+
+    """
+
+    def __init__(self, message_schema, frame_callback=None, validate_crc=True,
+                 sample_interval=None, **kwargs):
+        StreamProtocolHandler.__init__(self, message_schema, frame_callback, **kwargs)
+        if not isinstance(self._frame_layout, _FrameLayout):
+            raise SuitcaseProgrammingError(
+                "The size of a %s frame cannot be determined from its header"
+                % message_schema.__name__)
+        self.validate_crc = validate_crc
+        self.sample_interval = sample_interval
+        self._running_checksums = validate_crc
+        self._frames_until_sample = sample_interval
+        # the frames are not decoded, so a single message is reused for the
+        # fields the framer unpacks: the header, checksums and DispatchField
+        self._message = message_schema()
+        self._dispatch_index = None
+        for index, (_name, field) in enumerate(self._message):
+            if isinstance(field, DispatchField):
+                self._dispatch_index = index
+                break
+
+    def _header_message(self, message_schema):
+        if self.payload_sink is not None:
+            # the message of a streamed frame is handed to its sink
+            return message_schema()
+        return self._message
+
+    def _complete_frame(self, message, layout, frame_size, checksums):
+        data = bytes(self._buffer[self._start:self._start + frame_size])
+        offsets = None
+        if self.validate_crc and checksums is None and layout.crc_indexes:
+            for field, offset, _start, _end in layout.checksum_regions(message, frame_size):
+                field.unpack(data[offset:offset + field.bytes_required])
+            layout.validate_checksums(message, self._buffer, self._start, frame_size)
+        elif checksums is not None:
+            for checksum in checksums:
+                crc_field = checksum.crc_field
+                offset = checksum.crc_offset
+                crc_field.unpack(data[offset:offset + crc_field.bytes_required])
+                crc_field.check(checksum.crc, data)
+
+        dispatch_key = None
+        index = self._dispatch_index
+        if index is not None:
+            field = message._sorted_fields[index][1]
+            if index >= layout.header_count:
+                if offsets is None:
+                    offsets = layout.offsets(message)
+                field.unpack(data[offsets[index]:offsets[index] + field.bytes_required])
+            dispatch_key = field.getval()
+
+        sample = None
+        if self.sample_interval is not None:
+            self._frames_until_sample -= 1
+            if self._frames_until_sample == 0:
+                self._frames_until_sample = self.sample_interval
+                sample = self.message_schema.from_data(data)
+        return RawFrame(data, dispatch_key, sample)
+
+
+class MultiSchemaProtocolHandler(StreamProtocolHandler):
+    """Protocol handler for a stream carrying messages of several schemas
+
+    Each schema must start with a :class:`~suitcase.fields.Magic` field,
+    which identifies the schema of each frame in the stream::
+
+        handler = MultiSchemaProtocolHandler([StatusFrame, DataFrame],
+                                             packet_received)
+
+    The leading Magic sequences of all schemas are searched for at once
+    using a single compiled regular expression, so each byte of the
+    stream is only examined once to find the next frame of any of the
+    schemas.  Where one sequence is a prefix of another, the longest
+    matching sequence wins.
+
+    :param message_schemas: A sequence of schemas, each starting with a
+        distinct Magic field.
+
+    The remaining parameters are those of :class:`StreamProtocolHandler`.
+
+    """
+
+    def __init__(self, message_schemas, packet_callback=None, **kwargs):
+        self.message_schemas = list(message_schemas)
+        if not self.message_schemas:
+            raise SuitcaseProgrammingError("At least one message schema is required")
+
+        self._schemas_by_magic = {}
+        for message_schema in self.message_schemas:
+            magic = _leading_magic(message_schema)
+            if magic is None:
+                raise SuitcaseProgrammingError("%s does not start with a Magic field"
+                                               % message_schema.__name__)
+            if magic in self._schemas_by_magic:
+                raise SuitcaseProgrammingError("%s and %s share the Magic sequence %r" % (
+                    self._schemas_by_magic[magic][0].__name__,
+                    message_schema.__name__, magic))
+            self._schemas_by_magic[magic] = (message_schema,
+                                             _frame_layout(message_schema))
+
+        magics = sorted(self._schemas_by_magic, key=len, reverse=True)
+        self._magic_pattern = re.compile(b"|".join(re.escape(magic) for magic in magics))
+        self._magics = magics
+        self._longest_magic = len(magics[0])
+        # the longer sequences starting with each sequence, longest first
+        self._extensions = dict(
+            (magic, [other for other in magics
+                     if len(other) > len(magic) and other.startswith(magic)])
+            for magic in magics)
+        StreamProtocolHandler.__init__(self, self.message_schemas[0],
+                                       packet_callback, **kwargs)
+
+    def _message_schemas(self):
+        return self.message_schemas
+
+    def _derived_max_frame_size(self):
+        sizes = [layout and layout.max_frame_size
+                 for _schema, layout in self._schemas_by_magic.values()]
+        if None in sizes:
+            return None
+        return max(sizes)
+
+    def _synchronize_any(self):
+        """Discard bytes until the buffer starts with one of the Magic sequences
+
+        This yields None while waiting for more bytes, followed by the
+        sequence found.
+
+        """
+        while True:
+            match = self._magic_pattern.search(self._buffer, self._start, self._end)
+            if match is None:
+                # keep the bytes which could be the start of a sequence
+                self._skip_to(max(self._start, self._end - (self._longest_magic - 1)))
+                yield None
+                continue
+
+            if self._partial_magic_before(match.start()):
+                # the match may be inside a longer sequence which started
+                # before it but has not been received in full
+                yield None
+                continue
+
+            self._skip_to(match.start())
+            magic = bytes(match.group())  # a bytearray on Python 2
+            extensions = self._extensions[magic]
+            if extensions:
+                # only as many bytes as the longest extension are compared
+                end = min(self._end, self._start + len(extensions[0]))
+                received = bytes(self._buffer[self._start:end])
+                if any(len(received) < len(other) and other.startswith(received)
+                       for other in extensions):
+                    # a longer sequence might start here
+                    yield None
+                    continue
+            yield magic
+            return
+
+    def _partial_magic_before(self, position):
+        """True if a sequence starting before ``position`` is cut off by the buffer end"""
+        for start in range(max(self._start, position - (self._longest_magic - 1)), position):
+            end = min(self._end, start + self._longest_magic)
+            received = bytes(self._buffer[start:end])
+            if any(len(received) < len(magic) and magic.startswith(received)
+                   for magic in self._magics):
+                return True
+        return False
+
+    def _create_packet_generator(self):
+        while True:
+            for magic in self._synchronize_any():
+                if magic is None:
+                    yield None
+
+            message_schema, layout = self._schemas_by_magic[magic]
+            for curmsg in self._read_frame(message_schema, layout):
+                yield curmsg
+
+
+class FrameWriter(object):
+    """Coalesce outgoing frames into fewer, larger writes
+
+    This is the sending counterpart of :class:`StreamProtocolHandler`.
+    Rather than writing each frame as it is produced, frames are packed
+    into a reusable buffer which is written out once it holds
+    ``flush_size`` bytes, once its oldest frame has waited for
+    ``flush_interval`` seconds or when :meth:`flush` is called::
+
+        writer = FrameWriter(sock.sendall, flush_interval=0.005)
+        for reading in readings:
+            writer.write(reading)
+        writer.flush()
+
+    ``write`` is called with a memoryview of the buffer, which must not be
+    used once ``write`` returns (``sendall`` and the ``write`` method of
+    files are fine).  Frames larger than ``flush_size`` are written on
+    their own without being copied into the buffer.  See
+    :class:`suitcase.aio.TransportFrameWriter` for asyncio transports.
+
+    The writer counts the frames and bytes written (``frames_written`` and
+    ``bytes_written``), the calls made to ``write`` (``writes``) and the
+    time frames spent waiting in the buffer (``total_latency`` and
+    ``max_latency``, in seconds).
+
+    :param write: A function called with the bytes of one or more whole
+        frames.
+    :param flush_size: The number of buffered bytes at which the buffer
+        is written out.
+    :param flush_interval: If specified, the longest time in seconds a
+        frame may wait in the buffer.  This is checked when frames are
+        written and by :meth:`poll`.
+
+    """
+
+    def __init__(self, write, flush_size=65536, flush_interval=None):
+        self.write_function = write
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        # counters
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.writes = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        # internal state.  Frames waiting to be written are in
+        # _buffer[:_end]; the buffer is reused after each flush.
+        self._buffer = bytearray(flush_size)
+        self._end = 0
+        self._frames_buffered = 0
+        self._oldest = None  # time the oldest buffered frame was written
+        self._total_enqueued = 0.0  # sum of the times frames were written
+
+    @property
+    def writes_saved(self):
+        """The number of writes saved by coalescing frames"""
+        return self.frames_written - self.writes
+
+    @property
+    def mean_latency(self):
+        """The mean time in seconds frames waited before being written"""
+        if not self.frames_written:
+            return 0.0
+        return self.total_latency / self.frames_written
+
+    @property
+    def bytes_buffered(self):
+        """The number of bytes waiting to be written"""
+        return self._end
+
+    def write(self, frame):
+        """Queue a frame to be written
+
+        :param frame: A :class:`~suitcase.structure.Structure` or the bytes
+            of a packed frame.
+
+        """
+        if hasattr(frame, 'pack'):
+            frame = frame.pack()
+        size = len(frame)
+        now = _clock()
+        if self._end + size > self.flush_size:
+            self.flush()
+        if size >= self.flush_size:
+            self._write(frame, 1, now, now)
+            return
+
+        self._buffer[self._end:self._end + size] = frame
+        self._end += size
+        if self._oldest is None:
+            self._oldest = now
+        self._frames_buffered += 1
+        self._total_enqueued += now
+        if self._end == self.flush_size:
+            self.flush()
+        else:
+            self.poll()
+
+    def write_many(self, frames):
+        """Queue several frames to be written"""
+        for frame in frames:
+            self.write(frame)
+
+    def poll(self):
+        """Flush the buffer if its oldest frame has waited ``flush_interval``
+
+        :returns: The number of seconds until the buffer is next due to be
+            flushed, or None if there is nothing waiting (or no
+            ``flush_interval``).  This is suitable as the timeout of a
+            ``select()`` call.
+
+        """
+        if self._oldest is None or self.flush_interval is None:
+            return None
+        remaining = self._oldest + self.flush_interval - _clock()
+        if remaining > 0:
+            return remaining
+        self.flush()
+        return None
+
+    def flush(self):
+        """Write out all of the buffered frames"""
+        if not self._end:
+            return
+        # if write() raises, the frames stay buffered
+        self._write(memoryview(self._buffer)[:self._end], self._frames_buffered,
+                    self._oldest, self._total_enqueued / self._frames_buffered)
+        self._end = 0
+        self._frames_buffered = 0
+        self._oldest = None
+        self._total_enqueued = 0.0
+
+    def _write(self, data, frame_count, oldest, mean_enqueued):
+        self.write_function(data)
+        now = _clock()
+        self.writes += 1
+        self.frames_written += frame_count
+        self.bytes_written += len(data)
+        self.total_latency += (now - mean_enqueued) * frame_count
+        self.max_latency = max(self.max_latency, now - oldest)
+
+
+class DatagramProtocolHandler(object):
+    """Protocol handler for datagrams which each hold exactly one frame
+
+    Unlike :class:`StreamProtocolHandler`, no state is kept between
+    datagrams: each datagram is unpacked as a complete message (with
+    :meth:`~suitcase.structure.Structure.unpack_from`) and a datagram
+    which cannot be unpacked is counted in ``errors`` without affecting
+    the others::
+
+        handler = DatagramProtocolHandler(Telemetry, packet_received)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', 5000))
+        while True:
+            handler.receive(sock)
+
+    :meth:`receive` reads a batch of datagrams from a socket into a pool
+    of preallocated buffers; :meth:`feed` takes a datagram received by
+    other means.  See :class:`suitcase.aio.DatagramFrameProtocol` for
+    asyncio.
+
+    :param message_schema: The schema of the messages in the datagrams.
+    :param packet_callback: A callback to be executed with the form
+        ``callback(packet, address)`` for each message, where ``address``
+        is the address the datagram was received from (or the address
+        passed to :meth:`feed`).
+    :param error_callback: If specified, a callback executed with the form
+        ``callback(datagram, address, exception)`` for each datagram
+        which cannot be unpacked.
+    :param batch_size: The largest number of datagrams read by a call to
+        :meth:`receive`, which is also the number of buffers in its pool.
+    :param max_datagram_size: The size of each buffer in the pool.
+
+    The handler counts the messages unpacked (``frames_received``), the
+    datagrams which could not be unpacked (``errors``) and the bytes of
+    all datagrams (``bytes_received``).
+
+    """
+
+    def __init__(self, message_schema, packet_callback=None, error_callback=None,
+                 batch_size=64, max_datagram_size=65535):
+        self.message_schema = message_schema
+        self.packet_callback = packet_callback
+        self.error_callback = error_callback
+        self.batch_size = batch_size
+        self.max_datagram_size = max_datagram_size
+
+        # counters
+        self.frames_received = 0
+        self.errors = 0
+        self.bytes_received = 0
+
+        # one more byte than the largest datagram so truncation is detected
+        self._pool = [bytearray(max_datagram_size + 1) for _ in range(batch_size)]
+
+    def _unpack(self, buffer, size, address, packets):
+        self.bytes_received += size
+        message = self.message_schema()
+        try:
+            if size > self.max_datagram_size:
+                raise SuitcaseParseError("Datagram of more than %d bytes"
+                                         % self.max_datagram_size)
+            message.unpack_from(buffer, 0, size)
+        except Exception as exc:
+            self.errors += 1
+            if self.error_callback is not None:
+                self.error_callback(bytes(buffer[:size]), address, exc)
+            return
+        self.frames_received += 1
+        packets.append((message, address))
+
+    def _deliver(self, packets):
+        # as for StreamProtocolHandler, callbacks are executed after parsing
+        for message, address in packets:
+            self.packet_callback(message, address)
+
+    def feed(self, datagram, address=None):
+        """Unpack a datagram, executing the callback if it holds a message"""
+        packets = []
+        self._unpack(datagram, len(datagram), address, packets)
+        self._deliver(packets)
+
+    def feed_many(self, datagrams):
+        """Unpack several datagrams given as ``(datagram, address)`` pairs"""
+        packets = []
+        for datagram, address in datagrams:
+            self._unpack(datagram, len(datagram), address, packets)
+        self._deliver(packets)
+
+    def receive(self, sock):
+        """Receive and unpack a batch of datagrams from ``sock``
+
+        The first datagram is received as the socket is configured (so
+        this blocks on a blocking socket).  Up to ``batch_size - 1`` more
+        datagrams are then received without blocking, much like
+        ``recvmmsg()``.  Each datagram is received directly into a buffer
+        of the pool and unpacked from there.  Only one datagram is
+        received at a time from a socket with a timeout.
+
+        :returns: The number of datagrams received.
+
+        """
+        received = []
+        error = None
+        flags = 0
+        # with a timeout, the socket would wait for each datagram
+        timeout = sock.gettimeout()
+        batch = timeout == 0.0 or (timeout is None and _MSG_DONTWAIT)
+        for buffer in self._pool:
+            try:
+                size, address = sock.recvfrom_into(buffer, 0, flags)
+            except socket.error as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    error = exc  # raised once the datagrams received are handled
+                break
+            received.append((buffer, size, address))
+            if not batch:
+                break
+            flags = _MSG_DONTWAIT if timeout is None else 0
+
+        packets = []
+        for buffer, size, address in received:
+            self._unpack(buffer, size, address, packets)
+        self._deliver(packets)
+        if error is not None:
+            raise error
+        return len(received)
@@ -9,7 +9,7 @@ import six
 from suitcase.exceptions import SuitcaseException, \
     SuitcasePackException, SuitcaseParseError
 from suitcase.fields import FieldArray, FieldPlaceholder, CRCField, SubstructureField, \
-    ConditionalField, FieldAccessor, FieldProperty
+    ConditionalField, FieldAccessor, FieldProperty, LengthField, Payload
 from six import BytesIO
 
 
@@ -17,12 +17,55 @@ class ParseError(Exception):
     """Exception raised when there is an error parsing"""
 
 
+def _memoryview(obj):
+    """Return a memoryview of ``obj``
+
+    On Python 2, objects such as mmap only have the old buffer interface;
+    a memoryview is then made of a buffer object over them.
+
+    """
+    try:
+        return memoryview(obj)
+    except TypeError:
+        if not six.PY2:
+            raise
+        return memoryview(buffer(obj))  # noqa: F821 (Python 2 builtin)
+
+
 class Packer(object):
     """Object responsible for packing/unpacking bytes into/from fields"""
 
-    def __init__(self, ordered_fields, crc_field):
+    def __init__(self, ordered_fields, crc_field, field_kinds=None):
         self.crc_field = crc_field
         self.ordered_fields = ordered_fields
+        if field_kinds is None:
+            field_kinds = self.field_kinds(ordered_fields)
+        conditional_indexes, derived_length_indexes = field_kinds
+        self.conditional_fields = [ordered_fields[i][1] for i in conditional_indexes]
+        self.derived_length_fields = [ordered_fields[i][1] for i in derived_length_indexes]
+
+    @staticmethod
+    def field_kinds(ordered_fields):
+        """Return the indexes of the conditional and derived length fields"""
+        return ([i for i, (_name, field) in enumerate(ordered_fields)
+                 if isinstance(field, ConditionalField)],
+                [i for i, (_name, field) in enumerate(ordered_fields)
+                 if isinstance(field, LengthField) and field.is_derived])
+
+    def invalidate_conditions(self, changed_field=None):
+        """Discard remembered ConditionalField results affected by a change"""
+        for field in self.conditional_fields:
+            field.invalidate(changed_field)
+
+    def _begin_pass(self):
+        # conditions are evaluated once per pack/unpack and remembered
+        # until its end
+        for field in self.conditional_fields:
+            field.begin_pass()
+
+    def _end_pass(self):
+        for field in self.conditional_fields:
+            field.end_pass()
 
     def pack(self):
         # type: () -> bytes
@@ -32,25 +75,24 @@ class Packer(object):
 
     def write(self, stream):
         # type: (BytesIO) -> None
+        self._begin_pass()
+        try:
+            self._write(stream)
+        finally:
+            self._end_pass()
+
+    def _write(self, stream):
+        self._prepare_pack()
+
         # now, pack everything in
         crc_fields = []
         for name, field in self.ordered_fields:
-            try:
-                if isinstance(field, CRCField):
-                    crc_offset = stream.tell()
-                    field.pack(stream)
-                    crc_fields.append((field, crc_offset))
-                else:
-                    field.pack(stream)
-            except SuitcaseException:
-                raise  # just reraise the same exception object
-            except Exception:
-                # keep the original traceback information, see
-                # http://stackoverflow.com/questions/3847503/wrapping-exceptions-in-python
-                exc_type = SuitcasePackException
-                _, exc_value, exc_traceback = sys.exc_info()
-                exc_value = exc_type("Unexpected exception during pack of %r: %s" % (name, str(exc_value)))
-                six.reraise(exc_type, exc_value, exc_traceback)
+            if isinstance(field, CRCField):
+                crc_offset = stream.tell()
+                self._pack_field(name, field, stream)
+                crc_fields.append((field, crc_offset))
+            else:
+                self._pack_field(name, field, stream)
 
         # if there is a crc value, seek back to the field and
         # pack it with the right value
@@ -61,10 +103,76 @@ class Packer(object):
                 checksum_data = self.crc_field.packed_checksum(data)
                 stream.write(checksum_data)
 
-    def unpack(self, data, trailing=False):
-        # type: (bytes, bool) -> BytesIO
+    def pack_parts(self):
+        # type: () -> List[bytes]
+        """Pack into a list of buffers without copying top-level payloads
+
+        The value of each top-level :class:`~suitcase.fields.Payload` is
+        included in the list as is (for instance a memoryview), between
+        the packed bytes of the fields before and after it.  Checksums
+        are computed over the parts without joining them.
+
+        """
+        self._begin_pass()
+        try:
+            return self._pack_parts()
+        finally:
+            self._end_pass()
+
+    def _pack_parts(self):
+        self._prepare_pack()
+
+        parts = []
+        crc_fields = []
+        stream = BytesIO()
+        for name, field in self.ordered_fields:
+            if isinstance(field, Payload) and field.getval() is not None:
+                data = stream.getvalue()
+                if data:
+                    parts.append(data)
+                if len(field.getval()):
+                    parts.append(field.getval())
+                stream = BytesIO()
+                continue
+            if isinstance(field, CRCField):
+                crc_fields.append((field, len(parts), stream.tell()))
+            self._pack_field(name, field, stream)
+        data = stream.getvalue()
+        if data:
+            parts.append(data)
+
+        for field, index, crc_offset in crc_fields:
+            checksum_data = field.pack_checksum(field.checksum_parts(parts))
+            part = parts[index]
+            parts[index] = b''.join((part[:crc_offset], checksum_data,
+                                     part[crc_offset + len(checksum_data):]))
+        return parts
+
+    def _prepare_pack(self):
+        # lengths derived from other fields must be in place before those
+        # fields are packed
+        for field in self.derived_length_fields:
+            field.update_length()
+        if self.derived_length_fields:
+            self.invalidate_conditions()
+
+    def _pack_field(self, name, field, stream):
+        try:
+            field.pack(stream)
+        except SuitcaseException:
+            raise  # just reraise the same exception object
+        except Exception:
+            # keep the original traceback information, see
+            # http://stackoverflow.com/questions/3847503/wrapping-exceptions-in-python
+            exc_type = SuitcasePackException
+            _, exc_value, exc_traceback = sys.exc_info()
+            exc_value = exc_type("Unexpected exception during pack of %r: %s" % (name, str(exc_value)))
+            six.reraise(exc_type, exc_value, exc_traceback)
+
+    def unpack(self, data, trailing=False, validate_crc=True):
+        # type: (bytes, bool, bool) -> BytesIO
         stream = BytesIO(data)
-        self.unpack_stream(stream)
+        self.unpack_stream(stream, validate_crc)
         stream.tell()
         if trailing:
             return stream
@@ -74,8 +182,79 @@ class Packer(object):
                                      (stream.tell(), len(data)))
         return stream
 
-    def unpack_stream(self, stream):
-        # type: (BytesIO) -> None
+    def unpack_from(self, buffer, offset=0, size=None, validate_crc=True):
+        # type: (bytes, int, int, bool) -> int
+        """Unpack from ``buffer[offset:offset + size]`` without copying it first
+
+        Fields are unpacked in order from slices of a memoryview of the
+        buffer.  Messages with greedy or nested fields are unpacked with
+        :meth:`unpack` from a copy of the data instead.
+
+        :returns: The number of bytes unpacked.
+
+        """
+        self._begin_pass()
+        try:
+            return self._unpack_from(buffer, offset, size, validate_crc)
+        finally:
+            self._end_pass()
+
+    def _unpack_from(self, buffer, offset, size, validate_crc):
+        view = _memoryview(buffer)[offset:]
+        if size is not None:
+            view = view[:size]
+        try:
+            return self._unpack_view(view, validate_crc)
+        finally:
+            # release the buffer now rather than when the traceback of an
+            # error is freed, so that e.g. a mmap can be closed while
+            # handling the error (Python 2 memoryviews have no release())
+            if hasattr(view, 'release'):
+                view.release()
+
+    def _unpack_view(self, view, validate_crc):
+        length = len(view)
+
+        crc_fields = []
+        position = 0
+        for name, field in self.ordered_fields:
+            field_size = field.bytes_required
+            if field_size is None or field.is_substructure():
+                self.unpack(view.tobytes(), validate_crc=validate_crc)
+                return length
+            if position + field_size > length:
+                raise SuitcaseParseError("While attempting to parse field "
+                                         "%r we tried to read %s bytes but "
+                                         "we were only able to read %s." %
+                                         (name, field_size, length - position))
+            if isinstance(field, CRCField):
+                crc_fields.append((field, position))
+            try:
+                field.unpack(view[position:position + field_size].tobytes())
+            except SuitcaseException:
+                raise  # just re-raise these
+            except Exception:
+                exc_type = SuitcaseParseError
+                _, exc_value, exc_traceback = sys.exc_info()
+                exc_value = exc_type("Unexpected exception while unpacking field %r: %s" % (name, str(exc_value)))
+                six.reraise(exc_type, exc_value, exc_traceback)
+            position += field_size
+
+        if position != length:
+            raise SuitcaseParseError("Structure fully parsed but additional bytes remained.  Parsing "
+                                     "consumed %d of %d bytes" % (position, length))
+        if validate_crc:
+            for crc_field, crc_offset in crc_fields:
+                start, end, _step = slice(crc_field.start, crc_field.end).indices(length)
+                if end <= crc_offset or crc_offset + crc_field.bytes_required <= start:
+                    # the checksum does not cover itself
+                    crc_field.check(crc_field.algo(view[start:end]))
+                else:
+                    crc_field.validate(view.tobytes(), crc_offset)
+        return length
+
+    def unpack_stream(self, stream, validate_crc=True):
+        # type: (BytesIO, bool) -> None
         """Unpack bytes from a stream of data field-by-field
 
         In the most basic case, the basic algorithm here is as follows::
@@ -90,9 +269,18 @@ class Packer(object):
         greedy field (bytes_required returns None) in the stream is to
         pivot and parse the remaining fields starting from the last and
         moving through the stream backwards.  There is also some special
-        logic present for dealing with checksum fields.
+        logic present for dealing with checksum fields, which are validated
+        once all fields have been unpacked unless ``validate_crc`` is False
+        (when the caller validates them by other means).
 
         """
+        self._begin_pass()
+        try:
+            self._unpack_stream(stream, validate_crc)
+        finally:
+            self._end_pass()
+
+    def _unpack_stream(self, stream, validate_crc):
         crc_fields = []
         greedy_field = None
         greedy_field_name = None
@@ -178,7 +366,7 @@ class Packer(object):
             greedy_data_chunk = inverted_stream.read()[::-1]
             greedy_field.unpack(greedy_data_chunk)
 
-        if crc_fields:
+        if crc_fields and validate_crc:
             data = stream.getvalue()
             for (crc_field, offset) in crc_fields:
                 crc_field.validate(data, offset)
@@ -308,20 +496,33 @@ class Structure(object):
         return m
 
     def __init__(self, **kwargs):
-        self._key_to_field = {}
-        self._parent = None
-        self._sorted_fields = []
-        self._placeholder_to_field = {}
-        if self.__class__._crc_field is None:
-            self._crc_field = None
+        cls = self.__class__
+        key_to_field = {}
+        sorted_fields = []
+        placeholder_to_field = {}
+        # set directly as __setattr__ looks for fields first
+        attributes = self.__dict__
+        attributes['_key_to_field'] = key_to_field
+        attributes['_parent'] = None
+        attributes['_sorted_fields'] = sorted_fields
+        attributes['_placeholder_to_field'] = placeholder_to_field
+        attributes['_dependent_fields'] = []  # populated by DependentField instances
+        if cls._crc_field is None:
+            attributes['_crc_field'] = None
         else:
-            self._crc_field = self.__class__._crc_field.create_instance(self)
-        for key, field_placeholder in self.__class__._sorted_fields:
+            attributes['_crc_field'] = cls._crc_field.create_instance(self)
+        for key, field_placeholder in cls._sorted_fields:
             field = field_placeholder.create_instance(self)
-            self._key_to_field[key] = field
-            self._placeholder_to_field[field_placeholder] = field
-            self._sorted_fields.append((key, field))
-        self._packer = Packer(self._sorted_fields, self._crc_field)
+            key_to_field[key] = field
+            placeholder_to_field[field_placeholder] = field
+            sorted_fields.append((key, field))
+        # the kinds of fields the packer tracks are the same for every
+        # message of a class, so they are only found once
+        field_kinds = cls.__dict__.get('_field_kinds')
+        if field_kinds is None:
+            field_kinds = Packer.field_kinds(sorted_fields)
+            cls._field_kinds = field_kinds
+        attributes['_packer'] = Packer(sorted_fields, self._crc_field, field_kinds)
         for key, value in kwargs.items():
             setattr(self, key, value)
 
@@ -336,7 +537,9 @@ class Structure(object):
         k2f = self.__dict__.get('_key_to_field', {})
         if key in k2f:
             field = self._key_to_field[key]
-            return field.setval(value)
+            result = field.setval(value)
+            self._packer.invalidate_conditions(field)
+            return result
         return object.__setattr__(self, key, value)
 
     def __dir__(self):
@@ -353,20 +556,79 @@ class Structure(object):
         return output
 
     def lookup_field_by_name(self, name):
-        for fname, field in self:
-            if name == fname:
-                return field
-        raise KeyError
+        return self._key_to_field[name]
 
     def lookup_field_by_placeholder(self, placeholder):
         return self._placeholder_to_field[placeholder]
 
+    def bind_parent(self, parent):
+        """Attach this message to the message containing it
+
+        Any DependentField within this message is resolved against the
+        parent right away so that later accesses are direct.
+
+        """
+        self._parent = parent
+        for field in self._dependent_fields:
+            field.bind(parent)
+
+    def invalidate_conditions(self, changed_field=None):
+        """Discard remembered ConditionalField results in this message
+
+        Results are only remembered during a pack or unpack, and are
+        discarded automatically whenever a field is assigned to through
+        the message (or a bit within a BitField is set).  This only needs
+        to be called directly if, during a pass, a condition relies on
+        state that suitcase does not see changing.
+
+        :param changed_field: The field which has changed or None if all
+            remembered results should be discarded.
+
+        """
+        self._packer.invalidate_conditions(changed_field)
+
     def unpack(self, data, trailing=False):
         # type: (bytes, bool) -> BytesIO
         # If we asked to unpack while leaving any trailing bytes,
         # make sure to specify it's okay for there to be trailing bytes.
         return self._packer.unpack(data, trailing=trailing)
 
+    def unpack_from(self, buffer, offset=0, size=None):
+        # type: (bytes, int, int) -> int
+        """Unpack the message from part of a larger buffer
+
+        This is equivalent to ``unpack(buffer[offset:offset + size])``
+        but, for messages without greedy or nested fields, avoids copying
+        the data before it is unpacked.  ``buffer`` may be any bytes-like
+        object (for instance a bytearray reused for each datagram
+        received).  The message does not keep a reference to it.
+
+        :param buffer: The bytes-like object holding the message.
+        :param offset: The offset of the message in ``buffer``.
+        :param size: The size of the message.  By default the message
+            extends to the end of ``buffer``.
+        :returns: The number of bytes unpacked.
+
+        """
+        return self._packer.unpack_from(buffer, offset, size)
+
     def pack(self):
         # type: () -> bytes
         return self._packer.pack()
+
+    def pack_parts(self):
+        # type: () -> List[bytes]
+        """Pack the message into a list of buffers for vectored I/O
+
+        This avoids copying large payloads.  The value of each top-level
+        Payload field (which may be a memoryview) is included in the list
+        as is, surrounded by the packed bytes of the other fields, so the
+        list can be passed directly to ``socket.sendmsg()`` or
+        ``os.writev()``::
+
+            sock.sendmsg(message.pack_parts())
+
+        ``b''.join(message.pack_parts())`` is equal to ``message.pack()``.
+
+        """
+        return self._packer.pack_parts()
@@ -0,0 +1,177 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+import sys
+import unittest
+
+if sys.version_info < (3, 7):
+    raise unittest.SkipTest("suitcase.aio requires Python 3.7+")
+
+import asyncio
+
+from suitcase.aio import BufferedFrameProtocol, DatagramFrameProtocol, FrameProtocol, \
+    TransportFrameWriter, frames
+from suitcase.test.test_protocol import ChecksummedFrame, PointList, Point, RadioFrame
+
+
+def _stream(count):
+    return b''.join(ChecksummedFrame(sequence=i, payload=b'x' * i).pack()
+                    for i in range(count))
+
+
+class TestAsyncio(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.close()
+            self.run_async(self.server.wait_closed())
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 5))
+
+    def serve(self, data, chunk_size=7):
+        """Start a loopback server writing ``data`` to each client"""
+        async def handle(reader, writer):
+            for i in range(0, len(data), chunk_size):
+                writer.write(data[i:i + chunk_size])
+                await writer.drain()
+            writer.close()
+
+        self.server = self.run_async(asyncio.start_server(handle, '127.0.0.1', 0))
+        return self.server.sockets[0].getsockname()[:2]
+
+    def collect(self, iterator):
+        messages = []
+        while True:
+            try:
+                messages.append(self.run_async(iterator.__anext__()))
+            except StopAsyncIteration:
+                return messages
+
+    def connect(self, protocol_factory, address):
+        _, protocol = self.run_async(
+            self.loop.create_connection(protocol_factory, *address))
+        return protocol
+
+    def test_frames_from_stream_reader(self):
+        address = self.serve(_stream(50))
+        reader, writer = self.run_async(asyncio.open_connection(*address))
+        messages = self.collect(frames(reader, ChecksummedFrame, read_size=16))
+        writer.close()
+        self.assertEqual([m.sequence for m in messages], list(range(50)))
+
+    def test_protocol(self):
+        address = self.serve(_stream(50))
+        protocol = self.connect(lambda: FrameProtocol(ChecksummedFrame), address)
+        messages = self.collect(protocol.__aiter__())
+        self.assertEqual([m.payload for m in messages],
+                         [b'x' * i for i in range(50)])
+
+    def test_buffered_protocol(self):
+        m = PointList()
+        m.origin = Point(x=1, y=2)
+        m.body = Point(x=3, y=4)
+        address = self.serve(m.pack() * 20, chunk_size=3)
+        protocol = self.connect(lambda: BufferedFrameProtocol(PointList), address)
+        messages = self.collect(protocol)
+        self.assertEqual([msg.body.y for msg in messages], [4] * 20)
+
+    def test_backpressure(self):
+        address = self.serve(_stream(200), chunk_size=4096)
+        protocol = self.connect(
+            lambda: BufferedFrameProtocol(ChecksummedFrame, max_queue=4), address)
+
+        async def wait_for_pause():
+            while not protocol._paused:
+                await asyncio.sleep(0.001)
+
+        self.run_async(wait_for_pause())
+        self.assertTrue(protocol.transport.is_reading() is False)
+        messages = self.collect(protocol)
+        self.assertEqual(len(messages), 200)
+        self.assertFalse(protocol._paused)
+
+    def test_datagram_protocol(self):
+        async def exchange():
+            loop = asyncio.get_running_loop()
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: DatagramFrameProtocol(RadioFrame), local_addr=('127.0.0.1', 0))
+            sender, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=transport.get_extra_info('sockname'))
+            sender.sendto(b'junk')
+            for i in range(10):
+                sender.sendto(RadioFrame(sequence=i, payload=b'x').pack())
+            received = []
+            async for message, address in protocol:
+                received.append(message.sequence)
+                if len(received) == 9:
+                    break
+            sender.close()
+            transport.close()
+            return received, protocol.handler.errors
+
+        received, errors = self.run_async(exchange())
+        self.assertEqual(received, list(range(9)))
+        self.assertEqual(errors, 1)
+
+
+class RecordingTransport(asyncio.Transport):
+    def __init__(self):
+        asyncio.Transport.__init__(self)
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class TestTransportFrameWriter(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.transport = RecordingTransport()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_coalesce_loop_iteration(self):
+        writer = TransportFrameWriter(self.transport)
+
+        async def produce():
+            for i in range(10):
+                writer.write(ChecksummedFrame(sequence=i, payload=b'x'))
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            writer.write(b'raw')
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+
+        self.loop.run_until_complete(produce())
+        self.assertEqual(len(self.transport.written), 2)
+        self.assertEqual(self.transport.written[0], b''.join(
+            ChecksummedFrame(sequence=i, payload=b'x').pack() for i in range(10)))
+        self.assertEqual(self.transport.written[1], b'raw')
+        self.assertEqual(writer.writes_saved, 9)
+
+    def test_flush_interval(self):
+        writer = TransportFrameWriter(self.transport, flush_interval=0.01)
+
+        async def produce():
+            writer.write(b'a')
+            await asyncio.sleep(0)
+            writer.write(b'b')
+            self.assertEqual(self.transport.written, [])
+            await asyncio.sleep(0.05)
+
+        self.loop.run_until_complete(produce())
+        self.assertEqual(self.transport.written, [b'ab'])
+        self.assertTrue(writer.max_latency >= 0.01)
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,7 @@
 
 import unittest
 
-from suitcase.crc import crc16_ccitt, crc32, crc16_kermit
+from suitcase.crc import crc16_ccitt, crc32, crc16_kermit, RESUMABLE_ALGORITHMS
 
 
 class TestCRC16CCITT(unittest.TestCase):
@@ -27,5 +27,22 @@ class TestCRC32(unittest.TestCase):
         self.assertEqual(crc, 0xE79AA9C2)
 
 
+class TestResumable(unittest.TestCase):
+    def test_continuation(self):
+        data = b"Hello, world" * 10
+        for algo in RESUMABLE_ALGORITHMS:
+            crc = 0
+            for i in range(0, len(data), 7):
+                crc = algo(bytearray(data[i:i + 7]), crc)
+            self.assertEqual(crc, algo(data))
+
+    def test_buffers(self):
+        data = b"Hello, world"
+        for algo in RESUMABLE_ALGORITHMS:
+            self.assertEqual(algo(bytearray(data)), algo(data))
+            self.assertEqual(algo(memoryview(data)), algo(data))
+            self.assertEqual(algo(bytearray(data)[3:]), algo(data[3:]))
+
+
 if __name__ == '__main__':
     unittest.main()
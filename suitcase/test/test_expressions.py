@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+import unittest
+
+from suitcase.exceptions import SuitcaseProgrammingError
+from suitcase.expressions import Expression, FieldReference
+from suitcase.fields import BitField, BitBool, BitNum, ConditionalField, \
+    LengthField, Payload, UBInt8, UBInt16
+from suitcase.structure import Structure
+
+
+class ExtendedHeader(Structure):
+    hdr = BitField(8, version=BitNum(4), ihl=BitNum(4))
+    flags = BitField(8, has_ext=BitBool(), priority=BitNum(7))
+    ext = ConditionalField(UBInt16(), flags.has_ext == 1)
+    urgent = ConditionalField(UBInt8(),
+                              (flags.has_ext == 1) & (flags.priority > 3))
+    options_length = LengthField(hdr.ihl * 4 - 20)
+    options = Payload(options_length)
+
+
+class Counted(Structure):
+    count = UBInt8()
+    items_length = LengthField(count * 2)
+    items = Payload(items_length)
+
+
+class TestExpressionConstruction(unittest.TestCase):
+    def test_operators_build_expressions(self):
+        expr = ExtendedHeader._field_placeholders['hdr'].ihl * 4 - 20
+        self.assertIsInstance(expr, Expression)
+        self.assertEqual(expr.evaluate_with(lambda placeholder: 6), 4)
+
+    def test_division(self):
+        count = Counted._field_placeholders['count']
+        # Python 2 uses __div__ for "/" without true division enabled
+        for expr in (count / 4, count.__div__(4), 12 / count, count.__rdiv__(12)):
+            self.assertIsInstance(expr, Expression)
+        self.assertEqual(count.__div__(4).evaluate_with(lambda p: 6), 1.5)
+        self.assertEqual(count.__rdiv__(12).evaluate_with(lambda p: 8), 1.5)
+        self.assertEqual((count // 4).evaluate_with(lambda p: 6), 1)
+
+    def test_references(self):
+        flags = ExtendedHeader._field_placeholders['flags']
+        expr = (flags.has_ext == 1) & (flags.priority > flags.has_ext)
+        self.assertEqual(len(expr.references()), 2)
+
+    def test_evaluate_with_columns(self):
+        count = Counted._field_placeholders['count']
+        expr = count * 2 + 1
+        columns = {count: [1, 2, 3]}
+        self.assertEqual(
+            [expr.evaluate_with(lambda p: value) for value in columns[count]],
+            [3, 5, 7])
+
+    def test_placeholders_remain_usable_in_containers(self):
+        placeholders = Counted._field_placeholders
+        count = placeholders['count']
+        items = placeholders['items']
+        self.assertTrue(count in [count])
+        self.assertFalse(count in [items])
+        self.assertTrue(count != items)
+        self.assertEqual({count: 1}[count], 1)
+
+    def test_ordering_comparison_has_no_truth_value(self):
+        count = Counted._field_placeholders['count']
+        self.assertRaises(TypeError, bool, count < 3)
+
+    def test_solve(self):
+        count = Counted._field_placeholders['count']
+        self.assertEqual((count * 2 + 1).solve(9), (count, 4))
+        self.assertEqual((10 - count).solve(3), (count, 7))
+        self.assertEqual((count << 2).solve(8), (count, 2))
+        self.assertRaises(SuitcaseProgrammingError, (count * 2).solve, 3)
+        self.assertRaises(SuitcaseProgrammingError, (count * count).solve, 4)
+
+    def test_repr(self):
+        hdr = ExtendedHeader._field_placeholders['hdr']
+        self.assertEqual(repr(hdr.ihl * 4), "(<BitField #%d>.ihl * 4)"
+                         % hdr._field_seqno)
+        self.assertIsInstance(FieldReference(hdr), Expression)
+
+
+class TestExpressionFields(unittest.TestCase):
+    def test_conditional_unpack(self):
+        m = ExtendedHeader.from_data(b'\x45\x00')
+        self.assertEqual(m.ext, None)
+        self.assertEqual(m.urgent, None)
+        self.assertEqual(m.options, b'')
+
+        m = ExtendedHeader.from_data(b'\x45\x81\x12\x34')
+        self.assertEqual(m.ext, 0x1234)
+        self.assertEqual(m.urgent, None)
+
+        m = ExtendedHeader.from_data(b'\x46\x84\x12\x34\x07abcd')
+        self.assertEqual(m.ext, 0x1234)
+        self.assertEqual(m.urgent, 7)
+        self.assertEqual(m.options_length, 4)
+        self.assertEqual(m.options, b'abcd')
+
+    def test_pack_solves_length(self):
+        m = ExtendedHeader()
+        m.hdr.version = 4
+        m.flags.has_ext = True
+        m.flags.priority = 1
+        m.ext = 0x1234
+        m.options = b'12345678'
+        self.assertEqual(m.pack(), b'\x47\x81\x12\x34' + b'12345678')
+        self.assertEqual(m.hdr.ihl, 7)
+
+    def test_pack_without_integral_solution(self):
+        m = ExtendedHeader()
+        m.hdr.version = 4
+        m.options = b'123'
+        self.assertRaises(SuitcaseProgrammingError, m.pack)
+
+    def test_plain_field_reference(self):
+        m = Counted(items=b'abcdef')
+        self.assertEqual(m.pack(), b'\x03abcdef')
+        self.assertEqual(Counted.from_data(b'\x02abcd').items, b'abcd')
+
+    def test_conditions_track_referenced_fields(self):
+        m = ExtendedHeader.from_data(b'\x45\x00')
+        m.flags.has_ext = True
+        m.ext = 0x0102
+        self.assertEqual(m.ext, 0x0102)
+        self.assertEqual(m.pack(), b'\x45\x80\x01\x02')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,13 @@
 #
 # Copyright (c) 2019 Digi International Inc. All Rights Reserved.
 
+import copy
 import unittest
 
 import six
 from suitcase.crc import crc16_ccitt, crc32
 from suitcase.exceptions import SuitcaseProgrammingError, SuitcasePackStructException, SuitcasePackException, \
-    SuitcaseParseError, SuitcaseException
+    SuitcaseParseError, SuitcaseException, SuitcaseChecksumException
 from suitcase.fields import DependentField, LengthField, VariableRawPayload, \
     Magic, BitField, BitBool, BitNum, DispatchTarget, CRCField, Payload, \
     UBInt8, UBInt16, UBInt24, UBInt32, UBInt40, UBInt48, UBInt56, UBInt64, \
@@ -797,6 +798,112 @@ class TestConditionalField(unittest.TestCase):
         self.assertEqual(m3.f3.b2, 0x44)
 
 
+class CountingCondition(object):
+    """Condition recording how many times it has been evaluated"""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.calls = 0
+
+    def __call__(self, message):
+        self.calls += 1
+        return self.fn(message)
+
+
+class TestConditionalFieldMemoization(unittest.TestCase):
+    def _make_message(self, with_dependencies=False):
+        condition = CountingCondition(lambda m: m.flags.ext)
+
+        class FlaggedMessage(Structure):
+            flags = BitField(8, ext=BitBool(), other=BitNum(7))
+            seq = UBInt8()
+            ext = ConditionalField(UBInt16(), condition,
+                                   depends_on=[flags] if with_dependencies else None)
+
+        return FlaggedMessage(), condition
+
+    def test_single_evaluation_per_unpack(self):
+        m, condition = self._make_message()
+        m.unpack(b'\x80\x01\x12\x34')
+        self.assertEqual(condition.calls, 1)
+        self.assertEqual(m.ext, 0x1234)
+
+    def test_single_evaluation_per_pack(self):
+        m, condition = self._make_message()
+        m.flags.ext = True
+        m.seq = 1
+        m.ext = 0x1234
+        self.assertEqual(m.pack(), b'\x80\x01\x12\x34')
+        self.assertEqual(condition.calls, 1)
+
+    def test_evaluated_outside_pass(self):
+        m, condition = self._make_message()
+        m.unpack(b'\x00\x01')
+        self.assertEqual(m.ext, None)
+        repr(m)
+        self.assertEqual(condition.calls, 3)
+
+    def test_invalidated_by_bitfield_assignment(self):
+        m, condition = self._make_message()
+        m.unpack(b'\x80\x01\x12\x34')
+        m.flags.ext = False
+        self.assertEqual(m.ext, None)
+        self.assertEqual(m.pack(), b'\x00\x01')
+
+    def test_depends_on(self):
+        m, condition = self._make_message(with_dependencies=True)
+        field = m._key_to_field['ext']
+        field.begin_pass()
+        try:
+            self.assertFalse(field.is_included())
+            m.seq = 2
+            self.assertFalse(field.is_included())
+            self.assertEqual(condition.calls, 1)
+            m.flags.ext = True
+            self.assertTrue(field.is_included())
+            self.assertEqual(condition.calls, 2)
+        finally:
+            field.end_pass()
+
+    def test_nested_change_in_place(self):
+        class Inner(Structure):
+            x = UBInt8()
+
+        class Outer(Structure):
+            inner = SubstructureField(Inner)
+            opt = ConditionalField(UBInt8(), lambda m: m.inner.x)
+
+        o = Outer.from_data(b'\x01\x05')
+        self.assertEqual(o.opt, 5)
+        o.inner.x = 0
+        self.assertEqual(o.opt, None)
+        self.assertEqual(o.pack(), b'\x00')
+
+    def test_list_change_in_place(self):
+        class Element(Structure):
+            value = UBInt8()
+
+        class WithItems(Structure):
+            count = LengthField(UBInt8())
+            items = FieldArray(Element, count)
+            opt = ConditionalField(UBInt8(), lambda m: len(m.items) > 1)
+
+        a = WithItems.from_data(b'\x01\x07')
+        self.assertEqual(a.opt, None)
+        a.items.append(Element(value=8))
+        a.opt = 9
+        self.assertEqual(a.opt, 9)
+        self.assertEqual(a.pack(), b'\x02\x07\x08\x09')
+
+
+class VectoredFrame(Structure):
+    soh = Magic(b'\x01')
+    length = LengthField(UBInt16())
+    payload = Payload(length)
+    crc = CRCField(UBInt32(), crc32, 0, -5)
+    eof = Magic(b'\x04')
+
+
 class TestStructure(unittest.TestCase):
     def test_unpack_fewer_bytes_than_required(self):
         self.assertRaises(SuitcaseParseError, MySimpleFixedPayload.from_data, b'123')
@@ -804,6 +911,56 @@ class TestStructure(unittest.TestCase):
     def test_unpack_more_bytes_than_required(self):
         self.assertRaises(SuitcaseParseError, MySimpleFixedPayload.from_data, b'12345')
 
+    def test_unpack_from(self):
+        data = VectoredFrame(payload=b'payload').pack()
+        buffer = bytearray(b'..' + data + b'..')
+        m = VectoredFrame()
+        self.assertEqual(m.unpack_from(buffer, 2, len(data)), len(data))
+        self.assertEqual(m.payload, b'payload')
+        buffer[:] = b'\x00' * len(buffer)  # no reference to the buffer is kept
+        self.assertEqual(m.payload, b'payload')
+
+        self.assertRaises(SuitcaseParseError, m.unpack_from, buffer, 2, len(data))
+        self.assertRaises(SuitcaseParseError, m.unpack_from, data + b'.')
+        self.assertRaises(SuitcaseChecksumException, m.unpack_from,
+                          data[:-2] + b'\x00\x04')
+
+    def test_unpack_from_greedy(self):
+        m = ConditionalArrayGreedyAfter()
+        m.unpack_from(b'..\x01\x00tail', 2)
+        self.assertEqual(m.greedy, b'tail')
+
+    def test_copy_partial_message(self):
+        m = VectoredFrame()
+        self.assertEqual(copy.copy(m).payload, None)
+        m.payload = b'abc'
+        self.assertEqual(copy.copy(m).payload, b'abc')
+
+    def test_pack_parts(self):
+        payload = bytearray(b'x' * 1000)
+        m = VectoredFrame(payload=memoryview(payload))
+        parts = m.pack_parts()
+        self.assertEqual(len(parts), 3)
+        data = b''.join(bytes(bytearray(part)) for part in parts)
+        self.assertEqual(data, VectoredFrame(payload=bytes(payload)).pack())
+        self.assertEqual(VectoredFrame.from_data(data).payload, payload)
+        # the payload is not copied
+        payload[0:1] = b'y'
+        self.assertEqual(parts[1][0:1].tobytes(), b'y')
+
+    def test_pack_parts_unresumable_checksum(self):
+        class Frame(Structure):
+            length = LengthField(UBInt8())
+            payload = Payload(length)
+            crc = CRCField(UBInt16(), lambda data: len(data), 0, -2)
+
+        m = Frame(payload=b'abc')
+        self.assertEqual(m.pack_parts(), [b'\x03', b'abc', b'\x00\x04'])
+
+    def test_pack_parts_without_payload(self):
+        m = MySimpleFixedPayload(number=5)
+        self.assertEqual(m.pack_parts(), [m.pack()])
+
 
 # Test FieldArray and ConditionalField interaction
 class ConditionalArrayElement(Structure):
@@ -1447,6 +1604,46 @@ class TestSubstructureWithDependentField(unittest.TestCase):
         self.assertEqual(structure.length, 13)
 
 
+class TestDependentFieldBinding(unittest.TestCase):
+    def test_lookup_field_by_name(self):
+        m = BasicMessage()
+        self.assertIs(m.lookup_field_by_name('b2'),
+                      m._key_to_field['b2'])
+        self.assertRaises(KeyError, m.lookup_field_by_name, 'missing')
+
+    def test_resolved_when_dispatched(self):
+        s = SuperMessage()
+        child = SuperChild()
+        s.submessage = child
+        self.assertIs(child._key_to_field['options'].parent_field,
+                      s._key_to_field['options'])
+        self.assertIs(child._key_to_field['ubseq'].parent_field,
+                      s._key_to_field['ubseq'])
+
+    def test_rebound_to_new_parent(self):
+        s1 = SuperMessage()
+        s2 = SuperMessage()
+        child = SuperChild()
+        s1.submessage = child
+        s2.submessage = child
+        s2.ubseq = (1, 2, 3)
+        self.assertEqual(child.ubseq, (1, 2, 3))
+
+    def test_attributes_forwarded_to_bound_field(self):
+        s = SuperMessage()
+        child = SuperChild()
+        s.submessage = child
+        dependent = child._key_to_field['options']
+        s.lookup_field_by_name = None  # no lookups once bound
+        self.assertEqual(dependent.number_bits, 8)
+        self.assertFalse(hasattr(dependent, '__deepcopy__'))
+
+    def test_resolved_in_substructure(self):
+        structure = SubstructureWithDependentField.from_data(b"\x00\x02Hi")
+        dependent, = structure.sub._dependent_fields
+        self.assertIs(dependent.parent_field, structure._key_to_field['length'])
+
+
 class MultipleGreedyFields(Structure):
     # TODO: Ideally we could do this particular example?
     payload1 = Payload()
@@ -0,0 +1,210 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+import unittest
+
+import six
+
+from suitcase.exceptions import SuitcaseParseError
+from suitcase.fields import Magic, UBInt8, UBInt16, LengthField, Payload
+from suitcase.framing import ByteStuffing, SLIPFraming, HDLCFraming, \
+    COBSFraming, DelimitedFraming, Deframer, UnescapingStream, HDLC_ESCAPING, XBEE_ESCAPING, \
+    cobs_encode, cobs_decode
+from suitcase.protocol import StreamProtocolHandler
+from suitcase.structure import Structure
+
+
+class XBeeFrame(Structure):
+    start = Magic(b'\x7e')
+    length = LengthField(UBInt16())
+    data = Payload(length)
+
+
+class Reading(Structure):
+    sensor = UBInt8()
+    value = UBInt16()
+
+
+RESERVED = b'\x00\x11\x13\x7d\x7e\xc0\xdb\xdc\xdd'
+
+
+class TestByteStuffing(unittest.TestCase):
+    def test_hdlc(self):
+        self.assertEqual(HDLC_ESCAPING.escape(b'a\x7eb\x7dc'),
+                         b'a\x7d\x5eb\x7d\x5dc')
+        self.assertEqual(HDLC_ESCAPING.unescape(b'a\x7d\x5eb\x7d\x5dc'),
+                         b'a\x7eb\x7dc')
+
+    def test_xbee(self):
+        # example from the XBee documentation
+        self.assertEqual(XBEE_ESCAPING.escape(b'\x7e\x00\x02\x23\x11\xcb'),
+                         b'\x7d\x5e\x00\x02\x23\x7d\x31\xcb')
+
+    def test_round_trip(self):
+        data = bytes(bytearray(range(256))) * 2 + RESERVED * 3
+        for stuffing in (HDLC_ESCAPING, XBEE_ESCAPING):
+            self.assertEqual(stuffing.unescape(stuffing.escape(data)), data)
+
+    def test_escaped_escapes(self):
+        # the escape byte followed by what would unescape to a reserved byte
+        data = b'\x7d\x5e\x7d\x5d\x5e'
+        self.assertEqual(HDLC_ESCAPING.unescape(HDLC_ESCAPING.escape(data)), data)
+
+    def test_invalid_escape(self):
+        self.assertRaises(SuitcaseParseError, HDLC_ESCAPING.unescape, b'a\x7d\x41')
+        self.assertRaises(SuitcaseParseError, HDLC_ESCAPING.unescape, b'a\x7d')
+        self.assertRaises(SuitcaseParseError, HDLC_ESCAPING.unescape,
+                          b'\x7d\x7d\x5e')
+
+    def test_escape_must_be_reserved(self):
+        self.assertRaises(ValueError, ByteStuffing, b'\x7d', {b'\x7e': b'\x5e'})
+
+
+class TestCOBS(unittest.TestCase):
+    def test_examples(self):
+        # examples from the COBS paper / Wikipedia
+        examples = [
+            (b'', b'\x01'),
+            (b'\x00', b'\x01\x01'),
+            (b'\x00\x00', b'\x01\x01\x01'),
+            (b'\x11\x22\x00\x33', b'\x03\x11\x22\x02\x33'),
+            (b'\x11\x22\x33\x44', b'\x05\x11\x22\x33\x44'),
+            (b'\x11\x00\x00\x00', b'\x02\x11\x01\x01\x01'),
+        ]
+        for data, encoded in examples:
+            self.assertEqual(cobs_encode(data), encoded)
+            self.assertEqual(cobs_decode(encoded), data)
+
+    def test_long_blocks(self):
+        data = bytes(bytearray(range(1, 256)))
+        for size in (253, 254, 255, 508, 600):
+            block = (data * 3)[:size]
+            for candidate in (block, block + b'\x00', b'\x00' + block,
+                              block + b'\x00' + block):
+                encoded = cobs_encode(candidate)
+                self.assertNotIn(b'\x00', encoded)
+                self.assertEqual(cobs_decode(encoded), candidate)
+        self.assertEqual(cobs_encode(data[:254]), b'\xff' + data[:254])
+
+    def test_invalid(self):
+        self.assertRaises(SuitcaseParseError, cobs_decode, b'\x05\x11\x22')
+        self.assertRaises(SuitcaseParseError, cobs_decode, b'\x03\x11\x00')
+
+
+class TestDelimitedFraming(unittest.TestCase):
+    def test_slip(self):
+        framing = SLIPFraming()
+        self.assertEqual(framing.encode(b'a\xc0b\xdbc'),
+                         b'a\xdb\xdcb\xdb\xddc\xc0')
+        self.assertEqual(SLIPFraming(leading_end=True).encode(b'a'),
+                         b'\xc0a\xc0')
+        self.assertEqual(framing.decode(b'a\xdb\xdcb\xdb\xddc'), b'a\xc0b\xdbc')
+        self.assertRaises(SuitcaseParseError, framing.decode, b'\xdb\xc1')
+
+    def test_hdlc(self):
+        framing = HDLCFraming()
+        self.assertEqual(framing.encode(b'\x01\x7e'), b'\x7e\x01\x7d\x5e\x7e')
+
+    def test_pack(self):
+        framing = COBSFraming()
+        reading = Reading(sensor=0, value=0x1100)
+        self.assertEqual(framing.pack(reading), b'\x01\x02\x11\x01\x00')
+
+
+class TestDeframer(unittest.TestCase):
+    def setUp(self):
+        self.frames = []
+
+    def test_byte_at_a_time(self):
+        data = [b'', b'\xc0', RESERVED * 2, b'x' * 300]
+        for framing in (SLIPFraming(), SLIPFraming(leading_end=True),
+                        HDLCFraming(), COBSFraming()):
+            self.frames = []
+            deframer = Deframer(framing, self.frames.append)
+            stream = b''.join(framing.encode(d) for d in data)
+            for byte in six.iterbytes(stream):
+                deframer.feed(six.int2byte(byte))
+            # empty frames cannot be told apart from idle delimiters,
+            # except for COBS where an empty frame is encoded as b'\x01'
+            expected = data if isinstance(framing, COBSFraming) else data[1:]
+            self.assertEqual(self.frames, expected)
+            self.assertEqual(deframer.frames_received, len(expected))
+
+    def test_multibyte_delimiter(self):
+        class LineFraming(DelimitedFraming):
+            delimiter = b'\r\n'
+
+            def encode(self, data):
+                return data + self.delimiter
+
+            def decode(self, frame):
+                return frame
+
+        framing = LineFraming()
+        lines = [b'first', b'a\rb', b'x' * 100, b'\n']
+        stream = b''.join(framing.encode(line) for line in lines)
+        for size in (1, 2, 3, 7):
+            self.frames = []
+            deframer = Deframer(framing, self.frames.append, max_frame_size=50)
+            for offset in range(0, len(stream), size):
+                deframer.feed(stream[offset:offset + size])
+            self.assertEqual(self.frames, [b'first', b'a\rb', b'\n'])
+            self.assertEqual(deframer.errors, 1)
+
+    def test_message_schema(self):
+        framing = HDLCFraming()
+        deframer = Deframer(framing, self.frames.append, message_schema=Reading)
+        deframer.feed(framing.encode(b'\x01\x7e\x7d') +
+                      framing.encode(b'\x02\x00') +
+                      framing.encode(b'\x03\x00\x10'))
+        self.assertEqual([(m.sensor, m.value) for m in self.frames],
+                         [(1, 0x7e7d), (3, 0x10)])
+        self.assertEqual(deframer.errors, 1)
+
+    def test_invalid_frames_are_dropped(self):
+        framing = SLIPFraming()
+        deframer = Deframer(framing, self.frames.append)
+        deframer.feed(b'ab\xdbc\xc0' + framing.encode(b'ok'))
+        self.assertEqual(self.frames, [b'ok'])
+        self.assertEqual(deframer.errors, 1)
+
+    def test_max_frame_size(self):
+        framing = COBSFraming()
+        deframer = Deframer(framing, self.frames.append, max_frame_size=16)
+        stream = (framing.encode(b'a' * 8) + framing.encode(b'b' * 40) +
+                  framing.encode(b'c' * 8))
+        for offset in range(0, len(stream), 5):
+            deframer.feed(stream[offset:offset + 5])
+        self.assertEqual(self.frames, [b'a' * 8, b'c' * 8])
+        self.assertEqual(deframer.errors, 1)
+
+        deframer.feed(framing.encode(b'd' * 20))
+        self.assertEqual(deframer.errors, 2)
+
+    def test_reset(self):
+        framing = SLIPFraming()
+        deframer = Deframer(framing, self.frames.append)
+        deframer.feed(b'noise')
+        deframer.reset()
+        deframer.feed(framing.encode(b'ok'))
+        self.assertEqual(self.frames, [b'ok'])
+
+
+class TestUnescapingStream(unittest.TestCase):
+    def test_xbee_api_mode_2(self):
+        frames = []
+        handler = StreamProtocolHandler(XBeeFrame, frames.append)
+        stream = UnescapingStream(XBEE_ESCAPING, handler.feed)
+        payloads = [b'\x7e\x7d\x11\x13', b'plain', b'\x7d' * 3]
+        escaped = b''.join(
+            b'\x7e' + XBEE_ESCAPING.escape(XBeeFrame(data=p).pack()[1:])
+            for p in payloads)
+        for byte in six.iterbytes(escaped):
+            stream.feed(six.int2byte(byte))
+        self.assertEqual([f.data for f in frames], payloads)
+
+
+if __name__ == '__main__':
+    unittest.main()
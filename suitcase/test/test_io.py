@@ -0,0 +1,233 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from suitcase.exceptions import SuitcaseChecksumException, SuitcaseParseError, \
+    SuitcaseProgrammingError
+from suitcase.io import MappedFrameReader, FrameIndex, decode_parallel
+from suitcase.test.test_protocol import RadioFrame, TextLine, PointList, Point, \
+    GreedyTail
+
+
+class TestMappedFrameReader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.frames = [RadioFrame(sequence=i, payload=b'p' * (i % 7)).pack()
+                       for i in range(100)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def capture(self, data):
+        path = os.path.join(self.directory, 'capture.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_read(self):
+        path = self.capture(b''.join(self.frames))
+        with MappedFrameReader(path, RadioFrame) as reader:
+            messages = list(reader)
+            self.assertEqual(reader.frames_read, 100)
+            self.assertEqual(reader.offset, len(reader))
+        self.assertEqual([m.sequence for m in messages], list(range(100)))
+        self.assertEqual(messages[8].payload, b'p')
+
+    def test_offsets(self):
+        path = self.capture(b''.join(self.frames))
+        with MappedFrameReader(path, RadioFrame) as reader:
+            offsets = [offset for offset, _message in reader.iter_with_offsets()]
+        self.assertEqual(offsets[:3], [0, len(self.frames[0]),
+                                       len(self.frames[0]) + len(self.frames[1])])
+
+        with MappedFrameReader(path, RadioFrame, offset=offsets[50] + 1) as reader:
+            self.assertEqual(next(iter(reader)).sequence, 51)
+            self.assertEqual(reader.bytes_skipped, offsets[51] - offsets[50] - 1)
+
+    def test_resync(self):
+        frames = list(self.frames)
+        frames[10] = frames[10][:-1] + b'\x00'  # bad checksum
+        frames[20] = b'noise' + frames[20]
+        path = self.capture(b''.join(frames) + self.frames[0][:-3])
+        with MappedFrameReader(path, RadioFrame) as reader:
+            sequences = [m.sequence for m in reader]
+            self.assertEqual(reader.errors, 2)  # the checksum and the truncated frame
+        self.assertEqual(sequences, [i for i in range(100) if i != 10])
+
+        with MappedFrameReader(path, RadioFrame, resync=False) as reader:
+            self.assertRaises(SuitcaseChecksumException, list, reader)
+            self.assertEqual(reader.frames_read, 10)
+
+    def test_error_closing(self):
+        frames = list(self.frames)
+        frames[3] = frames[3][:-1] + b'\x00'  # bad checksum
+        path = self.capture(b''.join(frames))
+        # the parse error is raised, not an error unmapping the file
+        with self.assertRaises(SuitcaseChecksumException):
+            with MappedFrameReader(path, RadioFrame, resync=False) as reader:
+                list(reader)
+
+    def test_truncated(self):
+        path = self.capture(b''.join(self.frames[:3]) + self.frames[3][:-1])
+        with MappedFrameReader(path, RadioFrame, resync=False) as reader:
+            self.assertEqual(len(list(reader)), 3)
+            self.assertEqual(reader.offset, sum(len(f) for f in self.frames[:3]))
+
+    def test_terminated_frames(self):
+        path = self.capture(b''.join(TextLine(address=i, text=b'line').pack()
+                                     for i in range(10)))
+        with MappedFrameReader(path, TextLine) as reader:
+            self.assertEqual([m.address for m in reader], list(range(10)))
+
+    def test_parsed_frames(self):
+        m = PointList()
+        m.origin = Point(x=1, y=2)
+        m.body = Point(x=3, y=4)
+        path = self.capture(m.pack() * 5)
+        with MappedFrameReader(path, PointList) as reader:
+            self.assertEqual([msg.body.y for msg in reader], [4] * 5)
+
+    def test_empty_file(self):
+        with MappedFrameReader(self.capture(b''), RadioFrame) as reader:
+            self.assertEqual(list(reader), [])
+
+    def test_unsupported_schema(self):
+        path = self.capture(b'\x01ab')
+        with MappedFrameReader(path, GreedyTail) as reader:
+            self.assertRaises(SuitcaseParseError, list, reader)
+
+
+class TestFrameIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'capture.bin')
+        self.frames = [RadioFrame(sequence=i, payload=b'p' * (i % 7)).pack()
+                       for i in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def append(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+    def test_build_and_load(self):
+        self.append(b''.join(self.frames))
+        index = FrameIndex.build(self.path, RadioFrame, keys=['sequence', 'length'])
+        self.assertEqual(len(index), 200)
+        self.assertEqual(index[1], (len(self.frames[0]), len(self.frames[1]), 1, 1))
+
+        loaded = FrameIndex.load(FrameIndex.default_path(self.path))
+        self.assertEqual(loaded.keys, ['sequence', 'length'])
+        self.assertEqual(list(loaded.offsets), list(index.offsets))
+        self.assertEqual(list(loaded.key_values['length']),
+                         [i % 7 for i in range(200)])
+        self.assertEqual(os.path.getsize(FrameIndex.default_path(self.path)),
+                         len(b'SCIX\x01\x0fsequence,length') + 200 * 4 * 8)
+
+        with MappedFrameReader(self.path, RadioFrame) as reader:
+            message = reader.read(loaded.offsets[150])
+        self.assertEqual(message.sequence, 150)
+
+    def test_queries(self):
+        self.append(b''.join(self.frames))
+        index = FrameIndex.build(self.path, RadioFrame, keys=['sequence', 'length'])
+        self.assertEqual(list(index.key_range('sequence', 10, 13)), [10, 11, 12])
+        self.assertEqual(index.find('length', 6), list(range(6, 200, 7)))
+
+    def test_incremental(self):
+        self.append(b''.join(self.frames[:50]) + self.frames[50][:3])
+        index = FrameIndex.build(self.path, RadioFrame)
+        self.assertEqual(len(index), 50)
+        self.append(self.frames[50][3:] + b''.join(self.frames[51:]))
+        self.assertEqual(index.update(self.path, RadioFrame), 150)
+        self.assertEqual(index.update(self.path, RadioFrame), 0)
+
+        loaded = FrameIndex.load(FrameIndex.default_path(self.path))
+        self.assertEqual(len(loaded), 200)
+        self.assertEqual(loaded.end, os.path.getsize(self.path))
+
+
+def sequence_of(message):
+    return message.sequence
+
+
+@unittest.skipIf(sys.version_info < (3,), "decode_parallel() requires Python 3")
+class TestDecodeParallel(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'capture.bin')
+        # payloads containing the Magic sequence make synchronizing on it
+        # in the middle of the file land within frames
+        frames = [RadioFrame(sequence=i % 256, payload=b'\xa5\x5a\x00\x01' * (i % 5)).pack()
+                  for i in range(600)]
+        frames[100] = frames[100][:-1] + b'\x00'
+        frames[300] = b'noise' + frames[300]
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(frames))
+        with MappedFrameReader(self.path, RadioFrame) as reader:
+            self.expected = [m.sequence for m in reader]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_in_order(self):
+        for chunk_size in (50, 999, 1 << 20):
+            results = list(decode_parallel(self.path, RadioFrame, sequence_of,
+                                           workers=2, chunk_size=chunk_size))
+            self.assertEqual(results, self.expected)
+
+    def test_messages(self):
+        messages = list(decode_parallel(self.path, RadioFrame, workers=2,
+                                        chunk_size=1000))
+        self.assertEqual([m.sequence for m in messages], self.expected)
+
+    def test_bounded_in_flight_chunks(self):
+        import concurrent.futures
+        executor_class = concurrent.futures.ProcessPoolExecutor
+        submitted = []
+
+        class CountingExecutor(executor_class):
+            def submit(self, *args, **kwargs):
+                submitted.append(args)
+                return executor_class.submit(self, *args, **kwargs)
+
+        concurrent.futures.ProcessPoolExecutor = CountingExecutor
+        try:
+            results = decode_parallel(self.path, RadioFrame, sequence_of, workers=2,
+                                      chunk_size=50)
+            self.assertEqual(next(results), self.expected[0])
+            # chunks are submitted as results are consumed, not all at once
+            self.assertEqual(len(submitted), 5)
+            self.assertEqual([self.expected[0]] + list(results), self.expected)
+            self.assertTrue(len(submitted) > 100)
+        finally:
+            concurrent.futures.ProcessPoolExecutor = executor_class
+
+    def test_index(self):
+        index = FrameIndex.build(self.path, RadioFrame)
+        results = list(decode_parallel(self.path, RadioFrame, sequence_of, workers=2,
+                                       chunk_size=333, index=index))
+        self.assertEqual(results, self.expected)
+
+    def test_index_chunk_after_last_frame(self):
+        # the second chunk starts between the offset and the end of the last frame
+        index = FrameIndex.build(self.path, RadioFrame)
+        results = list(decode_parallel(self.path, RadioFrame, sequence_of, workers=2,
+                                       chunk_size=index.offsets[-1] + 1, index=index))
+        self.assertEqual(results, self.expected)
+
+    def test_requires_magic_or_index(self):
+        self.assertRaises(SuitcaseProgrammingError, list,
+                          decode_parallel(self.path, GreedyTail))
+
+
+if __name__ == '__main__':
+    unittest.main()
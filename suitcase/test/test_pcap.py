@@ -0,0 +1,215 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from suitcase.exceptions import SuitcaseParseError
+from suitcase.pcap import PacketReader, PcapWriter, PcapngWriter, LINKTYPE_RAW, \
+    LINKTYPE_ETHERNET
+from suitcase.test.examples.test_network_stack import UDPFrame
+
+
+def datagram(i):
+    return UDPFrame(source_port=9101, destination_port=9100 + i, checksum=0,
+                    data=b'd' * (i % 5))
+
+
+class CaptureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'capture.pcap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, writer_class, count=20, **kwargs):
+        with writer_class(self.path, LINKTYPE_RAW, **kwargs) as writer:
+            for i in range(count):
+                writer.write(datagram(i), timestamp=1500000000123456789 + i)
+        self.assertEqual(writer.packets_written, count)
+
+
+class TestPcap(CaptureTestCase):
+    def test_round_trip(self):
+        self.write(PcapWriter)
+        with PacketReader(self.path) as reader:
+            self.assertEqual(reader.format, 'pcap')
+            self.assertEqual(reader.link_type, LINKTYPE_RAW)
+            packets = list(reader)
+            self.assertEqual(reader.packets_read, 20)
+            self.assertEqual(reader.offset, os.path.getsize(self.path))
+        self.assertEqual([p.data.tobytes() for p in packets],
+                         [datagram(i).pack() for i in range(20)])
+        self.assertIsInstance(packets[0].data, memoryview)
+        # microsecond resolution
+        self.assertEqual(packets[3].timestamp, 1500000000123456000)
+        self.assertEqual(packets[3].original_length, 11)
+
+        frame = UDPFrame()
+        frame.unpack_from(packets[7].data)
+        self.assertEqual(frame.destination_port, 9107)
+        self.assertEqual(frame.data, b'dd')
+
+    def test_nanosecond(self):
+        self.write(PcapWriter, nanosecond=True)
+        with PacketReader(self.path) as reader:
+            self.assertTrue(reader.nanosecond)
+            packet = list(reader)[3]
+        self.assertEqual(packet.timestamp, 1500000000123456792)
+        self.assertAlmostEqual(packet.time, 1500000000.1234567)
+
+    def test_messages(self):
+        with PcapWriter(self.path, LINKTYPE_RAW) as writer:
+            writer.write(datagram(1).pack())
+            writer.write(b'\x00\x01')  # too short
+            writer.write(bytearray(datagram(2).pack()))
+        with PacketReader(self.path) as reader:
+            messages = [message for _packet, message in reader.messages(UDPFrame)]
+            self.assertEqual(reader.errors, 1)
+        self.assertEqual([m.destination_port for m in messages], [9101, 9102])
+
+    def test_snaplen(self):
+        self.write(PcapWriter, count=5, snaplen=9)
+        with PacketReader(self.path) as reader:
+            self.assertEqual(reader.snaplen, 9)
+            packets = list(reader)
+        self.assertEqual([len(p.data) for p in packets], [8, 9, 9, 9, 9])
+        self.assertEqual(packets[4].original_length, 12)
+        self.assertEqual(packets[4].data.tobytes(), datagram(4).pack()[:9])
+
+    def test_big_endian(self):
+        data = [struct.pack('>IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)]
+        for i in range(3):
+            data.append(struct.pack('>IIII', 1000 + i, 5, 3, 60) + b'abc')
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(data))
+        with PacketReader(self.path) as reader:
+            self.assertEqual(reader.link_type, LINKTYPE_ETHERNET)
+            packets = list(reader)
+        self.assertEqual([p.timestamp for p in packets],
+                         [1000000005000, 1001000005000, 1002000005000])
+        self.assertEqual(packets[2].original_length, 60)
+        self.assertEqual(packets[2].data.tobytes(), b'abc')
+
+    def test_truncated(self):
+        self.write(PcapWriter, count=3)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 2)
+        with PacketReader(self.path) as reader:
+            self.assertEqual(len(list(reader)), 2)
+            self.assertEqual(reader.offset, size - 16 - 10)
+
+    def test_stream(self):
+        self.write(PcapWriter, count=50)
+        with io.open(self.path, 'rb') as f:
+            # a small buffer is reused and grown while reading
+            reader = PacketReader(f, buffer_size=16)
+            packets = [p.data.tobytes() for p in reader]
+            self.assertEqual(reader.offset, os.path.getsize(self.path))
+        self.assertEqual(packets, [datagram(i).pack() for i in range(50)])
+
+    def test_not_a_capture(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x00' * 64)
+        self.assertRaises(SuitcaseParseError, PacketReader, self.path)
+        with open(self.path, 'wb'):
+            pass
+        self.assertRaises(SuitcaseParseError, PacketReader, self.path)
+        self.assertRaises(SuitcaseParseError, PacketReader,
+                          io.BytesIO(struct.pack('<I', 0xa1b2c3d4)))
+
+
+class TestPcapng(CaptureTestCase):
+    def test_round_trip(self):
+        self.write(PcapngWriter)
+        with PacketReader(self.path) as reader:
+            self.assertEqual(reader.format, 'pcapng')
+            packets = list(reader)
+            self.assertEqual(reader.offset, os.path.getsize(self.path))
+        self.assertEqual([p.data.tobytes() for p in packets],
+                         [datagram(i).pack() for i in range(20)])
+        self.assertEqual(packets[3].timestamp, 1500000000123456000)
+        self.assertEqual(packets[3].link_type, LINKTYPE_RAW)
+        self.assertEqual(UDPFrame.from_data(packets[7].data.tobytes()).data, b'dd')
+
+    def test_nanosecond(self):
+        self.write(PcapngWriter, nanosecond=True)
+        with PacketReader(self.path) as reader:
+            packet = list(reader)[3]
+        self.assertEqual(packet.timestamp, 1500000000123456792)
+
+    def test_interfaces(self):
+        with PcapngWriter(self.path, LINKTYPE_RAW) as writer:
+            ethernet = writer.add_interface(LINKTYPE_ETHERNET, snaplen=4)
+            writer.write(b'raw packet', timestamp=0)
+            writer.write(b'ethernet frame', timestamp=0, interface=ethernet)
+        with PacketReader(self.path) as reader:
+            packets = list(reader)
+        self.assertEqual([(p.interface, p.link_type, p.data.tobytes()) for p in packets],
+                         [(0, LINKTYPE_RAW, b'raw packet'),
+                          (1, LINKTYPE_ETHERNET, b'ethe')])
+        self.assertEqual(packets[1].original_length, 14)
+
+    def test_snaplen(self):
+        self.write(PcapngWriter, count=5, snaplen=9)
+        with PacketReader(self.path) as reader:
+            packets = list(reader)
+        self.assertEqual([len(p.data) for p in packets], [8, 9, 9, 9, 9])
+
+    def test_big_endian(self):
+        def block(block_type, body):
+            length = 12 + len(body)
+            return struct.pack('>II', block_type, length) + body + struct.pack('>I', length)
+
+        data = b''.join([
+            block(0x0a0d0d0a, struct.pack('>IHHq', 0x1a2b3c4d, 1, 0, -1)),
+            # an interface with a timestamp resolution of 2^-10 seconds
+            block(1, struct.pack('>HHIHHB3xHH', 1, 0, 0, 9, 1, 0x8a, 0, 0)),
+            block(0xbad, b'skip'),  # an unknown block
+            block(6, struct.pack('>IIIII', 0, 0, 2048, 3, 3) + b'abc\x00'),
+            block(3, struct.pack('>I', 2) + b'de\x00\x00'),
+        ])
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        with PacketReader(self.path) as reader:
+            packets = list(reader)
+        self.assertEqual([(p.timestamp, p.data.tobytes()) for p in packets],
+                         [(2000000000, b'abc'), (None, b'de')])
+        self.assertEqual(packets[1].link_type, LINKTYPE_ETHERNET)
+
+    def test_truncated(self):
+        self.write(PcapngWriter, count=3)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 2)
+        with PacketReader(self.path) as reader:
+            self.assertEqual(len(list(reader)), 2)
+            self.assertEqual(reader.offset, size - 32 - 12)
+
+    def test_stream(self):
+        self.write(PcapngWriter, count=50)
+        with io.open(self.path, 'rb') as f:
+            reader = PacketReader(f, buffer_size=16)
+            packets = [p.data.tobytes() for p in reader]
+        self.assertEqual(packets, [datagram(i).pack() for i in range(50)])
+
+    def test_invalid_block(self):
+        with PcapngWriter(self.path) as writer:
+            writer.write(b'abc')
+        with open(self.path, 'r+b') as f:
+            f.seek(48 + 4)
+            f.write(struct.pack('<I', 30))
+        with PacketReader(self.path) as reader:
+            self.assertRaises(SuitcaseParseError, list, reader)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,13 +3,21 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 # Copyright (c) 2015 Digi International Inc. All Rights Reserved.
+import socket
 import unittest
 
 import six
+from suitcase import protocol
+from suitcase.crc import crc16_ccitt, crc32
 from suitcase.fields import Magic, SBInt64, DispatchField, UBInt8, DispatchTarget, \
-    LengthField
+    LengthField, UBInt16, Payload, CRCField, ConditionalField, SubstructureField, \
+    FieldArray, UBInt32, StreamedPayload
+from suitcase.exceptions import SuitcaseParseError, SuitcaseBufferOverflowError, \
+    SuitcaseProgrammingError, SuitcaseChecksumException
 from suitcase.structure import Structure
-from suitcase.protocol import StreamProtocolHandler
+from suitcase.protocol import StreamProtocolHandler, StreamParser, _FrameLayout, \
+    OVERFLOW_RAISE, OVERFLOW_DROP_OLDEST, OVERFLOW_RESYNC, MultiSchemaProtocolHandler, \
+    StreamFramer, RawFrame, FrameWriter, DatagramProtocolHandler
 from suitcase.test.examples.test_network_stack import UDPFrame
 
 
@@ -17,6 +25,10 @@ class MagicSchema(Structure):
     magic = Magic(b'\xAA\xAA')
     value = SBInt64()
 
+class ShortMagicSchema(Structure):
+    magic = Magic(b'\xAA')
+    value = SBInt64()
+
 class LongMagicSchema(Structure):
     magic = Magic(b'\xAA\xAA\xBB\xBB')
     value = SBInt64()
@@ -29,6 +41,71 @@ class ErrorCaseSchema(Structure):
     })
 
 
+class ChecksummedFrame(Structure):
+    soh = Magic(b'\x7e\x7e')
+    sequence = UBInt8()
+    length = LengthField(UBInt16())
+    payload = Payload(length)
+    crc = CRCField(UBInt16(), crc16_ccitt, 2, -3)
+    eof = Magic(b'~')
+
+
+class RadioFrame(Structure):
+    sync = Magic(b'\xA5\x5A')
+    sequence = UBInt8()
+    length = LengthField(UBInt8())
+    payload = Payload(length)
+    crc = CRCField(UBInt16(), crc16_ccitt, 2, -2)
+
+
+class OptionalTrailer(Structure):
+    length = LengthField(UBInt8())
+    payload = Payload(length)
+    flag = UBInt8()
+    trailer = ConditionalField(UBInt16(), lambda m: m.flag == 1)
+
+
+class Point(Structure):
+    x = UBInt8()
+    y = UBInt8()
+
+
+class PointList(Structure):
+    magic = Magic(b'\xAB')
+    origin = SubstructureField(Point)
+    count = LengthField(UBInt8())
+    points = FieldArray(Point, num_elements_provider=count)
+    type = DispatchField(UBInt8())
+    body = DispatchTarget(None, type, {
+        0x00: Point,
+        0x01: MagicSchema,
+    })
+    crc = CRCField(UBInt16(), crc16_ccitt, 1, -2)
+
+
+class GreedyTail(Structure):
+    length = LengthField(UBInt8())
+    payload = Payload(length)
+    tail = Payload()
+
+
+class TextLine(Structure):
+    stx = Magic(b'\x02')
+    address = UBInt8()
+    text = Payload()
+    etx = Magic(b'\x03')
+    crc = CRCField(UBInt16(), crc16_ccitt, 1, -3)
+
+
+class FirmwareImage(Structure):
+    magic = Magic(b'\xF0\x0D')
+    slot = UBInt8()
+    length = LengthField(UBInt32())
+    image = StreamedPayload(length)
+    crc = CRCField(UBInt32(), crc32, 2, -5)
+    eof = Magic(b'\x04')
+
+
 class TestStreamProtocol(unittest.TestCase):
     def test_protocol_basic(self):
         packets_received = []
@@ -158,6 +235,861 @@ class TestStreamProtocol(unittest.TestCase):
         self.assertEqual(len(rx), 1)
         self.assertEqual(rx[0].value, -29939)
 
+    def test_protocol_single_byte_magic_scan(self):
+        rx = []
+        protocol_handler = StreamProtocolHandler(ShortMagicSchema, rx.append)
+        protocol_handler.feed(b'garbage' * 1000)
+        self.assertEqual(protocol_handler._bytes_available(), 0)
+        protocol_handler.feed(ShortMagicSchema(value=7).pack())
+        self.assertEqual(len(rx), 1)
+        self.assertEqual(rx[0].value, 7)
+
+    def test_protocol_buffer_is_reused(self):
+        rx = []
+        protocol_handler = StreamProtocolHandler(MagicSchema, rx.append)
+        stream = b''.join(MagicSchema(value=i).pack() for i in range(500))
+        for i in range(0, len(stream), 7):
+            protocol_handler.feed(stream[i:i + 7])
+        self.assertEqual([p.value for p in rx], list(range(500)))
+        # consumed bytes are dropped rather than accumulating
+        self.assertTrue(len(protocol_handler._buffer) <= 4096)
+
+    def test_protocol_large_feed(self):
+        rx = []
+        protocol_handler = StreamProtocolHandler(MagicSchema, rx.append)
+        stream = b''.join(MagicSchema(value=i).pack() for i in range(5000))
+        protocol_handler.feed(stream)
+        self.assertEqual(len(rx), 5000)
+        self.assertEqual(rx[-1].value, 4999)
+        self.assertEqual(protocol_handler._bytes_available(), 0)
+
+    def test_protocol_get_buffer(self):
+        rx = []
+        protocol_handler = StreamProtocolHandler(MagicSchema, rx.append)
+        stream = b''.join(MagicSchema(value=i).pack() for i in range(1000))
+        for i in range(0, len(stream), 7):
+            chunk = stream[i:i + 7]
+            buf = protocol_handler.get_buffer(len(chunk))
+            self.assertTrue(len(buf) >= len(chunk))
+            buf[:len(chunk)] = chunk
+            protocol_handler.buffer_updated(len(chunk))
+        self.assertEqual([p.value for p in rx], list(range(1000)))
+
+    def test_protocol_get_buffer_grows_while_exported(self):
+        rx = []
+        protocol_handler = StreamProtocolHandler(MagicSchema, rx.append)
+        held = protocol_handler.get_buffer()
+        frame = MagicSchema(value=7).pack()
+        buf = protocol_handler.get_buffer(len(held) + 1)
+        buf[:len(frame)] = frame
+        protocol_handler.buffer_updated(len(frame))
+        self.assertEqual([p.value for p in rx], [7])
+        self.assertRaises(ValueError, protocol_handler.buffer_updated,
+                          len(protocol_handler.get_buffer()) + 1)
+
+    def test_protocol_recv_into(self):
+        rx = []
+        protocol_handler = StreamProtocolHandler(ChecksummedFrame, rx.append)
+        sender, receiver = socket.socketpair()
+        try:
+            for i in range(10):
+                sender.sendall(ChecksummedFrame(sequence=i, payload=b'ab').pack())
+            sender.close()
+            while True:
+                nbytes = receiver.recv_into(protocol_handler.get_buffer())
+                if nbytes == 0:
+                    break
+                protocol_handler.buffer_updated(nbytes)
+        finally:
+            receiver.close()
+        self.assertEqual([p.sequence for p in rx], list(range(10)))
+
+
+class TestFrameAtATime(unittest.TestCase):
+    def test_layout_detection(self):
+        layout = _FrameLayout.from_schema(ChecksummedFrame)
+        self.assertEqual(layout.header_count, 3)
+        self.assertEqual(layout.header_size, 5)
+        self.assertEqual(layout.sizes, [2, 1, 2, None, 2, 1])
+        self.assertEqual(_FrameLayout.from_schema(MagicSchema).header_size, 0)
+        self.assertNotEqual(_FrameLayout.from_schema(UDPFrame), None)
+        self.assertNotEqual(_FrameLayout.from_schema(ErrorCaseSchema), None)
+        self.assertEqual(_FrameLayout.from_schema(OptionalTrailer), None)
+
+    def test_fragmented_frames(self):
+        rx = []
+        phandler = StreamProtocolHandler(ChecksummedFrame, rx.append)
+        stream = b''.join(
+            ChecksummedFrame(sequence=i, payload=b'x' * i).pack()
+            for i in range(20))
+        for i in range(0, len(stream), 3):
+            phandler.feed(stream[i:i + 3])
+        self.assertEqual([p.sequence for p in rx], list(range(20)))
+        self.assertEqual(rx[-1].payload, b'x' * 19)
+
+    def test_bad_checksum_is_rejected(self):
+        rx = []
+        phandler = StreamProtocolHandler(ChecksummedFrame, rx.append)
+        frame = bytearray(ChecksummedFrame(sequence=1, payload=b'abc').pack())
+        frame[5] ^= 0xFF
+        phandler.feed(bytes(frame))
+        self.assertEqual(rx, [])
+        phandler.feed(ChecksummedFrame(sequence=2, payload=b'abc').pack())
+        self.assertEqual([p.sequence for p in rx], [2])
+
+    def test_running_checksum(self):
+        layout = _FrameLayout.from_schema(RadioFrame)
+        frame = RadioFrame.from_data(RadioFrame(sequence=1, payload=b'abc').pack())
+        checksums = layout.running_checksums(frame, 9)
+        self.assertEqual([(c.position, c.end) for c in checksums], [(2, 7)])
+
+        calls = []
+
+        def algo(data, crc=0):
+            calls.append(len(data))
+            return crc16_ccitt(data, crc)
+
+        class CountingFrame(Structure):
+            sync = Magic(b'\xA5\x5A')
+            length = LengthField(UBInt16())
+            payload = Payload(length)
+            crc = CRCField(UBInt16(), algo, 2, -2)
+
+        algorithms = protocol.RESUMABLE_ALGORITHMS
+        protocol.RESUMABLE_ALGORITHMS = algorithms + (algo,)
+        try:
+            rx = []
+            phandler = StreamProtocolHandler(CountingFrame, rx.append)
+            frame = bytearray(CountingFrame(payload=b'x' * 1000).pack())
+            del calls[:]
+            for i in range(0, len(frame), 100):
+                phandler.feed(bytes(frame[i:i + 100]))
+            self.assertEqual(len(rx), 1)
+            self.assertEqual(sum(calls), 1002)  # each byte checksummed once
+            self.assertTrue(max(calls) <= 100)
+
+            frame[500] ^= 0xFF
+            phandler.feed(bytes(frame))
+            self.assertEqual(len(rx), 1)
+        finally:
+            protocol.RESUMABLE_ALGORITHMS = algorithms
+
+    def test_checksum_over_itself_is_not_resumable(self):
+        class SelfChecksummed(Structure):
+            length = LengthField(UBInt8())
+            payload = Payload(length)
+            crc = CRCField(UBInt16(), crc16_ccitt, 0, None)
+
+        layout = _FrameLayout.from_schema(SelfChecksummed)
+        frame = SelfChecksummed(payload=b'ab')
+        frame.unpack(frame.pack())
+        self.assertEqual(layout.running_checksums(frame, 5), None)
+        rx = []
+        StreamProtocolHandler(SelfChecksummed, rx.append).feed(frame.pack())
+        self.assertEqual(len(rx), 1)
+
+    def test_field_by_field_fallback(self):
+        rx = []
+        phandler = StreamProtocolHandler(OptionalTrailer, rx.append)
+        self.assertEqual(phandler._frame_layout, None)
+        phandler.feed(b'\x02ab\x01\x12\x34\x01c\x00')
+        self.assertEqual([(p.payload, p.trailer) for p in rx],
+                         [(b'ab', 0x1234), (b'c', None)])
+
+
+class TestLimits(unittest.TestCase):
+    def _frame(self, sequence, payload_size):
+        return ChecksummedFrame(sequence=sequence, payload=b'x' * payload_size).pack()
+
+    def test_max_frame_size_from_schema(self):
+        phandler = StreamProtocolHandler(ChecksummedFrame, None)
+        self.assertEqual(phandler.max_frame_size, 8 + 0xFFFF)
+        phandler = StreamProtocolHandler(ChecksummedFrame, None, max_buffer_size=100)
+        self.assertEqual(phandler.max_frame_size, 100)
+        self.assertEqual(StreamProtocolHandler(PointList, None).max_frame_size, None)
+
+    def test_oversized_frame_raises(self):
+        rx = []
+        phandler = StreamProtocolHandler(ChecksummedFrame, rx.append, max_frame_size=64)
+        self.assertRaises(SuitcaseBufferOverflowError, phandler.feed,
+                          self._frame(1, 10) + self._frame(2, 100))
+        self.assertEqual([p.sequence for p in rx], [1])
+        self.assertEqual(phandler._bytes_available(), 0)
+        self.assertEqual(phandler.overflows, 1)
+        phandler.feed(self._frame(3, 10))
+        self.assertEqual([p.sequence for p in rx], [1, 3])
+
+    def test_oversized_frame_dropped(self):
+        rx = []
+        phandler = StreamProtocolHandler(ChecksummedFrame, rx.append, max_frame_size=64,
+                                         overflow_policy=OVERFLOW_DROP_OLDEST)
+        stream = self._frame(1, 10) + self._frame(2, 100) + self._frame(3, 10)
+        for i in range(0, len(stream), 16):
+            phandler.feed(stream[i:i + 16])
+        self.assertEqual([p.sequence for p in rx], [1, 3])
+        self.assertEqual(phandler.frames_dropped, 1)
+        self.assertEqual(phandler.bytes_dropped, 108)
+        self.assertEqual(phandler._bytes_available(), 0)
+
+    def test_oversized_frame_resync(self):
+        rx = []
+        phandler = StreamProtocolHandler(PointList, rx.append, max_frame_size=12,
+                                         overflow_policy=OVERFLOW_RESYNC)
+        small = PointList(origin=Point(x=1, y=2), body=Point(x=3, y=4)).pack()
+        large = PointList(origin=Point(x=5, y=6), body=MagicSchema(value=7)).pack()
+        phandler.feed(large + small)
+        self.assertEqual([p.origin.x for p in rx], [1])
+        self.assertEqual(phandler.overflows, 1)
+        for i in range(len(large)):
+            phandler.feed(large[i:i + 1])
+        phandler.feed(small)
+        self.assertEqual([p.origin.x for p in rx], [1, 1])
+        self.assertEqual(phandler.overflows, 2)
+
+    def test_frames_per_feed(self):
+        rx = []
+        phandler = StreamProtocolHandler(ChecksummedFrame, rx.append,
+                                         max_frames_per_feed=2)
+        phandler.feed(b''.join(self._frame(i, 3) for i in range(5)))
+        self.assertEqual(len(rx), 2)
+        phandler.feed(b'')
+        self.assertEqual(len(rx), 4)
+        phandler.feed(b'')
+        self.assertEqual([p.sequence for p in rx], list(range(5)))
+        self.assertEqual(phandler.frames_received, 5)
+
+    def test_frames_left_by_budget_are_not_an_overflow(self):
+        stream = b''.join(self._frame(i, 2) for i in range(100))  # 10 bytes each
+        for policy in (OVERFLOW_RAISE, OVERFLOW_DROP_OLDEST, OVERFLOW_RESYNC):
+            rx = []
+            phandler = StreamProtocolHandler(ChecksummedFrame, rx.append,
+                                             max_buffer_size=500, max_frames_per_feed=10,
+                                             overflow_policy=policy)
+            phandler.feed(stream)
+            self.assertEqual(len(rx), 10)
+            self.assertEqual(phandler._bytes_available(), 900)
+            while phandler.process():
+                pass
+            self.assertEqual([p.sequence for p in rx], list(range(100)))
+            self.assertEqual((phandler.overflows, phandler.bytes_dropped), (0, 0))
+
+    def test_process_buffered_frames(self):
+        rx = []
+        phandler = StreamProtocolHandler(ChecksummedFrame, rx.append,
+                                         max_frames_per_feed=1)
+        phandler.feed(b''.join(self._frame(i, 3) for i in range(5)))
+        self.assertEqual(phandler.process(max_frames=2), 2)
+        self.assertEqual(len(rx), 3)
+        self.assertEqual(phandler.process(max_frames=10), 2)
+        self.assertEqual(phandler.process(), 0)
+        self.assertEqual([p.sequence for p in rx], list(range(5)))
+
+    def test_immediate_delivery(self):
+        seen = []
+        phandler = StreamProtocolHandler(ChecksummedFrame, None, immediate_delivery=True)
+        phandler.packet_callback = lambda p: seen.append(phandler.frames_received)
+        phandler.feed(b''.join(self._frame(i, 3) for i in range(3)))
+        self.assertEqual(seen, [1, 2, 3])
+
+        del seen[:]
+        phandler.immediate_delivery = False
+        phandler.feed(b''.join(self._frame(i, 3) for i in range(3)))
+        self.assertEqual(seen, [6, 6, 6])
+
+    def test_callback_errors_are_not_parse_errors(self):
+        for immediate_delivery in (False, True):
+            rx = []
+            failed = []
+
+            def callback(packet):
+                if packet.sequence == 1 and not failed:
+                    failed.append(packet)
+                    raise RuntimeError("callback failed")
+                rx.append(packet.sequence)
+
+            phandler = StreamProtocolHandler(ChecksummedFrame, callback,
+                                             immediate_delivery=immediate_delivery)
+            stream = b''.join(self._frame(i, 3) for i in range(4))
+            self.assertRaises(RuntimeError, phandler.feed, stream[:-5])
+            phandler.feed(stream[-5:])
+            self.assertEqual(rx, [0, 2, 3])
+            self.assertEqual(len(failed), 1)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, StreamProtocolHandler, MagicSchema, None,
+                          overflow_policy='ignore')
+
+
+class TestBatchDelivery(unittest.TestCase):
+    def _stream(self, start, count):
+        return b''.join(MagicSchema(value=i).pack() for i in range(start, start + count))
+
+    def test_batch_per_feed(self):
+        batches = []
+        phandler = StreamProtocolHandler(MagicSchema, batch_callback=batches.append)
+        phandler.feed(self._stream(0, 3))
+        phandler.feed(b'')
+        phandler.feed(self._stream(3, 2))
+        self.assertEqual([[p.value for p in batch] for batch in batches],
+                         [[0, 1, 2], [3, 4]])
+
+    def test_batch_size(self):
+        batches = []
+        phandler = StreamProtocolHandler(MagicSchema, batch_callback=batches.append,
+                                         batch_size=4)
+        phandler.feed(self._stream(0, 3))
+        self.assertEqual(batches, [])
+        phandler.feed(self._stream(3, 6))
+        self.assertEqual([len(batch) for batch in batches], [4, 4])
+        phandler.flush()
+        self.assertEqual([[p.value for p in batch] for batch in batches],
+                         [[0, 1, 2, 3], [4, 5, 6, 7], [8]])
+
+    def test_batch_interval(self):
+        now = [100.0]
+        clock, protocol._clock = protocol._clock, lambda: now[0]
+        try:
+            batches = []
+            phandler = StreamProtocolHandler(MagicSchema, batch_callback=batches.append,
+                                             batch_interval=0.5, immediate_delivery=True)
+            phandler.feed(self._stream(0, 2))
+            now[0] += 0.25
+            phandler.feed(self._stream(2, 2))
+            self.assertEqual(batches, [])
+            now[0] += 0.25
+            phandler.feed(self._stream(4, 1))
+            self.assertEqual([[p.value for p in batch] for batch in batches],
+                             [[0, 1, 2, 3, 4]])
+        finally:
+            protocol._clock = clock
+
+
+def radio_frames(count, corrupt=()):
+    frames = []
+    for i in range(count):
+        frame = bytearray(RadioFrame(sequence=i, payload=b'data').pack())
+        if i in corrupt:
+            frame[5] ^= 0xFF
+        frames.append(bytes(frame))
+    return b''.join(frames)
+
+
+class TestResyncOnError(unittest.TestCase):
+    def test_default_discards_buffer(self):
+        rx = []
+        phandler = StreamProtocolHandler(RadioFrame, rx.append)
+        phandler.feed(radio_frames(5, corrupt=[1]))
+        self.assertEqual([p.sequence for p in rx], [0])
+
+    def test_bad_checksum(self):
+        rx = []
+        phandler = StreamProtocolHandler(RadioFrame, rx.append,
+                                         resync_on_error=True)
+        phandler.feed(radio_frames(5, corrupt=[1, 3]))
+        self.assertEqual([p.sequence for p in rx], [0, 2, 4])
+        self.assertEqual(phandler.resyncs, 2)
+        # the bytes of each corrupted frame were skipped
+        self.assertEqual(phandler.bytes_skipped, 2 * 10)
+        self.assertEqual(phandler._bytes_available(), 0)
+
+    def test_fragmented(self):
+        rx = []
+        phandler = StreamProtocolHandler(RadioFrame, rx.append,
+                                         resync_on_error=True)
+        stream = b'\x00' + radio_frames(6, corrupt=[0, 4])
+        for i in range(0, len(stream), 3):
+            phandler.feed(stream[i:i + 3])
+        self.assertEqual([p.sequence for p in rx], [1, 2, 3, 5])
+        self.assertEqual(phandler.bytes_skipped, 1 + 2 * 10)
+
+    def test_multi_schema(self):
+        rx = []
+        phandler = MultiSchemaProtocolHandler([RadioFrame, MagicSchema],
+                                              rx.append, resync_on_error=True)
+        phandler.feed(radio_frames(2, corrupt=[0]) + MagicSchema(value=9).pack())
+        self.assertEqual([type(p) for p in rx], [RadioFrame, MagicSchema])
+        self.assertEqual(phandler.resyncs, 1)
+
+
+class TestStreamFramer(unittest.TestCase):
+    def test_raw_frames(self):
+        rx = []
+        framer = StreamFramer(ErrorCaseSchema, rx.append)
+        frames = [ErrorCaseSchema(type=0, body=MagicSchema(value=i)).pack()
+                  for i in range(3)]
+        framer.feed(b''.join(frames))
+        self.assertEqual(rx, [(frame, 0) for frame in frames])
+        data, dispatch_key = rx[0]
+        self.assertEqual((data, dispatch_key), (frames[0], 0))
+        self.assertEqual(rx[1].data, frames[1])
+        self.assertEqual(rx[1].message, None)
+
+    def test_checksums(self):
+        rx = []
+        framer = StreamFramer(RadioFrame, rx.append, resync_on_error=True)
+        stream = radio_frames(4, corrupt=[1])
+        for i in range(0, len(stream), 3):
+            framer.feed(stream[i:i + 3])
+        self.assertEqual([data[2:3] for data, _key in rx], [b'\x00', b'\x02', b'\x03'])
+        self.assertEqual(rx[0].dispatch_key, None)
+
+        del rx[:]
+        framer = StreamFramer(ChecksummedFrame, rx.append, validate_crc=False)
+        frame = bytearray(ChecksummedFrame(sequence=1, payload=b'abc').pack())
+        frame[5] ^= 0xFF
+        framer.feed(bytes(frame))
+        self.assertEqual(rx, [(bytes(frame), None)])
+
+    def test_sampling(self):
+        rx = []
+        framer = StreamFramer(RadioFrame, rx.append, sample_interval=3)
+        framer.feed(radio_frames(7))
+        self.assertEqual([frame.message and frame.message.sequence for frame in rx],
+                         [None, None, 2, None, None, 5, None])
+
+    def test_header_message_reused(self):
+        rx = []
+        framer = StreamFramer(ChecksummedFrame, rx.append)
+        frames = [ChecksummedFrame(sequence=i, payload=b'x' * (i % 4)).pack()
+                  for i in range(8)]
+        framer.feed(b''.join(frames))
+        self.assertEqual([data for data, _key in rx], frames)
+        # no message is constructed per frame
+        self.assertIs(framer._header_message(ChecksummedFrame),
+                      framer._header_message(ChecksummedFrame))
+
+    def test_schema_without_layout(self):
+        self.assertRaises(SuitcaseProgrammingError, StreamFramer, PointList, None)
+        self.assertEqual(repr(RawFrame(b'ab', 1)), "RawFrame(%r, 1)" % b'ab')
+
+
+class TestMultiSchema(unittest.TestCase):
+    def _stream(self):
+        return [
+            MagicSchema(value=1).pack(),
+            ChecksummedFrame(sequence=2, payload=b'two').pack(),
+            b'garbage',
+            LongMagicSchema(value=3).pack(),
+            PointList(origin=Point(x=4, y=4), body=Point(x=0, y=0)).pack(),
+            MagicSchema(value=5).pack(),
+        ]
+
+    def _check(self, rx):
+        self.assertEqual([type(p) for p in rx],
+                         [MagicSchema, ChecksummedFrame, LongMagicSchema,
+                          PointList, MagicSchema])
+        self.assertEqual(rx[1].payload, b'two')
+        self.assertEqual(rx[2].value, 3)
+        self.assertEqual(rx[3].origin.x, 4)
+
+    def test_demultiplex(self):
+        rx = []
+        phandler = MultiSchemaProtocolHandler(
+            [MagicSchema, LongMagicSchema, ChecksummedFrame, PointList], rx.append)
+        phandler.feed(b''.join(self._stream()))
+        self._check(rx)
+
+    def test_demultiplex_byte_at_a_time(self):
+        rx = []
+        phandler = MultiSchemaProtocolHandler(
+            [MagicSchema, LongMagicSchema, ChecksummedFrame, PointList], rx.append)
+        stream = b''.join(self._stream())
+        for i in range(len(stream)):
+            phandler.feed(stream[i:i + 1])
+        self._check(rx)
+        self.assertEqual(phandler._bytes_available(), 0)
+
+    def test_magic_within_longer_magic(self):
+        class Long(Structure):
+            magic = Magic(b'\x01\x02\x03')
+            value = UBInt8()
+
+        class Short(Structure):
+            magic = Magic(b'\x02')
+            value = UBInt8()
+
+        stream = Long(value=0x44).pack() + Short(value=0x55).pack()
+        for split in range(len(stream) + 1):
+            rx = []
+            phandler = MultiSchemaProtocolHandler([Long, Short], rx.append)
+            phandler.feed(stream[:split])
+            phandler.feed(stream[split:])
+            self.assertEqual([(type(p).__name__, p.value) for p in rx],
+                             [('Long', 0x44), ('Short', 0x55)])
+
+    def test_schema_validation(self):
+        self.assertRaises(SuitcaseProgrammingError, MultiSchemaProtocolHandler,
+                          [MagicSchema, OptionalTrailer], None)
+        self.assertRaises(SuitcaseProgrammingError, MultiSchemaProtocolHandler,
+                          [MagicSchema, MagicSchema], None)
+        self.assertRaises(SuitcaseProgrammingError, MultiSchemaProtocolHandler, [], None)
+        self.assertEqual(MultiSchemaProtocolHandler(
+            [MagicSchema, ChecksummedFrame], None).max_frame_size, 8 + 0xFFFF)
+
+
+class TestTerminatedFrames(unittest.TestCase):
+    def setUp(self):
+        self.rx = []
+        self.frames = [TextLine(address=i, text=b'line %d' % i * i)
+                       for i in range(1, 6)]
+        self.stream = b''.join(frame.pack() for frame in self.frames)
+
+    def test_layout(self):
+        layout = protocol._frame_layout(TextLine)
+        self.assertIsInstance(layout, protocol._TerminatedLayout)
+        self.assertEqual((layout.header_size, layout.terminator, layout.trailer_size),
+                         (2, b'\x03', 2))
+        self.assertEqual(protocol._TerminatedLayout.from_schema(GreedyTail), None)
+
+    def test_fragmented(self):
+        for chunk_size in (1, 2, 7, len(self.stream)):
+            del self.rx[:]
+            handler = StreamProtocolHandler(TextLine, self.rx.append)
+            for offset in range(0, len(self.stream), chunk_size):
+                handler.feed(self.stream[offset:offset + chunk_size])
+            self.assertEqual([(m.address, m.text) for m in self.rx],
+                             [(m.address, m.text) for m in self.frames])
+
+    def test_search_resumes(self):
+        finds = []
+
+        class CountingBuffer(bytearray):
+            def find(self, *args):
+                finds.append(args[2] - args[1])
+                return bytearray.find(self, *args)
+
+        handler = StreamProtocolHandler(TextLine, self.rx.append)
+        handler._buffer = CountingBuffer(1 << 16)
+        frame = TextLine(address=1, text=b'x' * 4000).pack()
+        for offset in range(0, len(frame), 10):
+            handler.feed(frame[offset:offset + 10])
+        self.assertEqual(len(self.rx), 1)
+        # each byte is searched for the terminator (and the Magic) once
+        self.assertTrue(sum(finds) <= 2 * len(frame), sum(finds))
+
+    def test_bad_checksum(self):
+        data = bytearray(self.stream)
+        data[5] ^= 0xFF
+        handler = StreamProtocolHandler(TextLine, self.rx.append,
+                                        resync_on_error=True)
+        handler.feed(bytes(data))
+        self.assertEqual([m.address for m in self.rx], [2, 3, 4, 5])
+        self.assertEqual(handler.resyncs, 1)
+
+    def test_missing_terminator(self):
+        handler = StreamProtocolHandler(TextLine, self.rx.append, max_frame_size=64,
+                                        overflow_policy=OVERFLOW_RESYNC)
+        handler.feed(b'\x02\x09' + b'x' * 100 + self.stream)
+        self.assertEqual(len(self.rx), len(self.frames))
+        self.assertEqual(handler.overflows, 1)
+
+        handler = StreamProtocolHandler(TextLine, self.rx.append, max_frame_size=64)
+        self.assertRaises(SuitcaseBufferOverflowError, handler.feed,
+                          b'\x02\x09' + b'x' * 100)
+
+
+class TestStreamedPayload(unittest.TestCase):
+    def setUp(self):
+        self.rx = []
+        self.chunks = []
+        self.image = bytes(bytearray(i & 0xFF for i in range(1 << 20)))
+        self.frame = FirmwareImage(slot=2, image=self.image).pack()
+
+    def sink(self, message):
+        self.assertEqual(message.slot, 2)
+        self.assertEqual(message.length, len(self.image))
+        return self.chunks.append
+
+    def test_payload_is_not_buffered(self):
+        handler = StreamProtocolHandler(FirmwareImage, self.rx.append,
+                                        payload_sink=self.sink, max_buffer_size=8192)
+        for offset in range(0, len(self.frame), 4096):
+            handler.feed(self.frame[offset:offset + 4096])
+            self.assertTrue(len(handler._buffer) <= 16384)
+        self.assertEqual(b''.join(self.chunks), self.image)
+        self.assertEqual(len(self.rx), 1)
+        self.assertEqual(self.rx[0].slot, 2)
+        self.assertEqual(self.rx[0].image, None)
+        self.assertEqual(handler.overflows, 0)
+
+    def test_byte_at_a_time(self):
+        self.image = b'\xF0\x0D\x04' * 3
+        self.frame = FirmwareImage(slot=2, image=self.image).pack()
+        handler = StreamProtocolHandler(FirmwareImage, self.rx.append,
+                                        payload_sink=self.sink)
+        for byte in six.iterbytes(self.frame * 2):
+            handler.feed(six.int2byte(byte))
+        self.assertEqual(b''.join(self.chunks), self.image * 2)
+        self.assertEqual(len(self.rx), 2)
+
+    def test_bad_checksum(self):
+        frame = bytearray(self.frame)
+        frame[100] ^= 0x01
+        handler = StreamProtocolHandler(FirmwareImage, self.rx.append,
+                                        payload_sink=self.sink)
+        handler.feed(bytes(frame))
+        self.assertEqual(self.rx, [])
+        handler.feed(self.frame)
+        self.assertEqual(len(self.rx), 1)
+
+    def test_bad_checksum_reported(self):
+        frame = bytearray(self.frame)
+        frame[100] ^= 0x01
+        failed = []
+        handler = StreamProtocolHandler(
+            FirmwareImage, self.rx.append, payload_sink=self.sink,
+            payload_error_callback=lambda message, error: failed.append((message, error)))
+        handler.feed(bytes(frame))
+        self.assertEqual(self.rx, [])
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0][0].slot, 2)
+        self.assertIsInstance(failed[0][1], SuitcaseChecksumException)
+        handler.feed(self.frame)
+        self.assertEqual(len(self.rx), 1)
+        self.assertEqual(len(failed), 1)
+
+    def test_sink_errors_are_not_parse_errors(self):
+        def sink(message):
+            def write(data):
+                raise IOError("disk full")
+            return write
+
+        failed = []
+        handler = StreamProtocolHandler(
+            FirmwareImage, self.rx.append, payload_sink=sink,
+            payload_error_callback=lambda message, error: failed.append(error))
+        self.assertRaises(IOError, handler.feed, self.frame[:5000])
+        # the rest of the frame is discarded, the next one is parsed
+        handler.feed(self.frame[5000:])
+        self.assertEqual(handler.frames_dropped, 1)
+        handler.payload_sink = self.sink
+        handler.feed(self.frame)
+        self.assertEqual(len(self.rx), 1)
+        self.assertEqual(b''.join(self.chunks), self.image)
+        self.assertEqual(failed, [])
+
+    def test_without_sink(self):
+        handler = StreamProtocolHandler(FirmwareImage, self.rx.append)
+        handler.feed(self.frame)
+        self.assertEqual(self.rx[0].image, self.image)
+        self.assertEqual(FirmwareImage.from_data(self.frame).image, self.image)
+
+    def test_checksum_must_be_resumable(self):
+        class Unresumable(Structure):
+            length = LengthField(UBInt8())
+            data = StreamedPayload(length)
+            crc = CRCField(UBInt16(), lambda data, crc=0: 0, 0, -2)
+
+        StreamProtocolHandler(Unresumable, self.rx.append)
+        self.assertRaises(SuitcaseProgrammingError, StreamProtocolHandler,
+                          Unresumable, self.rx.append, payload_sink=self.sink)
+
+        class UnresumableImage(Structure):
+            magic = Magic(b'\xBA\xD0')
+            length = LengthField(UBInt8())
+            data = StreamedPayload(length)
+            crc = CRCField(UBInt16(), lambda data, crc=0: 0, 0, -2)
+
+        MultiSchemaProtocolHandler([FirmwareImage, UnresumableImage], self.rx.append)
+        # every schema is checked, not only the first
+        self.assertRaises(SuitcaseProgrammingError, MultiSchemaProtocolHandler,
+                          [FirmwareImage, UnresumableImage], self.rx.append,
+                          payload_sink=self.sink)
+
+
+class TestFrameWriter(unittest.TestCase):
+    def setUp(self):
+        self.writes = []
+        self.now = 100.0
+        self._clock = protocol._clock
+        protocol._clock = lambda: self.now
+
+    def tearDown(self):
+        protocol._clock = self._clock
+
+    def write(self, data):
+        self.writes.append(bytes(bytearray(data)))  # bytes or a memoryview
+
+    def test_flush_size(self):
+        writer = FrameWriter(self.write, flush_size=70)
+        frames = [RadioFrame(sequence=i, payload=b'x' * 10).pack() for i in range(20)]
+        writer.write_many(frames[:4])
+        self.assertEqual(self.writes, [])
+        self.assertEqual(writer.bytes_buffered, 64)
+        writer.write_many(RadioFrame.from_data(frame) for frame in frames[4:])
+        writer.flush()
+        self.assertEqual(b''.join(self.writes), b''.join(frames))
+        self.assertEqual([len(data) for data in self.writes], [64] * 5)
+        self.assertEqual(writer.frames_written, 20)
+        self.assertEqual(writer.bytes_written, 320)
+        self.assertEqual(writer.writes, 5)
+        self.assertEqual(writer.writes_saved, 15)
+
+    def test_large_frames(self):
+        writer = FrameWriter(self.write, flush_size=16)
+        writer.write(b'small')
+        writer.write(b'L' * 40)
+        writer.write(b'x' * 11)
+        writer.write(b'y' * 5)
+        self.assertEqual(self.writes, [b'small', b'L' * 40, b'x' * 11 + b'y' * 5])
+
+    def test_flush_interval_and_latency(self):
+        writer = FrameWriter(self.write, flush_interval=0.01)
+        writer.write(b'a')
+        self.assertAlmostEqual(writer.poll(), 0.01)
+        self.now += 0.004
+        writer.write(b'b')
+        self.assertEqual(self.writes, [])
+        self.now += 0.008
+        self.assertEqual(writer.poll(), None)
+        self.assertEqual(self.writes, [b'ab'])
+        self.assertAlmostEqual(writer.max_latency, 0.012)
+        self.assertAlmostEqual(writer.mean_latency, 0.010)
+
+        writer.write(b'c')
+        self.now += 0.02
+        writer.write(b'd')  # the wait of the oldest frame is checked on write
+        self.assertEqual(self.writes, [b'ab', b'cd'])
+
+    def test_failed_write_keeps_frames(self):
+        def failing_write(data):
+            raise socket.error("connection reset")
+
+        writer = FrameWriter(failing_write)
+        writer.write(b'abc')
+        self.assertRaises(socket.error, writer.flush)
+        self.assertEqual(writer.bytes_buffered, 3)
+        writer.write_function = self.write
+        writer.flush()
+        self.assertEqual(self.writes, [b'abc'])
+
+    def test_socket(self):
+        a, b = socket.socketpair()
+        try:
+            writer = FrameWriter(a.sendall)
+            rx = []
+            handler = StreamProtocolHandler(RadioFrame, rx.append)
+            for i in range(100):
+                writer.write(RadioFrame(sequence=i, payload=b'y' * i))
+            writer.flush()
+            a.shutdown(socket.SHUT_WR)
+            while True:
+                data = b.recv(65536)
+                if not data:
+                    break
+                handler.feed(data)
+            self.assertEqual([m.sequence for m in rx], list(range(100)))
+            self.assertEqual(writer.writes, 1)
+        finally:
+            a.close()
+            b.close()
+
+
+class TestDatagramProtocolHandler(unittest.TestCase):
+    def setUp(self):
+        self.rx = []
+        self.errors = []
+        self.handler = DatagramProtocolHandler(
+            RadioFrame, lambda packet, address: self.rx.append((packet, address)),
+            error_callback=lambda data, address, exc: self.errors.append(data),
+            batch_size=8)
+
+    def test_feed(self):
+        frame = RadioFrame(sequence=1, payload=b'abc').pack()
+        self.handler.feed(frame, 'peer')
+        self.handler.feed(frame[:-1], 'peer')
+        self.handler.feed(frame + b'x', 'peer')
+        self.handler.feed_many([(bytearray(frame), 'a'), (b'junk', 'b'), (frame, 'c')])
+        self.assertEqual([(m.payload, address) for m, address in self.rx],
+                         [(b'abc', 'peer'), (b'abc', 'a'), (b'abc', 'c')])
+        self.assertEqual(self.errors, [frame[:-1], frame + b'x', b'junk'])
+        self.assertEqual(self.handler.frames_received, 3)
+        self.assertEqual(self.handler.errors, 3)
+
+    def test_loopback(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(('127.0.0.1', 0))
+            address = receiver.getsockname()
+            datagrams = [RadioFrame(sequence=i, payload=b'z' * i).pack()
+                         for i in range(20)]
+            datagrams[5] = datagrams[5][:-2] + b'\x00\x00'  # bad checksum
+            for datagram in datagrams:
+                sender.sendto(datagram, address)
+
+            receiver.settimeout(None)
+            counts = []
+            while sum(counts) < 20:
+                counts.append(self.handler.receive(receiver))
+            self.assertTrue(len(counts) < 20, counts)  # datagrams were batched
+            self.assertTrue(max(counts) <= 8)
+            self.assertEqual([m.sequence for m, _address in self.rx],
+                             [i for i in range(20) if i != 5])
+            self.assertEqual(self.rx[0][1][1], sender.getsockname()[1])
+            self.assertEqual(self.errors, [datagrams[5]])
+
+            receiver.setblocking(False)
+            self.assertEqual(self.handler.receive(receiver), 0)
+        finally:
+            receiver.close()
+            sender.close()
+
+
+class TestResumableParser(unittest.TestCase):
+    def _point_list(self, body):
+        m = PointList()
+        m.origin = Point(x=1, y=2)
+        m.points = [Point(x=i, y=i + 1) for i in range(3)]
+        m.body = body
+        return m.pack()
+
+    def test_parser_reports_bytes_required(self):
+        data = self._point_list(Point(x=7, y=8))
+        parser = StreamParser(PointList)
+        self.assertEqual(parser.advance(data[:2]), None)
+        self.assertEqual(parser.bytes_consumed, 2)
+        self.assertEqual(parser.bytes_required, 3)
+        msg = parser.advance(data)
+        self.assertEqual(msg.body.x, 7)
+        self.assertEqual(parser.bytes_consumed, len(data))
+
+    def test_parser_with_offset(self):
+        data = self._point_list(Point(x=7, y=8))
+        buf = bytearray(b'junk' + data + b'more')
+        msg = StreamParser(PointList).advance(buf, 4, 4 + len(data))
+        self.assertEqual([(p.x, p.y) for p in msg.points],
+                         [(0, 1), (1, 2), (2, 3)])
+
+    def test_nested_frames_byte_at_a_time(self):
+        rx = []
+        phandler = StreamProtocolHandler(PointList, rx.append)
+        self.assertEqual(phandler._frame_layout, None)
+        stream = (self._point_list(Point(x=7, y=8)) + b'\x00\x00' +
+                  self._point_list(MagicSchema(value=-5)))
+        for i in range(len(stream)):
+            phandler.feed(stream[i:i + 1])
+        self.assertEqual(len(rx), 2)
+        self.assertEqual((rx[0].origin.x, rx[0].origin.y), (1, 2))
+        self.assertEqual(rx[0].body.y, 8)
+        self.assertEqual(rx[1].points[2].y, 3)
+        self.assertEqual(rx[1].body.value, -5)
+        self.assertEqual(phandler._bytes_available(), 0)
+
+    def test_nested_bad_checksum_is_rejected(self):
+        rx = []
+        phandler = StreamProtocolHandler(PointList, rx.append)
+        frame = bytearray(self._point_list(Point(x=7, y=8)))
+        frame[-1] ^= 0xFF
+        phandler.feed(bytes(frame))
+        self.assertEqual(rx, [])
+        phandler.feed(self._point_list(Point(x=7, y=8)))
+        self.assertEqual(len(rx), 1)
+
+    def test_unbounded_greedy_field(self):
+        parser = StreamParser(GreedyTail)
+        self.assertRaises(SuitcaseParseError, parser.advance, b'\x01ab')
+
 
 if __name__ == '__main__':
     unittest.main()